@@ -0,0 +1,62 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import h5py
+import numpy as np
+
+from vsearch.benchmark import (synthetic_vocabulary, zipf_word_sampler, generate_collection, generate_bow_database,
+                               run_suite, suite_report, compare_results)
+from vsearch.database import AnnDatabase
+from vsearch.utils import load_descriptors_and_points
+
+
+class BenchmarkTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_zipf_words(self):
+        sample = zipf_word_sampler(1000, 1.0)
+        words = sample(20000, np.random.RandomState(0))
+        self.assertTrue(np.all((words >= 0) & (words < 1000)))
+        counts = np.sort(np.bincount(words, minlength=1000))[::-1]
+        self.assertGreater(counts[0], 10 * counts[100])
+        np.testing.assert_equal(words, sample(20000, np.random.RandomState(0)))
+
+    def test_generate(self):
+        vocabulary = synthetic_vocabulary(50, 11)
+        paths = generate_collection(self.directory, vocabulary, 3, 'colornames', descriptors_per_image=40)
+        self.assertEqual(len(paths), 3)
+        descriptors, points = load_descriptors_and_points(paths[0])
+        self.assertEqual(descriptors.shape, (40, 11))
+        self.assertEqual(points.shape, (40, 2))
+
+        database_file = os.path.join(self.directory, 'db.h5')
+        generate_bow_database(database_file, vocabulary, 20, words_per_image=30, keypoint_words=True)
+        db = AnnDatabase.from_file(database_file)
+        self.assertEqual(len(db), 20)
+        self.assertEqual(db.vocabulary_size, 50)
+        self.assertTrue(all(db[key].sum() == 30 for key in db))
+        with h5py.File(database_file, 'r') as f:
+            self.assertEqual(len(f['keypoint_words']), 20)
+
+    def test_suite(self):
+        stages = ['index', 'load', 'bag', 'query_descriptors', 'query_bow']
+        results = run_suite(self.directory, n_images=30, vocabulary_size=100, words_per_image=20, queries=3,
+                            repeats=1, stages=stages)
+        self.assertEqual([r['stage'] for r in results], stages)
+        for r in results:
+            self.assertGreater(r['seconds'], 0)
+            self.assertGreater(r['max_rss_bytes'], 0)
+
+        report = suite_report(results, {'images': 30})
+        comparison = compare_results(report, report)
+        self.assertEqual([c['ratio'] for c in comparison], [1.] * len(stages))
+        with self.assertRaises(ValueError):
+            compare_results(report, suite_report(results, {'images': 31}))
+        with self.assertRaises(ValueError):
+            run_suite(self.directory, stages=['nonsense'])
@@ -0,0 +1,43 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from vsearch.cache import LRUCache, file_cache_key, nbytes
+
+
+class LRUCacheTests(unittest.TestCase):
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(max_bytes=3 * 80)
+        for i in range(3):
+            cache.put(i, np.zeros(10))
+        self.assertIsNotNone(cache.get(0))  # 1 is now the least recently used
+        cache.put(3, np.zeros(10))
+        self.assertIn(0, cache)
+        self.assertNotIn(1, cache)
+        self.assertEqual(cache.nbytes, 3 * 80)
+
+    def test_too_large_value(self):
+        cache = LRUCache(max_bytes=100)
+        cache.put('big', np.zeros(100))
+        self.assertNotIn('big', cache)
+        self.assertEqual(cache.nbytes, 0)
+
+    def test_replace_value(self):
+        cache = LRUCache(max_bytes=1000)
+        cache.put('a', np.zeros(10))
+        cache.put('a', np.zeros(20))
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.nbytes, 160)
+
+    def test_nbytes(self):
+        self.assertEqual(nbytes((np.zeros(2), [np.zeros(3, dtype='uint8')], None)), 19)
+
+    def test_file_cache_key_changes_with_mtime(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            path = os.path.join(tempdir, 'file.txt')
+            open(path, 'w').close()
+            key = file_cache_key(path)
+            os.utime(path, ns=(0, 12345))
+            self.assertNotEqual(key, file_cache_key(path))
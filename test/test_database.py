@@ -1,10 +1,19 @@
+import os
+import shutil
+import tempfile
 import unittest
+from unittest import mock
 
+import cv2
 import numpy as np
 import numpy.testing as nt
 import h5py
 
-from vsearch.database import AnnDatabase, DatabaseError, DatabaseWithLocation, DatabaseEntry, LatLng
+from vsearch.database import AnnDatabase, DatabaseError, DatabaseWithLocation, DatabaseEntry, LatLng, \
+    SiftFeatureDatabase, ColornamesFeatureDatabase, SiftColornamesWrapper, cos_distance, top_k, fuse_min_top_k, \
+    CancellationToken, QueryCancelled, BoundingBox, Circle
+from vsearch.database import KEYPOINT_WORDS_GROUP, KEYPOINT_POINTS_GROUP
+from vsearch.utils import save_keypoints_and_descriptors
 
 test_db = 'test_db.h5'
 test_db_items = 222
@@ -16,7 +25,7 @@ test_vocabulary_feature_size = 11
 class AnnDatabaseTest(unittest.TestCase):
     def setUp(self):
         with h5py.File(test_vocabulary, 'r') as f:
-            self.vocabulary = f['vocabulary'].value
+            self.vocabulary = f['vocabulary'][()]
 
     def random_bow(self):
         bow = np.random.randint(-4, 5, size=test_vocabulary_size)
@@ -60,6 +69,33 @@ class AnnDatabaseTest(unittest.TestCase):
         db = AnnDatabase(self.vocabulary)
         self.assertEqual(db.vocabulary_size, test_vocabulary_size)
 
+    def test_stop_words(self):
+        db = AnnDatabase(self.vocabulary)
+        # Word 0 is in every image, and words 1 and 2 in most of them
+        bows = (np.random.RandomState(0).rand(20, test_vocabulary_size) < 0.1).astype('int')
+        bows[:, 0] = 1
+        bows[:18, 1:3] = 1
+        db.add_images(('image{:d}'.format(i), bow) for i, bow in enumerate(bows))
+        query = bows[5].astype('float')
+        distances = db.distances(query)
+        nnz = db._scoring_matrix.nnz
+
+        nt.assert_equal(db.set_stop_words(fraction=0.03), [0, 1, 2])
+        self.assertTrue(np.all(db.idf[[0, 1, 2]] == 0))
+        self.assertEqual(db._scoring_matrix, None)
+        stopped = db.distances(query)
+        self.assertEqual(db._scoring_matrix.nnz, nnz - bows[:, :3].sum())
+        nt.assert_almost_equal(stopped[5], 0)
+        self.assertEqual(db.query_bow(query, 1)[0][0], 'image5')
+
+        self.assertEqual(len(db.set_stop_words()), 0)
+        nt.assert_almost_equal(db.distances(query), distances)
+
+        nt.assert_equal(db.set_stop_words(min_idf=0.), [0])
+        # The stop list follows the document frequencies: word 0 is no longer in every image
+        db.add_image('new', np.eye(test_vocabulary_size)[1])
+        self.assertEqual(len(db.stop_words), 0)
+
     def test_idf_changes(self):
         db = AnnDatabase(self.vocabulary)
         self.assertIsNone(db.idf)
@@ -105,6 +141,27 @@ class AnnDatabaseTest(unittest.TestCase):
         db = AnnDatabase.from_file(test_db)
         self.assertEqual(len(db), test_db_items)
 
+    def test_load_from_file_progress(self):
+        calls = []
+        db = AnnDatabase.from_file(test_db, progress=lambda *args: calls.append(args), chunk_size=100)
+        self.assertEqual([(n, total) for _, n, total in calls], [(100, 222), (200, 222), (222, 222)])
+        self.assertEqual(sum(len(keys) for keys, *_ in calls), test_db_items)
+        self.assertEqual(set(db), {key for keys, *_ in calls for key in keys})
+
+    def test_add_images_idf(self):
+        bows = [self.random_bow() for _ in range(5)]
+        db1 = AnnDatabase(self.vocabulary)
+        for i, bow in enumerate(bows):
+            db1.add_image(str(i), bow)
+        db2 = AnnDatabase(self.vocabulary)
+        db2.add_images((str(i), bow) for i, bow in enumerate(bows))
+        nt.assert_almost_equal(db1.idf, db2.idf)
+
+        del db2['4']
+        db3 = AnnDatabase(self.vocabulary)
+        db3.add_images((str(i), bow) for i, bow in enumerate(bows[:4]))
+        nt.assert_almost_equal(db2.idf, db3.idf)
+
 class LocationDatabaseTests(unittest.TestCase):
     def setUp(self):
         self.visualdb = AnnDatabase.from_file(test_db)
@@ -125,3 +182,350 @@ class LocationDatabaseTests(unittest.TestCase):
             self.assertEqual(val.latlng.lat, lat)
             self.assertEqual(val.latlng.lng, lng)
 
+    def test_location_files(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'geo.csv')
+        try:
+            locdb = DatabaseWithLocation(self.visualdb)
+            keys = list(locdb)[:3]
+            locdb.set_locations(keys, [[58.1, 16.1], [58.2, 16.2], [58.3, 16.3]])
+            self.assertTrue(locdb.has_unsaved_locations)
+            locdb.save_locations(path)
+            self.assertFalse(locdb.has_unsaved_locations)
+            self.assertFalse(os.path.exists(path + '.npz'))
+            locdb.save_locations(path, sidecar=True)
+            self.assertTrue(os.path.exists(path + '.npz'))
+
+            # Edits are appended to the journal, and the file itself is unchanged
+            locdb[keys[0]] = LatLng(59.0, 17.0)
+            locdb[keys[1]] = None
+            size = os.path.getsize(path)
+            locdb.commit_locations(path)
+            self.assertEqual(os.path.getsize(path), size)
+
+            for sidecar in (True, False):
+                loaded = DatabaseWithLocation(self.visualdb)
+                self.assertEqual(loaded.load_locations(path, sidecar=sidecar), [])
+                self.assertEqual(loaded[keys[0]].latlng, LatLng(59.0, 17.0))
+                self.assertIsNone(loaded[keys[1]].latlng)
+                self.assertEqual(loaded[keys[2]].latlng, LatLng(58.3, 16.3))
+                self.assertEqual(sorted(loaded.keys_in_bbox(58.0, 16.0, 60.0, 18.0)), sorted([keys[0], keys[2]]))
+                self.assertFalse(loaded.has_unsaved_locations)
+
+            locdb.save_locations(path)
+            self.assertFalse(os.path.exists(path + '.journal'))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_spatial_queries(self):
+        locdb = DatabaseWithLocation(self.visualdb)
+        keys = list(locdb)
+        locdb[keys[0]] = LatLng(58.5890, 16.1800)
+        locdb[keys[1]] = LatLng(58.5900, 16.1810)
+        locdb[keys[2]] = LatLng(58.6200, 16.2500)
+        self.assertEqual(sorted(locdb.keys_in_bbox(58.58, 16.17, 58.60, 16.19)), sorted(keys[:2]))
+        nearby = locdb.keys_within_radius(LatLng(58.5890, 16.1800), 500)
+        self.assertEqual([k for k, _ in nearby], keys[:2])
+
+        locdb[keys[1]] = LatLng(58.6201, 16.2501)
+        self.assertEqual(locdb.keys_in_bbox(58.58, 16.17, 58.60, 16.19), [keys[0]])
+        locdb[keys[0]] = None
+        del locdb[keys[2]]
+        self.assertEqual(locdb.keys_in_bbox(58.0, 16.0, 59.0, 17.0), [keys[1]])
+
+
+class QueryTests(unittest.TestCase):
+    def setUp(self):
+        self.db = AnnDatabase.from_file(test_db)
+
+    def test_query_bow_matches_cos_distance(self):
+        bow = self.db[self.db.key_order[7]]
+        expected = sorted(((key, cos_distance(bow * self.db.idf, t * self.db.idf))
+                           for key, t in self.db.items()), key=lambda x: x[1])
+        matches = self.db.query_bow(bow)
+        self.assertEqual(len(matches), test_db_items)
+        nt.assert_almost_equal([d for _, d in matches], [d for _, d in expected])
+        self.assertEqual(matches[0][0], self.db.key_order[7])
+
+    def test_query_max_results(self):
+        bow = self.db[self.db.key_order[3]]
+        all_matches = self.db.query_bow(bow)
+        matches = self.db.query_bow(bow, max_results=5)
+        self.assertEqual(matches, all_matches[:5])
+
+    def test_scoring_updated_on_insert(self):
+        bow = self.db[self.db.key_order[0]]
+        self.db.add_image('new_image.jpg', bow)
+        self.assertIn('new_image.jpg', self.db.key_order)
+        self.assertEqual(len(self.db.distances(bow)), test_db_items + 1)
+
+    def test_top_k(self):
+        d = np.random.uniform(size=50)
+        nt.assert_equal(top_k(d), np.argsort(d))
+        nt.assert_equal(top_k(d, 7), np.argsort(d)[:7])
+        self.assertEqual(len(top_k(d, 0)), 0)
+
+    def test_fuse_min_top_k(self):
+        a = np.random.uniform(size=100)
+        b = np.random.uniform(size=100)
+        fused = np.minimum(a, b)
+        for k in (1, 10, None):
+            indices, distances = fuse_min_top_k(a, b, k)
+            nt.assert_equal(indices, np.argsort(fused)[:k])
+            nt.assert_almost_equal(distances, np.sort(fused)[:k])
+
+    def test_query_descriptors_batch(self):
+        vocabulary = self.db.annoy_index
+        queries = [np.vstack([vocabulary.get_item_vector(w) for w in np.random.randint(0, test_vocabulary_size, 30)])
+                   for _ in range(4)]
+        # Scored in two chunks
+        with mock.patch('vsearch.database.QUERY_CHUNK_SIZE', 3):
+            batch_matches = self.db.query_descriptors_batch(queries, max_results=8)
+        self.assertEqual(len(batch_matches), len(queries))
+        for descriptors, matches in zip(queries, batch_matches):
+            expected = self.db.query_descriptors(descriptors, max_results=8)
+            self.assertEqual([k for k, _ in matches], [k for k, _ in expected])
+            nt.assert_almost_equal([d for _, d in matches], [d for _, d in expected])
+
+    def test_query_paths(self):
+        db = SiftFeatureDatabase.from_file(test_db)
+        vocabulary = db.annoy_index
+        with tempfile.TemporaryDirectory() as tempdir:
+            paths = []
+            for i in range(3):
+                path = os.path.join(tempdir, 'image_{:d}.jpg'.format(i))
+                descriptors = np.vstack([vocabulary.get_item_vector(w)
+                                         for w in np.random.randint(0, test_vocabulary_size, 20)])
+                keypoints = [cv2.KeyPoint(float(x), float(x), 1.) for x in range(len(descriptors))]
+                save_keypoints_and_descriptors(db.feature_file_for_image(path), keypoints, descriptors)
+                paths.append(path)
+
+            rois = [(0, 0, 10, 10), None, (5, 5, 100, 100)]
+            with mock.patch('vsearch.database.QUERY_CHUNK_SIZE', 2):
+                batch_matches = db.query_paths(paths, rois, max_results=5)
+            self.assertEqual(len(batch_matches), 3)
+            for path, roi, matches in zip(paths, rois, batch_matches):
+                expected = db.query_path(path, roi, max_results=5)
+                self.assertEqual([k for k, _ in matches], [k for k, _ in expected])
+
+    def test_query_feature_cache(self):
+        db = SiftFeatureDatabase.from_file(test_db)
+        vocabulary = db.annoy_index
+        quantized = []
+        quantize = db.quantize
+        db.quantize = lambda descriptors: quantized.append(len(descriptors)) or quantize(descriptors)
+
+        with tempfile.TemporaryDirectory() as tempdir:
+            path = os.path.join(tempdir, 'image.jpg')
+            descriptors = np.vstack([vocabulary.get_item_vector(w)
+                                     for w in np.random.randint(0, test_vocabulary_size, 20)])
+            keypoints = [cv2.KeyPoint(float(x), float(x), 1.) for x in range(len(descriptors))]
+            save_keypoints_and_descriptors(db.feature_file_for_image(path), keypoints, descriptors)
+
+            small = db.query_path(path, (0, 0, 9, 9))
+            self.assertEqual(quantized, [10])
+            full = db.query_path(path, None)
+            self.assertEqual(quantized, [10, 10])
+            db.query_path(path, (2, 2, 5, 5))
+            self.assertEqual(quantized, [10, 10])
+            self.assertEqual(len(db.feature_cache), 1)
+
+            expected = db.query_descriptors(descriptors)
+            self.assertEqual([k for k, _ in full], [k for k, _ in expected])
+
+    def test_spatial_feature_file(self):
+        db = SiftFeatureDatabase.from_file(test_db)
+        vocabulary = db.annoy_index
+        descriptors = np.vstack([vocabulary.get_item_vector(w) for w in np.random.randint(0, test_vocabulary_size, 64)])
+        keypoints = [cv2.KeyPoint(float(x), float(y), 1.) for y in range(4, 64, 8) for x in range(4, 64, 8)]
+        roi = (0, 0, 20, 20)
+        with tempfile.TemporaryDirectory() as tempdir:
+            paths = [os.path.join(tempdir, name) for name in ('plain.jpg', 'spatial.jpg')]
+            save_keypoints_and_descriptors(db.feature_file_for_image(paths[0]), keypoints, descriptors)
+            save_keypoints_and_descriptors(db.feature_file_for_image(paths[1]), keypoints, descriptors, grid=4,
+                                           image_size=(64, 64))
+            nt.assert_equal(db.bow_for_path(paths[1], roi), db.bow_for_path(paths[0], roi))
+            # Only the cells within the ROI were read
+            self.assertEqual(len(db.features_for_path(paths[1], roi).points), 16)
+            nt.assert_equal(db.bow_for_path(paths[1], None), db.bow_for_path(paths[0], None))
+            self.assertEqual(len(db.features_for_path(paths[1], roi).points), 64)
+
+    def test_stored_keypoint_words(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            db_path = os.path.join(tempdir, 'db.h5')
+            words = np.random.randint(0, test_vocabulary_size, 40)
+            points = np.random.uniform(0, 100, size=(40, 2))
+            with h5py.File(test_db, 'r') as src, h5py.File(db_path, 'w') as f:
+                f['vocabulary'] = src['vocabulary'][()]
+                f['image.jpg'] = np.bincount(words, minlength=test_vocabulary_size)
+                f['other.jpg'] = src[self.db.key_order[0]][()]
+                f[KEYPOINT_WORDS_GROUP + '/image.jpg'] = words
+                f[KEYPOINT_POINTS_GROUP + '/image.jpg'] = points
+
+            db = SiftFeatureDatabase.from_file(db_path)
+            self.assertEqual(len(db), 2)
+            nt.assert_equal(db.bow_for_key('image.jpg', None), db['image.jpg'])
+
+            roi = (10, 20, 50, 30)
+            inside = (points[:, 0] >= 10) & (points[:, 0] <= 60) & (points[:, 1] >= 20) & (points[:, 1] <= 50)
+            nt.assert_equal(db.bow_for_key('image.jpg', roi), np.bincount(words[inside], minlength=test_vocabulary_size))
+            self.assertEqual(db.query_key('image.jpg', None)[0][0], 'image.jpg')
+
+            with self.assertRaises(KeyError):
+                db.bow_for_key('other.jpg', None)
+
+
+class WrapperTests(unittest.TestCase):
+    def setUp(self):
+        self.sift_db = SiftFeatureDatabase.from_file(test_db)
+        with h5py.File(test_db, 'r') as f:
+            self.cname_db = ColornamesFeatureDatabase(f['vocabulary'][()])
+        for key in reversed(list(self.sift_db)):
+            self.cname_db.add_image(key, self.sift_db[key])
+
+    def test_fuse_distances_aligns_keys(self):
+        wrapper = SiftColornamesWrapper(self.sift_db, self.cname_db)
+        self.assertNotEqual(self.sift_db.key_order, self.cname_db.key_order)
+        bow = self.sift_db[self.sift_db.key_order[11]]
+        sift_distances = self.sift_db.distances(bow)
+        cname_distances = self.cname_db.distances(bow)
+        matches = wrapper.fuse_distances(sift_distances, cname_distances, max_results=10)
+        expected = wrapper.combine_matches(self.sift_db.query_bow(bow), self.cname_db.query_bow(bow))[:10]
+        self.assertEqual([k for k, _ in matches], [k for k, _ in expected])
+        nt.assert_almost_equal([d for _, d in matches], [d for _, d in expected])
+
+    def test_query_descriptors_batch(self):
+        wrapper = SiftColornamesWrapper(self.sift_db, self.cname_db)
+        bows = [self.sift_db[key] for key in self.sift_db.key_order[:3]]
+        descriptors = [np.vstack([np.tile(self.sift_db.annoy_index.get_item_vector(w), (int(n), 1))
+                                  for w, n in enumerate(bow) if n > 0]) for bow in bows]
+        with mock.patch('vsearch.database.QUERY_CHUNK_SIZE', 2):
+            batch_matches = wrapper.query_descriptors_batch(descriptors, descriptors, max_results=4)
+        self.assertEqual(len(batch_matches), 3)
+        for bow, matches in zip(bows, batch_matches):
+            expected = wrapper.fuse_distances(self.sift_db.distances(bow), self.cname_db.distances(bow), 4)
+            self.assertEqual([k for k, _ in matches], [k for k, _ in expected])
+
+        with self.assertRaises(DatabaseError):
+            wrapper.query_descriptors_batch(descriptors, descriptors[:1])
+
+    def test_from_files_progress(self):
+        # Both databases are loaded concurrently, and report their progress separately
+        calls = []
+        wrapper = SiftColornamesWrapper.from_files(test_db, test_db, progress=lambda *args: calls.append(args))
+        for name in ('sift', 'colornames'):
+            reports = [(n, total) for db_name, _, n, total in calls if db_name == name]
+            self.assertEqual(reports[-1], (test_db_items, test_db_items))
+            self.assertEqual({key for db_name, keys, *_ in calls if db_name == name for key in keys}, set(wrapper))
+        self.assertEqual(len(wrapper), test_db_items)
+
+    def test_from_files_progress_error(self):
+        loaded = []
+
+        def progress(name, keys, num_loaded, num_total):
+            if name == 'sift':
+                raise DatabaseError('Unknown key')
+            loaded.append(num_loaded)
+
+        with self.assertRaises(DatabaseError):
+            SiftColornamesWrapper.from_files(test_db, test_db, progress=progress)
+        self.assertLessEqual(len(loaded), 1)
+
+    def patch_path_features(self, bow):
+        # Let both databases answer path queries with a fixed BoW vector
+        for db in (self.sift_db, self.cname_db):
+            db.features_for_path = lambda path, roi=None: None
+            db.bow_for_path = lambda path, roi: bow
+
+    def test_query_progressive(self):
+        wrapper = SiftColornamesWrapper(self.sift_db, self.cname_db)
+        bow = self.sift_db[self.sift_db.key_order[7]]
+        self.patch_path_features(bow)
+        reports = []
+        matches = wrapper.query_progressive('query.jpg', None, max_results=5, callback=reports.append, block_size=50)
+        expected = wrapper.fuse_distances(self.sift_db.distances(bow), self.cname_db.distances(bow), 5)
+        self.assertEqual([k for k, _ in matches], [k for k, _ in expected])
+        nt.assert_almost_equal([d for _, d in matches], [d for _, d in expected])
+
+        stages = [r.stage for r in reports]
+        self.assertEqual(stages.count('scoring'), int(np.ceil(test_db_items / 50)))
+        self.assertEqual(stages[-1], 'fusion')
+        scoring = [r for r in reports if r.stage == 'scoring']
+        self.assertEqual(scoring[-1].fraction, 1.)
+        self.assertTrue(all(len(r.matches) <= 5 for r in scoring))
+
+    def test_query_progressive_all_results(self):
+        wrapper = SiftColornamesWrapper(self.sift_db, self.cname_db)
+        bow = self.sift_db[self.sift_db.key_order[7]]
+        self.patch_path_features(bow)
+        reports = []
+        with mock.patch('vsearch.database.PROVISIONAL_RESULTS', 10):
+            matches = wrapper.query_progressive('query.jpg', None, callback=reports.append, block_size=50)
+        expected = wrapper.fuse_distances(self.sift_db.distances(bow), self.cname_db.distances(bow))
+        self.assertEqual([k for k, _ in matches], [k for k, _ in expected])
+
+        # Provisional results are capped, only the final report has all matches
+        scoring = [r for r in reports if r.stage == 'scoring']
+        self.assertTrue(all(len(r.matches) == 10 for r in scoring))
+        self.assertEqual([k for k, _ in scoring[-1].matches], [k for k, _ in expected[:10]])
+        self.assertEqual(len(reports[-1].matches), test_db_items)
+
+    def test_query_progressive_cancel(self):
+        wrapper = SiftColornamesWrapper(self.sift_db, self.cname_db)
+        self.patch_path_features(self.sift_db[self.sift_db.key_order[0]])
+        token = CancellationToken()
+        reports = []
+
+        def callback(progress):
+            reports.append(progress)
+            if progress.stage == 'scoring':
+                token.cancel()
+
+        with self.assertRaises(QueryCancelled):
+            wrapper.query_progressive('query.jpg', None, token=token, callback=callback, block_size=50)
+        self.assertEqual([r.stage for r in reports].count('scoring'), 1)
+
+    def test_query_candidates(self):
+        wrapper = SiftColornamesWrapper(self.sift_db, self.cname_db)
+        bow = self.sift_db[self.sift_db.key_order[7]]
+        self.patch_path_features(bow)
+        candidates = self.sift_db.key_order[::3] + ['not_in_database']
+        all_matches = wrapper.query_path('query.jpg', None)
+        expected = [m for m in all_matches if m[0] in candidates][:5]
+        matches = wrapper.query_path('query.jpg', None, max_results=5, candidates=candidates)
+        self.assertEqual([k for k, _ in matches], [k for k, _ in expected])
+        nt.assert_almost_equal([d for _, d in matches], [d for _, d in expected])
+
+        progressive = wrapper.query_progressive('query.jpg', None, max_results=5, candidates=candidates, block_size=20)
+        self.assertEqual([k for k, _ in progressive], [k for k, _ in expected])
+        self.assertEqual(wrapper.query_path('query.jpg', None, candidates=[]), [])
+
+    def test_query_region(self):
+        locdb = DatabaseWithLocation(SiftColornamesWrapper(self.sift_db, self.cname_db))
+        bow = self.sift_db[self.sift_db.key_order[7]]
+        self.patch_path_features(bow)
+        inside = self.sift_db.key_order[:30]
+        for i, key in enumerate(self.sift_db.key_order):
+            locdb[key] = LatLng(58.59 + (0 if key in inside else 1), 16.18 + 0.0001 * i)
+
+        for region in (BoundingBox(58.5, 16.1, 58.7, 16.3), Circle(LatLng(58.59, 16.18), 2000)):
+            matches = locdb.query_path('query.jpg', None, region=region)
+            self.assertEqual(sorted(entry.key for entry, _ in matches), sorted(inside))
+
+    def test_rerank_by_location(self):
+        locdb = DatabaseWithLocation(SiftColornamesWrapper(self.sift_db, self.cname_db))
+        keys = self.sift_db.key_order[:4]
+        locdb[keys[0]] = LatLng(58.0, 16.0)
+        locdb[keys[1]] = LatLng(58.0001, 16.0)
+        locdb[keys[2]] = LatLng(58.0, 16.0001)
+        locdb[keys[3]] = LatLng(59.0, 17.0)
+        matches = [(locdb[keys[3]], 0.1), (locdb[keys[0]], 0.2), (locdb[keys[1]], 0.3), (locdb[keys[2]], 0.3)]
+
+        # The isolated best match loses to the three matches that agree on a location
+        reranked = locdb.rerank_by_location(matches, weight=0.5, scale=100.)
+        self.assertEqual(reranked[-1][0].key, keys[3])
+        self.assertEqual(locdb.rerank_by_location(matches, weight=0.), matches)
+
+        reranked = locdb.rerank_by_location(matches, weight=0.5, scale=100., center=LatLng(59.0, 17.0))
+        self.assertEqual(reranked[0][0].key, keys[3])
+        self.assertAlmostEqual(reranked[0][1], 0.05)
@@ -0,0 +1,79 @@
+import csv
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import numpy.testing as nt
+import h5py
+
+from vsearch.database import AnnDatabase
+from vsearch.duplicates import load_bow_matrix, tfidf_normalize, find_near_duplicates, pair_writer
+
+test_db = 'test_db.h5'
+test_db_items = 222
+
+
+class DuplicatesTests(unittest.TestCase):
+    def setUp(self):
+        self.keys, counts = load_bow_matrix(test_db)
+        self.matrix = tfidf_normalize(counts)
+
+    def test_load_bow_matrix(self):
+        self.assertEqual(len(self.keys), test_db_items)
+        self.assertEqual(self.matrix.shape[0], test_db_items)
+
+    def test_matches_database_distances(self):
+        db = AnnDatabase.from_file(test_db)
+        threshold = 0.5
+        pairs = [p for block in find_near_duplicates(self.keys, self.matrix, threshold, top_k=None,
+                                                     block_size=50, nproc=1)
+                 for p in block]
+
+        key = self.keys[17]
+        found = {k1 if k2 == key else k2: s for k1, k2, s in pairs if key in (k1, k2)}
+        expected = {k: 1 - d for k, d in db.query_bow(db[key]) if 1 - d >= threshold and not k == key}
+        self.assertEqual(set(found), set(expected))
+        for k in found:
+            self.assertAlmostEqual(found[k], expected[k])
+
+        # Each pair is reported once
+        index = {k: i for i, k in enumerate(self.keys)}
+        self.assertTrue(all(index[k1] < index[k2] for k1, k2, s in pairs))
+
+    def test_top_k_and_process_pool(self):
+        serial = [p for block in find_near_duplicates(self.keys, self.matrix, 0.3, top_k=3, nproc=1) for p in block]
+        parallel = [p for block in find_near_duplicates(self.keys, self.matrix, 0.3, top_k=3, nproc=2) for p in block]
+        self.assertEqual([p[:2] for p in serial], [p[:2] for p in parallel])
+
+        # Each pair is reported once, and includes the top 3 of every image among all other images
+        index = {k: i for i, k in enumerate(self.keys)}
+        found = [(k1, k2) for k1, k2, s in serial]
+        self.assertEqual(len(set(found)), len(found))
+        self.assertTrue(all(index[k1] < index[k2] for k1, k2 in found))
+        similarities = self.matrix.dot(self.matrix.T).toarray()
+        np.fill_diagonal(similarities, 0)
+        for i in (0, 100, len(self.keys) - 1):
+            best = [j for j in np.argsort(-similarities[i])[:3] if similarities[i, j] >= 0.3]
+            self.assertTrue(best)
+            for j in best:
+                self.assertIn((self.keys[min(i, j)], self.keys[max(i, j)]), found)
+
+    def test_writers(self):
+        pairs = [('a.jpg', 'b.jpg', 0.9), ('a.jpg', 'c, d.jpg', 0.85)]
+        with tempfile.TemporaryDirectory() as tempdir:
+            h5_path = os.path.join(tempdir, 'pairs.h5')
+            with pair_writer(h5_path) as writer:
+                writer.write(pairs[:1])
+                writer.write(pairs[1:])
+            with h5py.File(h5_path, 'r') as f:
+                self.assertEqual(len(f['key1']), 2)
+                nt.assert_almost_equal(f['similarity'][()], [0.9, 0.85])
+
+            csv_path = os.path.join(tempdir, 'pairs.csv')
+            with pair_writer(csv_path) as writer:
+                writer.write(pairs)
+            with open(csv_path, newline='') as f:
+                rows = list(csv.reader(f))
+            self.assertEqual([row[:2] for row in rows], [list(p[:2]) for p in pairs])
+            nt.assert_almost_equal([float(row[2]) for row in rows], [0.9, 0.85])
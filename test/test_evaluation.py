@@ -0,0 +1,54 @@
+import unittest
+
+from vsearch.database import AnnDatabase
+from vsearch.evaluation import (ground_truth_from_locations, average_precision, recall_at_k, with_n_trees, evaluate,
+                                document_frequency_report)
+from vsearch.geo import read_location_csv
+
+test_db = 'test_db.h5'
+test_geo = 'test_geo.csv'
+
+
+class EvaluationTests(unittest.TestCase):
+    def test_metrics(self):
+        relevant = {'a', 'c'}
+        self.assertAlmostEqual(average_precision(['a', 'b', 'c'], relevant), (1 + 2 / 3) / 2)
+        self.assertAlmostEqual(average_precision(['b', 'a'], relevant), 0.25)
+        self.assertEqual(average_precision(['a'], set()), 0.)
+        self.assertEqual(recall_at_k(['a', 'b', 'c'], relevant, 1), 0.5)
+        self.assertEqual(recall_at_k(['a', 'b', 'c'], relevant, 3), 1.)
+
+    def test_ground_truth_from_locations(self):
+        keys = ['a', 'b', 'c']
+        latlngs = [(58.0, 16.0), (58.0001, 16.0), (59.0, 16.0)]
+        ground_truth = ground_truth_from_locations(keys, latlngs, 50)
+        self.assertEqual(ground_truth, {'a': {'b'}, 'b': {'a'}})
+
+    def test_evaluate(self):
+        db = AnnDatabase.from_file(test_db)
+        keys, latlngs, _ = read_location_csv(test_geo)
+        ground_truth = ground_truth_from_locations(keys, latlngs, 25)
+        queries = [(key, db[key]) for key in sorted(ground_truth)[:20]]
+
+        metrics = evaluate(db, queries, ground_truth, ks=(1, 10), max_results=50, batch_size=8)
+        self.assertEqual(metrics['queries'], 20)
+        self.assertTrue(0 < metrics['recall@1'] <= metrics['recall@10'] <= 1)
+        self.assertTrue(0 < metrics['mAP'] <= 1)
+        self.assertLessEqual(metrics['latency_p50'], metrics['latency_p95'])
+        self.assertGreater(metrics['queries_per_second'], 0)
+
+        # The BoW vectors are kept, so BoW queries give the same results with any number of trees
+        other = with_n_trees(db, 2)
+        self.assertEqual(other.n_trees, 2)
+        self.assertEqual(evaluate(other, queries, ground_truth, ks=(1, 10), max_results=50)['mAP'], metrics['mAP'])
+
+    def test_document_frequency_report(self):
+        db = AnnDatabase.from_file(test_db)
+        report = document_frequency_report(db, fractions=(0.01, 0.1, 1.))
+        self.assertEqual(report['images'], len(db))
+        self.assertEqual(report['postings'], sum((db[key] > 0).sum() for key in db))
+        shares = [top['postings_share'] for top in report['top']]
+        self.assertTrue(0 < shares[0] < shares[1] < shares[2])
+        self.assertAlmostEqual(shares[2], 1.)
+        self.assertEqual(report['top'][1]['words'], round(0.1 * db.vocabulary_size))
+        self.assertLessEqual(report['df_percentiles'][50], report['df_percentiles'][100])
@@ -0,0 +1,111 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import numpy.testing as nt
+
+from vsearch.geo import SpatialIndex, haversine_distance, radius_bbox, read_location_csv, write_location_csv, \
+    read_location_sidecar, write_location_sidecar
+
+
+class GeoTests(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(1234)
+        self.latlngs = np.column_stack([rng.uniform(58.5, 58.7, size=500), rng.uniform(16.0, 16.4, size=500)])
+        self.index = SpatialIndex(cell_size=0.01)
+        for i, latlng in enumerate(self.latlngs):
+            self.index.insert(i, latlng)
+
+    def test_haversine_distance(self):
+        # One degree of latitude is about 111.2 km
+        self.assertAlmostEqual(haversine_distance(58., 16., 59., 16.), 111195, delta=1)
+        self.assertEqual(haversine_distance(58., 16., 58., 16.), 0)
+
+    def test_in_bbox(self):
+        south, west, north, east = 58.55, 16.1, 58.62, 16.25
+        expected = [i for i, (lat, lng) in enumerate(self.latlngs)
+                    if south <= lat <= north and west <= lng <= east]
+        self.assertEqual(sorted(self.index.in_bbox(south, west, north, east)), expected)
+
+    def test_in_bbox_whole_world(self):
+        self.assertEqual(sorted(self.index.in_bbox(-90, -180, 90, 180)), list(range(len(self.latlngs))))
+
+    def test_in_bbox_antimeridian(self):
+        index = SpatialIndex()
+        index.insert('east', (0., 179.5))
+        index.insert('west', (0., -179.5))
+        index.insert('zero', (0., 0.))
+        self.assertEqual(sorted(index.in_bbox(-1, 179, 1, -179)), ['east', 'west'])
+
+    def test_within_radius(self):
+        center = (58.6, 16.2)
+        radius = 2000
+        result = self.index.within_radius(center, radius)
+        distances = haversine_distance(center[0], center[1], self.latlngs[:, 0], self.latlngs[:, 1])
+        expected = np.flatnonzero(distances <= radius)
+        self.assertEqual(sorted(k for k, _ in result), list(expected))
+        result_distances = [d for _, d in result]
+        self.assertEqual(result_distances, sorted(result_distances))
+        nt.assert_almost_equal(result_distances, np.sort(distances[expected]))
+
+    def test_radius_bbox_contains_circle(self):
+        south, west, north, east = radius_bbox(58.6, 16.2, 1000)
+        for bearing in np.linspace(0, 2 * np.pi, 16):
+            lat = 58.6 + np.cos(bearing) * 0.0089
+            lng = 16.2 + np.sin(bearing) * 0.0089 / np.cos(np.radians(58.6))
+            self.assertTrue(south <= lat <= north and west <= lng <= east)
+
+    def test_insert_moves_and_remove(self):
+        self.index.insert(0, (10., 10.))
+        self.assertEqual(self.index.in_bbox(9.9, 9.9, 10.1, 10.1), [0])
+        self.assertNotIn(0, self.index.in_bbox(58.5, 16.0, 58.7, 16.4))
+        self.index.remove(0)
+        self.assertEqual(self.index.in_bbox(9.9, 9.9, 10.1, 10.1), [])
+        self.assertEqual(len(self.index), len(self.latlngs) - 1)
+        self.index.remove(0)  # Removing a missing key is a no-op
+
+
+class LocationFileTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'geo.csv')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_read_malformed_lines(self):
+        with open(self.path, 'w') as f:
+            f.write('a.jpg, 58.5, 16.1\nno commas here\nb.jpg, north, 16.2\n\nc.jpg,58.7,16.3\n')
+        keys, latlngs, malformed = read_location_csv(self.path)
+        self.assertEqual(keys, ['a.jpg', 'c.jpg'])
+        nt.assert_equal(latlngs, [[58.5, 16.1], [58.7, 16.3]])
+        self.assertEqual(malformed, [2, 3])
+
+    def test_read_test_file(self):
+        keys, latlngs, malformed = read_location_csv('test_geo.csv')
+        with open('test_geo.csv') as f:
+            lines = [line for line in f if line.strip()]
+        self.assertEqual(len(keys), len(lines))
+        self.assertEqual(malformed, [])
+        self.assertEqual(keys[0], '20161129_091016_000.jpg')
+        nt.assert_almost_equal(latlngs[0], [58.589694, 16.181161])
+
+    def test_csv_and_sidecar_roundtrip(self):
+        keys = ['a.jpg', 'b.jpg']
+        latlngs = np.array([[58.589694, 16.181161], [58.588838, 16.180756]])
+        write_location_csv(self.path, keys, latlngs)
+        self.assertIsNone(read_location_sidecar(self.path))
+        write_location_sidecar(self.path, keys, latlngs)
+        sidecar_keys, sidecar_latlngs = read_location_sidecar(self.path)
+        self.assertEqual(sidecar_keys, keys)
+        nt.assert_equal(sidecar_latlngs, latlngs)
+        csv_keys, csv_latlngs, _ = read_location_csv(self.path)
+        self.assertEqual(csv_keys, keys)
+        nt.assert_almost_equal(csv_latlngs, latlngs)
+
+        # A CSV file that is newer than the sidecar makes the sidecar stale
+        stat = os.stat(self.path)
+        os.utime(self.path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        self.assertIsNone(read_location_sidecar(self.path))
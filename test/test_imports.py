@@ -0,0 +1,47 @@
+import os
+import subprocess
+import sys
+import unittest
+
+from vsearch.lazy import lazy_import
+
+PACKAGE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HEAVY_MODULES = ('cv2', 'h5py', 'annoy', 'scipy', 'sklearn', 'tqdm')
+
+
+def run_python(code):
+    env = dict(os.environ, PYTHONPATH=PACKAGE_ROOT)
+    result = subprocess.run([sys.executable, '-c', code], env=env, stdout=subprocess.PIPE, check=True)
+    return result.stdout.decode().strip()
+
+
+class ImportTests(unittest.TestCase):
+    def test_lazy_import(self):
+        self.assertIs(lazy_import('os'), os)
+        module = lazy_import('json.decoder')
+        self.assertIsNotNone(module.JSONDecoder)
+        self.assertIs(module.JSONDecoder, sys.modules['json.decoder'].JSONDecoder)
+
+    def test_heavy_modules_are_deferred(self):
+        code = ("import sys, vsearch.database, vsearch.server, vsearch.sharded, vsearch.duplicates, "
+                "vsearch.evaluation, vsearch.benchmark, vsearch.instrumentation, vsearch.snapshot, "
+                "vsearch.ingest, vsearch.thumbnails\n"
+                "print(' '.join(m for m in {!r} if m in sys.modules))".format(HEAVY_MODULES))
+        self.assertEqual(run_python(code), '')
+
+    def test_server_imports(self):
+        # The server must not pull in any heavy or unrelated module
+        unrelated = HEAVY_MODULES + ('PyQt5', 'vsearch.thumbnails', 'vsearch.ingest', 'vsearch.evaluation',
+                                     'vsearch.benchmark', 'vsearch.duplicates')
+        code = ("import sys, numpy, vsearch.database, vsearch.server\n"
+                "print(' '.join(m for m in {!r} if m in sys.modules))".format(unrelated))
+        self.assertEqual(run_python(code), '')
+
+    def test_database_works_after_lazy_import(self):
+        code = ("import sys, numpy as np\n"
+                "from vsearch.database import AnnDatabase\n"
+                "db = AnnDatabase(np.eye(4, dtype='float32'))\n"
+                "db.add_images([('a', np.array([1., 0, 0, 0])), ('b', np.array([0., 1, 0, 0]))])\n"
+                "print(db.query_bow(np.array([1., 0, 0, 0]), 1)[0][0], 'annoy' in sys.modules)")
+        self.assertEqual(run_python(code), 'a True')
@@ -0,0 +1,70 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import cv2
+import h5py
+import numpy as np
+
+from vsearch.benchmark import synthetic_vocabulary, synthetic_image, generate_collection
+from vsearch.database import SiftColornamesWrapper, KEYPOINT_WORDS_GROUP, dataset_name
+from vsearch.ingest import IngestPipeline, DirectoryPoller, create_database_file
+
+
+class IngestTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.images = os.path.join(self.directory, 'images')
+        # Images with descriptor files, which are used instead of computing the features since they are newer
+        for feature, dim in (('sift', 128), ('colornames', 11)):
+            vocabulary = synthetic_vocabulary(20, dim)
+            generate_collection(os.path.join(self.images, 'day0'), vocabulary, 2, feature, descriptors_per_image=50)
+            generate_collection(os.path.join(self.images, 'day1'), vocabulary, 1, feature, descriptors_per_image=50,
+                                seed=1)
+            db_file = os.path.join(self.directory, feature + '.h5')
+            create_database_file(db_file, vocabulary)
+            setattr(self, feature + '_db', db_file)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_ingest(self):
+        wrapper = SiftColornamesWrapper.from_files(self.sift_db, self.colornames_db)
+        self.assertEqual(len(wrapper), 0)
+
+        poller = DirectoryPoller(self.images, min_age=0)
+        images = poller.scan()
+        keys = ['day0/image0000000.jpg', 'day0/image0000001.jpg', 'day1/image0000000.jpg']
+        self.assertEqual([image.key for image in images], keys)
+        self.assertEqual(poller.scan(), [])
+
+        broken = os.path.join(self.images, 'broken.jpg')
+        with open(broken, 'wb') as f:
+            f.write(b'not an image')
+
+        commits = []
+        with IngestPipeline(self.sift_db, self.colornames_db, n_extractors=1, batch_size=2,
+                            progress=commits.append) as pipeline:
+            for image in images + poller.scan():
+                pipeline.submit(image.path, image.key)
+            pipeline.flush()
+            self.assertEqual(pipeline.committed, 3)
+            self.assertEqual([path for path, _ in pipeline.failed], [broken])
+
+            self.assertEqual(wrapper.update_from_files(), keys)
+            self.assertEqual(wrapper.update_from_files(), [])
+            matches = wrapper.sift_db.query_bow(wrapper.sift_db[keys[1]], 1)
+            self.assertEqual(matches[0][0], keys[1])
+
+            # A changed image is ingested again
+            path = images[0].path
+            os.utime(path, ns=(0, os.stat(path).st_mtime_ns - 10**9))
+            self.assertEqual(poller.scan(), [images[0]])
+            pipeline.submit(path, keys[0])
+        self.assertEqual(pipeline.committed, 4)
+        self.assertEqual(sum(len(keys) for keys in commits), 4)
+
+        with h5py.File(self.sift_db, 'r') as f:
+            self.assertEqual(f[dataset_name(keys[0])][()].sum(), 50)
+            self.assertEqual(len(f[KEYPOINT_WORDS_GROUP][dataset_name(keys[2])]), 50)
@@ -0,0 +1,76 @@
+import io
+import json
+import unittest
+
+import numpy as np
+
+from vsearch import instrumentation
+from vsearch.database import AnnDatabase
+from vsearch.instrumentation import StatsSink, LoggingSink, JsonLinesSink
+
+test_db = 'test_db.h5'
+
+
+class InstrumentationTests(unittest.TestCase):
+    def test_disabled(self):
+        self.assertFalse(instrumentation.enabled())
+        with instrumentation.timer('a'):
+            pass
+        instrumentation.count('b')
+
+        @instrumentation.timed('c')
+        def f(x):
+            """Docstring"""
+            return 2 * x
+
+        self.assertEqual(f(2), 4)
+        self.assertEqual(f.__doc__, 'Docstring')
+
+    def test_stats_sink(self):
+        @instrumentation.timed('f')
+        def f():
+            instrumentation.count('calls')
+
+        with instrumentation.recording() as stats:
+            self.assertTrue(instrumentation.enabled())
+            for _ in range(3):
+                f()
+            instrumentation.count('items', 10)
+            with instrumentation.timer('block'):
+                pass
+        self.assertFalse(instrumentation.enabled())
+        f()
+
+        result = stats.stats()
+        self.assertEqual(result['timers']['f']['calls'], 3)
+        self.assertLessEqual(result['timers']['f']['min'], result['timers']['f']['max'])
+        self.assertEqual(result['timers']['block']['calls'], 1)
+        self.assertEqual(result['counters'], {'calls': 3, 'items': 10})
+        self.assertIn('block', stats.report())
+
+    def test_logging_and_json_sinks(self):
+        f = io.StringIO()
+        json_sink = JsonLinesSink(f)
+        with instrumentation.recording(json_sink), instrumentation.recording(LoggingSink()):
+            with self.assertLogs('vsearch.instrumentation', level='DEBUG') as logs:
+                instrumentation.count('items', 2)
+                with instrumentation.timer('block'):
+                    pass
+        json_sink.close()
+        records = [json.loads(line) for line in f.getvalue().splitlines()]
+        self.assertEqual([(r['kind'], r['name']) for r in records], [('counter', 'items'), ('timer', 'block')])
+        self.assertEqual(records[0]['value'], 2)
+        self.assertEqual(len(logs.output), 2)
+
+    def test_database_stages(self):
+        with instrumentation.recording() as stats:
+            db = AnnDatabase.from_file(test_db)
+            descriptors = np.random.RandomState(0).rand(20, db.annoy_index.f).astype('float32')
+            db.query_descriptors(descriptors, max_results=5)
+        result = stats.stats()
+        self.assertIn('database.load', result['timers'])
+        self.assertIn('database.quantize', result['timers'])
+        self.assertIn('database.score', result['timers'])
+        self.assertEqual(result['counters']['database.images_loaded'], len(db))
+        self.assertEqual(result['counters']['database.descriptors_quantized'], 20)
+        self.assertEqual(result['counters']['database.images_scored'], len(db))
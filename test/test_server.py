@@ -0,0 +1,158 @@
+import asyncio
+import concurrent.futures
+import http.client
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+
+import h5py
+import numpy as np
+
+from vsearch.database import SiftFeatureDatabase, ColornamesFeatureDatabase, SiftColornamesWrapper, \
+    DatabaseWithLocation, LatLng
+from vsearch.server import QueryServer
+
+test_db = 'test_db.h5'
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path):
+        super().__init__('localhost')
+        self.socket_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.socket_path)
+
+
+class ServerTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        sift_db = SiftFeatureDatabase.from_file(test_db)
+        with h5py.File(test_db, 'r') as f:
+            cname_db = ColornamesFeatureDatabase(f['vocabulary'][()])
+        for key in sift_db:
+            cname_db.add_image(key, sift_db[key])
+
+        # Path queries use the database vectors of the image with the same name
+        def bow_for_path(path, roi):
+            return sift_db[os.path.basename(path)]
+        for db in (sift_db, cname_db):
+            db.bow_for_path = bow_for_path
+
+        cls.sift_db = sift_db
+        cls.wrapper = SiftColornamesWrapper(sift_db, cname_db)
+        cls.database = DatabaseWithLocation(cls.wrapper)
+        cls.database[sift_db.key_order[0]] = LatLng(58.5, 16.1)
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.directory, 'vsearch.sock')
+        self.loop = asyncio.new_event_loop()
+        self.server = QueryServer(self.database, batch_window=0.05, max_batch=8)
+        self.loop.run_until_complete(self.server.start(port=0))
+        self.unix_server = QueryServer(self.database)
+        self.loop.run_until_complete(self.unix_server.start(unix_socket=self.socket_path))
+        self.thread = threading.Thread(target=self.loop.run_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        for server in (self.server, self.unix_server):
+            asyncio.run_coroutine_threadsafe(server.close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        shutil.rmtree(self.directory)
+
+    def request(self, method, path, body=None, connection=None):
+        if connection is None:
+            connection = http.client.HTTPConnection(*self.server.address[:2])
+        connection.request(method, path, body=None if body is None else json.dumps(body))
+        response = connection.getresponse()
+        return response.status, json.loads(response.read().decode('utf-8'))
+
+    def test_status(self):
+        status, response = self.request('GET', '/status')
+        self.assertEqual(status, 200)
+        self.assertEqual(response['images'], len(self.sift_db))
+
+    def test_refresh(self):
+        # The color names database has no file, so there is nothing to add
+        status, response = self.request('POST', '/refresh')
+        self.assertEqual(status, 200)
+        self.assertEqual(response, {'added': 0, 'images': len(self.sift_db)})
+
+    def test_query_path(self):
+        key = self.sift_db.key_order[3]
+        status, response = self.request('POST', '/query', {'path': '/images/' + key, 'max_results': 5})
+        self.assertEqual(status, 200)
+        expected = self.wrapper.query_path(key, None, max_results=5)
+        self.assertEqual([m['key'] for m in response['matches']], [k for k, _ in expected])
+        np.testing.assert_almost_equal([m['distance'] for m in response['matches']], [d for _, d in expected])
+
+    def test_query_location(self):
+        key = self.sift_db.key_order[0]
+        status, response = self.request('POST', '/query', {'path': key, 'max_results': 1})
+        self.assertEqual(response['matches'], [{'key': key, 'distance': response['matches'][0]['distance'],
+                                                'lat': 58.5, 'lng': 16.1}])
+
+    def test_query_descriptors(self):
+        bow = self.sift_db[self.sift_db.key_order[5]]
+        descriptors = np.vstack([np.tile(self.sift_db.annoy_index.get_item_vector(w), (int(n), 1))
+                                 for w, n in enumerate(bow) if n > 0])
+        request = {'sift': descriptors.tolist(), 'colornames': descriptors.tolist(), 'max_results': 3}
+        status, response = self.request('POST', '/query_descriptors', request)
+        self.assertEqual(status, 200)
+        expected = self.wrapper.query_descriptors_batch([descriptors], [descriptors], max_results=3)[0]
+        self.assertEqual([m['key'] for m in response['matches']], [k for k, _ in expected])
+
+    def test_concurrent_queries_are_batched(self):
+        keys = self.sift_db.key_order[:8]
+
+        def query(i):
+            return self.request('POST', '/query', {'path': keys[i], 'max_results': i + 1})
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(keys)) as executor:
+            results = list(executor.map(query, range(len(keys))))
+
+        for i, (status, response) in enumerate(results):
+            self.assertEqual(status, 200)
+            self.assertEqual(len(response['matches']), i + 1)
+            self.assertEqual(response['matches'][0]['key'], keys[i])
+        self.assertLess(self.server.batcher.batches_run, len(keys))
+
+    def test_keep_alive(self):
+        connection = http.client.HTTPConnection(*self.server.address[:2])
+        for i in range(3):
+            status, response = self.request('GET', '/status', connection=connection)
+            self.assertEqual(status, 200)
+        connection.close()
+
+    def test_unix_socket(self):
+        status, response = self.request('GET', '/status', connection=UnixHTTPConnection(self.socket_path))
+        self.assertEqual(status, 200)
+        self.assertEqual(response['images'], len(self.sift_db))
+
+    def test_errors(self):
+        self.assertEqual(self.request('GET', '/nothing')[0], 404)
+        self.assertEqual(self.request('GET', '/query')[0], 405)
+        self.assertEqual(self.request('POST', '/query', {'roi': [0, 0, 10, 10]})[0], 400)
+        self.assertEqual(self.request('POST', '/query', {'path': 'x.jpg', 'max_results': 0})[0], 400)
+        self.assertEqual(self.request('POST', '/query', {'path': 'x.jpg', 'max_results': True})[0], 400)
+        for roi in (5, 'abcd', [0, 0, 10], [0, 0, 10, 'a'], [0, 0, 10, None]):
+            self.assertEqual(self.request('POST', '/query', {'path': 'x.jpg', 'roi': roi})[0], 400)
+        self.assertEqual(self.request('POST', '/query', ['x.jpg'])[0], 400)
+
+        for length in ('abc', '-1'):
+            connection = http.client.HTTPConnection(*self.server.address[:2])
+            connection.putrequest('POST', '/query')
+            connection.putheader('Content-Length', length)
+            connection.endheaders()
+            self.assertEqual(connection.getresponse().status, 400)
+        status, response = self.request('POST', '/query', {'path': 'not_in_database.jpg'})
+        self.assertEqual(status, 400)
+        self.assertIn('error', response)
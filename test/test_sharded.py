@@ -0,0 +1,66 @@
+import unittest
+
+import h5py
+import numpy as np
+import numpy.testing as nt
+
+from vsearch.database import AnnDatabase, ColornamesFeatureDatabase, SiftFeatureDatabase, SiftColornamesWrapper, \
+    DatabaseError
+from vsearch.sharded import ShardedDatabase
+
+test_db = 'test_db.h5'
+
+
+class ShardedDatabaseTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.db = AnnDatabase.from_file(test_db)
+        cls.sharded = ShardedDatabase(cls.db, n_shards=3)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.sharded.close()
+
+    def test_shards_cover_database(self):
+        self.assertEqual(self.sharded.n_shards, 3)
+        self.assertEqual(self.sharded.shard_bounds[0][0], 0)
+        self.assertEqual(self.sharded.shard_bounds[-1][1], len(self.db))
+        self.assertEqual(list(self.sharded), self.db.key_order)
+
+    def test_distances_match_unsharded(self):
+        bows = [self.db[key] for key in self.db.key_order[:5]]
+        nt.assert_almost_equal(self.sharded.distances_batch(bows), self.db.distances_batch(bows))
+        nt.assert_almost_equal(self.sharded.distances(bows[0]), self.db.distances(bows[0]))
+        rows = np.array([3, 10, 200])
+        nt.assert_almost_equal(self.sharded.distances(bows[0], rows), self.db.distances(bows[0], rows))
+
+    def test_top_k_matches_unsharded(self):
+        bows = [self.db[key] for key in self.db.key_order[10:14]]
+        for k in (1, 7, None):
+            for (indices, distances), (expected_indices, expected_distances) in zip(
+                    self.sharded.top_k_batch(bows, k), self.db.top_k_batch(bows, k)):
+                nt.assert_almost_equal(distances, expected_distances)
+                self.assertEqual(indices[0], expected_indices[0])
+
+        bow = bows[0]
+        self.assertEqual([k for k, _ in self.sharded.query_bow(bow, 5)], [k for k, _ in self.db.query_bow(bow, 5)])
+
+    def test_in_wrapper(self):
+        sift_db = SiftFeatureDatabase.from_file(test_db)
+        with h5py.File(test_db, 'r') as f:
+            cname_db = ColornamesFeatureDatabase(f['vocabulary'][()])
+        for key in reversed(list(sift_db)):
+            cname_db.add_image(key, sift_db[key])
+        bow = sift_db[sift_db.key_order[4]]
+        expected = SiftColornamesWrapper(sift_db, cname_db).fuse_distances(sift_db.distances(bow),
+                                                                            cname_db.distances(bow), 5)
+        with ShardedDatabase(sift_db, 2) as sharded_sift, ShardedDatabase(cname_db, 2) as sharded_cname:
+            wrapper = SiftColornamesWrapper(sharded_sift, sharded_cname)
+            matches = wrapper.fuse_distances(sharded_sift.distances(bow), sharded_cname.distances(bow), 5)
+        self.assertEqual([k for k, _ in matches], [k for k, _ in expected])
+
+    def test_closed(self):
+        sharded = ShardedDatabase(self.db, n_shards=1)
+        sharded.close()
+        with self.assertRaises(DatabaseError):
+            sharded.query_bow(self.db[self.db.key_order[0]])
@@ -0,0 +1,58 @@
+import multiprocessing
+import unittest
+
+import numpy as np
+import numpy.testing as nt
+
+from vsearch.shared import SharedArrays, attach_arrays, share_array, attach_array
+from vsearch.colornames import colornames_table, use_colornames_table, colornames_image
+import vsearch.colornames
+
+
+def _sum_worker(specs):
+    arrays = attach_arrays(specs)
+    return float(arrays['a'].sum()), arrays['b'].shape
+
+
+class SharedArraysTests(unittest.TestCase):
+    def test_share_array(self):
+        array = np.arange(12, dtype='float32').reshape(3, 4)
+        shm, spec = share_array(array)
+        try:
+            other, shared = attach_array(spec)
+            nt.assert_equal(shared, array)
+            del shared
+            other.close()
+        finally:
+            shm.close()
+            shm.unlink()
+
+    def test_workers_attach(self):
+        a = np.arange(100, dtype='float64')
+        b = np.zeros((3, 5), dtype='int32')
+        with SharedArrays({'a': a, 'b': b}) as shared:
+            ctx = multiprocessing.get_context('spawn')
+            with ctx.Pool(2) as pool:
+                results = pool.map(_sum_worker, [shared.specs] * 4)
+        self.assertEqual(results, [(a.sum(), (3, 5))] * 4)
+
+    def test_attached_arrays_are_read_only(self):
+        with SharedArrays({'a': np.zeros(4)}) as shared:
+            array = attach_arrays(shared.specs)['a']
+            with self.assertRaises(ValueError):
+                array[0] = 1
+
+
+class ColornamesTableTests(unittest.TestCase):
+    def test_shared_colornames_table(self):
+        table = colornames_table()
+        self.assertEqual(table.shape, (32768, 11))
+        self.assertIs(vsearch.colornames.COLORNAMES_TABLE, table)
+        image = np.random.randint(0, 256, size=(8, 8, 3))
+        expected = colornames_image(image)
+        with SharedArrays({'colornames': table}) as shared:
+            try:
+                use_colornames_table(attach_arrays(shared.specs)['colornames'])
+                nt.assert_equal(colornames_image(image), expected)
+            finally:
+                use_colornames_table(table)
@@ -0,0 +1,52 @@
+import unittest
+
+import cv2
+import numpy as np
+
+from vsearch.benchmark import synthetic_image
+from vsearch.sift import calculate_sift, select_keypoints, KeypointPolicy, DEFAULT_KEYPOINT_POLICY, \
+    keypoint_policy_attrs, keypoint_policy_from_attrs
+
+
+class KeypointPolicyTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.image = synthetic_image((640, 480), np.random.RandomState(0))
+
+    def test_select_keypoints(self):
+        # Many strong keypoints in the top left corner, and a few weak ones in the bottom right corner
+        strong = [cv2.KeyPoint(10. + i, 10. + i, 5., 0., 1. + i, 0) for i in range(50)]
+        weak = [cv2.KeyPoint(300. + i, 300. + i, 5., 0., 0.1, 0) for i in range(5)]
+        keypoints = strong + weak
+        policy = DEFAULT_KEYPOINT_POLICY._replace(max_keypoints=20, grid=2)
+        selected = select_keypoints(keypoints, (400, 400), policy)
+        self.assertEqual(len(selected), 20)
+        self.assertEqual(sum(kp in weak for kp in selected), 5)
+        self.assertIn(strong[-1], selected)
+        self.assertNotIn(strong[0], selected)
+
+        duplicates = [cv2.KeyPoint(10., 10., 5., angle, response, 0) for angle, response in [(0., 1.), (90., 2.)]]
+        selected = select_keypoints(duplicates + weak, (400, 400), DEFAULT_KEYPOINT_POLICY._replace(min_distance=1.))
+        self.assertEqual(selected, [duplicates[1]] + weak)
+
+    def test_calculate_sift(self):
+        descriptors, keypoints = calculate_sift(self.image)
+        policy = KeypointPolicy(max_side=320, max_keypoints=100, grid=4, min_distance=2.)
+        limited_descriptors, limited_keypoints = calculate_sift(self.image, policy=policy)
+        self.assertGreater(len(keypoints), 100)
+        self.assertEqual(limited_descriptors.shape, (100, 128))
+        # Keypoints are in the coordinates of the original image
+        points = np.array([kp.pt for kp in limited_keypoints])
+        self.assertGreater(points[:, 0].max(), 320)
+        self.assertTrue(np.all(points < [640, 480]))
+
+        roi = (0, 0, 320, 240)
+        roi_descriptors, roi_keypoints = calculate_sift(self.image, roi, policy=policy)
+        inside = [kp.pt for kp in limited_keypoints if kp.pt[0] <= 320 and kp.pt[1] <= 240]
+        self.assertEqual([kp.pt for kp in roi_keypoints], inside)
+        self.assertEqual(len(roi_descriptors), len(inside))
+
+    def test_attrs(self):
+        policy = KeypointPolicy(max_side=1024, max_keypoints=2000, grid=8, min_distance=1.5)
+        self.assertEqual(keypoint_policy_from_attrs(keypoint_policy_attrs(policy)), policy)
+        self.assertIsNone(keypoint_policy_from_attrs({}))
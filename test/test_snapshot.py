@@ -0,0 +1,111 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import h5py
+import numpy as np
+import numpy.testing as nt
+
+from vsearch.database import ColornamesFeatureDatabase, SiftFeatureDatabase, SiftColornamesWrapper, \
+    DatabaseWithLocation, DatabaseError, KEYPOINT_WORDS_GROUP, KEYPOINT_POINTS_GROUP
+from vsearch.snapshot import write_snapshot, open_snapshot, verify_snapshot, Snapshot, SnapshotError
+
+test_db = 'test_db.h5'
+test_geo = 'test_geo.csv'
+
+
+class SnapshotTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        # Copy of the test database with stored keypoint words
+        cls.db_file = os.path.join(cls.directory, 'db.h5')
+        shutil.copy(test_db, cls.db_file)
+        rng = np.random.RandomState(0)
+        with h5py.File(cls.db_file, 'a') as f:
+            keys = [key for key in f if key != 'vocabulary']
+            for key in keys:
+                f[KEYPOINT_WORDS_GROUP + '/' + key] = rng.randint(0, len(f['vocabulary']), 10)
+                f[KEYPOINT_POINTS_GROUP + '/' + key] = rng.rand(10, 2) * 100
+
+        sift_db = SiftFeatureDatabase.from_file(cls.db_file)
+        with h5py.File(test_db, 'r') as f:
+            cname_db = ColornamesFeatureDatabase(f['vocabulary'][()])
+        cname_db.add_images((key, sift_db[key]) for key in reversed(list(sift_db)))
+        cls.database = DatabaseWithLocation(SiftColornamesWrapper(sift_db, cname_db))
+        cls.database.load_locations(test_geo, sidecar=False)
+
+        cls.path = os.path.join(cls.directory, 'db.snapshot')
+        cls.cache_directory = os.path.join(cls.directory, 'cache')
+        write_snapshot(cls.path, cls.database)
+        cls.snapshot_db = open_snapshot(cls.path, cls.cache_directory)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    def test_queries_match(self):
+        sift_db = self.database.visualdb.sift_db
+        for key in sift_db.key_order[:20:4]:
+            bow = sift_db[key]
+            nt.assert_almost_equal(self.snapshot_db.visualdb.sift_db[key], bow)
+            self.assertEqual(self.snapshot_db.visualdb.sift_db.query_bow(bow, 5), sift_db.query_bow(bow, 5))
+            self.assertEqual(self.snapshot_db.visualdb.sift_db.query_key(key, None, 5),
+                             sift_db.query_key(key, None, 5))
+
+    def test_contents(self):
+        self.assertEqual(list(self.snapshot_db), list(self.database))
+        expected_keys, expected_latlngs = self.database.location_arrays()
+        keys, latlngs = self.snapshot_db.location_arrays()
+        self.assertEqual(sorted(keys), sorted(expected_keys))
+        self.assertFalse(self.snapshot_db.has_unsaved_locations)
+
+        key = expected_keys[0]
+        features = self.snapshot_db.visualdb.sift_db.stored_features(key)
+        nt.assert_equal(features.words, self.database.visualdb.sift_db.stored_features(key).words)
+
+    def test_read_only(self):
+        sift_db = self.snapshot_db.visualdb.sift_db
+        with self.assertRaises(DatabaseError):
+            sift_db.add_image('new', np.ones(sift_db.vocabulary_size))
+
+    def test_stop_words(self):
+        snapshot_db = open_snapshot(self.path, self.cache_directory).visualdb.sift_db
+        scoring_matrix = snapshot_db._scoring_matrix
+        snapshot_db.set_stop_words(None, None)
+        self.assertIs(snapshot_db._scoring_matrix, scoring_matrix)
+
+        sift_db = SiftFeatureDatabase.from_file(self.db_file)
+        stop_words = sift_db.set_stop_words(fraction=0.05)
+        self.assertGreater(len(stop_words), 0)
+        nt.assert_equal(snapshot_db.set_stop_words(fraction=0.05), stop_words)
+        for key in sift_db.key_order[:20:4]:
+            bow = sift_db[key]
+            nt.assert_almost_equal(snapshot_db.distances(bow), sift_db.distances(bow))
+
+    def test_annoy_index_cache(self):
+        path = os.path.join(self.directory, 'rewritten.snapshot')
+        cache_directory = os.path.join(self.directory, 'rewritten_cache')
+        for mtime in (1, 2):
+            write_snapshot(path, self.database)
+            os.utime(path, ns=(mtime * 10**9, mtime * 10**9))
+            open_snapshot(path, cache_directory)
+        # One copy per database, copies of the earlier version are removed
+        self.assertEqual(len(os.listdir(cache_directory)), 2)
+
+    def test_verify(self):
+        self.assertEqual(verify_snapshot(self.path, self.database, cache_directory=self.cache_directory), [])
+
+        corrupt = os.path.join(self.directory, 'corrupt.snapshot')
+        shutil.copy(self.path, corrupt)
+        with open(corrupt, 'r+b') as f:
+            f.seek(Snapshot(self.path).entries['sift/idf']['offset'])
+            f.write(b'\xff' * 10)
+        self.assertEqual(len(verify_snapshot(corrupt, cache_directory=self.cache_directory)), 1)
+
+        with open(corrupt, 'r+b') as f:
+            f.truncate(os.path.getsize(corrupt) // 2)
+        self.assertIn('truncated', verify_snapshot(corrupt, cache_directory=self.cache_directory)[0])
+        with self.assertRaises(SnapshotError):
+            open_snapshot(test_db, self.cache_directory)
@@ -0,0 +1,67 @@
+import os
+import tempfile
+import unittest
+
+import cv2
+import numpy as np
+
+from vsearch.thumbnails import decode_reduced, PreviewCache
+
+
+class PreviewTests(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.image_path = os.path.join(self.tempdir.name, 'image.png')
+        image = np.zeros((600, 800, 3), dtype='uint8')
+        image[:, :, 2] = 255  # Red in BGR
+        cv2.imwrite(self.image_path, image)
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_decode_reduced(self):
+        preview = decode_reduced(self.image_path, 200)
+        self.assertEqual(preview.shape, (150, 200, 3))
+        self.assertEqual(tuple(preview[0, 0]), (255, 0, 0))  # RGB
+
+        full = decode_reduced(self.image_path, 2000)
+        self.assertEqual(full.shape, (600, 800, 3))
+
+    def test_missing_image(self):
+        with self.assertRaises(IOError):
+            decode_reduced(os.path.join(self.tempdir.name, 'missing.jpg'), 100)
+
+    def test_disk_cache(self):
+        cache_dir = os.path.join(self.tempdir.name, 'cache')
+        cache = PreviewCache(max_side=100, directory=cache_dir)
+        self.assertIsNone(cache.cached(self.image_path))
+        preview = cache.get(self.image_path)
+        self.assertIs(cache.cached(self.image_path), preview)
+        self.assertEqual(len(os.listdir(cache_dir)), 1)
+
+        other = PreviewCache(max_side=100, directory=cache_dir)
+        np.testing.assert_equal(other.get(self.image_path), preview)
+        self.assertEqual(len(os.listdir(cache_dir)), 1)
+
+    def test_disk_cache_budget(self):
+        cache_dir = os.path.join(self.tempdir.name, 'cache')
+        paths = []
+        for i in range(3):
+            path = os.path.join(self.tempdir.name, 'image{:d}.png'.format(i))
+            cv2.imwrite(path, np.random.RandomState(i).randint(0, 255, (100, 100, 3), dtype='uint8'))
+            paths.append(path)
+
+        cache = PreviewCache(max_side=100, memory_bytes=0, directory=cache_dir)
+        cache.get(paths[0])
+        cache.get(paths[1])
+        size = sum(os.path.getsize(os.path.join(cache_dir, name)) for name in os.listdir(cache_dir))
+        # The first preview is the oldest file, until reading it marks it as recently used
+        for i, ns in ((0, 10**9), (1, 2 * 10**9)):
+            os.utime(cache._disk_path(cache._key(paths[i])), ns=(ns, ns))
+        cache.get(paths[0])
+
+        budget = PreviewCache(max_side=100, memory_bytes=0, directory=cache_dir, disk_bytes=size)
+        budget.get(paths[2])
+        self.assertEqual(len(os.listdir(cache_dir)), 2)
+        self.assertTrue(os.path.exists(budget._disk_path(budget._key(paths[0]))))
+        self.assertFalse(os.path.exists(budget._disk_path(budget._key(paths[1]))))
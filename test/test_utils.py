@@ -2,7 +2,12 @@ import unittest
 import tempfile
 import os
 
-from vsearch.utils import image_for_descriptor_file
+import cv2
+import numpy as np
+
+from vsearch.database import dataset_name, key_for_dataset
+from vsearch.utils import image_for_descriptor_file, iter_images, find_images, save_keypoints_and_descriptors, \
+    load_descriptors_and_points, load_descriptors_and_points_in_roi, roi_mask
 
 class UtilTests(unittest.TestCase):
     def test_image_for_descriptor(self):
@@ -22,3 +27,49 @@ class UtilTests(unittest.TestCase):
             # Multiple candidates
             with self.assertRaises(ValueError):
                 image_file = image_for_descriptor_file(os.path.join(tempdir, 'image_3.sift.h5'))
+
+    def test_iter_images(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            for fname in ['b.JPG', 'b.sift.h5', 'a.png', 'notes.txt', '2016/11/c.jpg', '2016/11/c.cname.h5',
+                          '2016/thumbs/d.jpg', '2017/e.tif']:
+                os.makedirs(os.path.dirname(os.path.join(tempdir, fname)), exist_ok=True)
+                open(os.path.join(tempdir, fname), 'a').close()
+
+            images = list(iter_images(tempdir))
+            self.assertEqual([image.key for image in images],
+                             ['a.png', 'b.JPG', '2016/11/c.jpg', '2016/thumbs/d.jpg', '2017/e.tif'])
+            self.assertEqual(images[1].path, os.path.join(tempdir, 'b.JPG'))
+            self.assertEqual(images[1].feature_files, {'sift': os.path.join(tempdir, 'b.sift.h5')})
+            self.assertEqual(images[2].feature_files, {'colornames': os.path.join(tempdir, '2016', '11', 'c.cname.h5')})
+
+            keys = [image.key for image in iter_images(tempdir, include=['2016/*'], exclude=['thumbs'])]
+            self.assertEqual(keys, ['2016/11/c.jpg'])
+            self.assertEqual(find_images(tempdir), [os.path.join(tempdir, name) for name in ('a.png', 'b.JPG')])
+
+    def test_dataset_names(self):
+        for key in ['image.jpg', '2016/11/image.jpg', 'a%2Fb/100%.jpg']:
+            self.assertNotIn('/', dataset_name(key))
+            self.assertEqual(key_for_dataset(dataset_name(key)), key)
+        self.assertEqual(dataset_name('image.jpg'), 'image.jpg')
+
+    def test_spatial_descriptor_file(self):
+        rng = np.random.RandomState(0)
+        points = rng.rand(200, 2) * [640, 480]
+        keypoints = [cv2.KeyPoint(float(x), float(y), 1.) for x, y in points]
+        descriptors = rng.rand(200, 128).astype('float32')
+        roi = (100, 50, 150, 100)
+        with tempfile.TemporaryDirectory() as tempdir:
+            path = os.path.join(tempdir, 'image.sift.h5')
+            save_keypoints_and_descriptors(path, keypoints, descriptors, grid=8, image_size=(640, 480))
+            all_descriptors, all_points = load_descriptors_and_points(path)
+            self.assertEqual(sorted(map(tuple, all_points)), sorted(map(tuple, points.astype('float32'))))
+
+            roi_descriptors, roi_points, complete = load_descriptors_and_points_in_roi(path, roi)
+            self.assertFalse(complete)
+            self.assertLess(len(roi_points), 100)
+            inside = roi_mask(roi_points, roi)
+            expected = roi_mask(points, roi)
+            self.assertEqual(inside.sum(), expected.sum())
+            self.assertEqual(sorted(map(tuple, roi_descriptors[inside])), sorted(map(tuple, descriptors[expected])))
+
+            self.assertTrue(load_descriptors_and_points_in_roi(path, None)[2])
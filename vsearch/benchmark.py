@@ -0,0 +1,453 @@
+# Copyright 2017 Hannes Ovrén
+#
+# This file is part of vsearch.
+#
+# vsearch is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# vsearch is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with vsearch.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmarks on synthetic image collections
+
+Synthetic collections have the same file formats as real ones, but are generated from a random vocabulary.
+Visual words are drawn from a Zipf distribution, such that some words are much more common than others,
+like in real collections. Descriptors are vocabulary words plus Gaussian noise.
+
+:func:`run_suite` times the stages of building and querying a database, and reports the peak memory of each stage.
+The results are plain dicts, such that they can be written to JSON files and compared between versions with
+:func:`compare_results`.
+"""
+
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+from .database import AnnDatabase, KEYPOINT_WORDS_GROUP, KEYPOINT_POINTS_GROUP, database_keys, dataset_name
+from .colornames import calculate_colornames
+from .lazy import lazy_import
+from .utils import FEATURE_TYPES, save_keypoints_and_descriptors, save_vocabulary
+
+cv2 = lazy_import('cv2')
+h5py = lazy_import('h5py')
+
+STAGES = ('index', 'build', 'load', 'bag', 'query_descriptors', 'query_bow', 'colornames')
+
+RESULTS_FORMAT_VERSION = 1
+
+
+def synthetic_vocabulary(size, dim, seed=0):
+    """Random KxD vocabulary of non-negative float32 words, like SIFT and colornames descriptors"""
+    rng = np.random.RandomState(seed)
+    return rng.rand(size, dim).astype('float32')
+
+
+def zipf_word_sampler(vocabulary_size, exponent=1.0):
+    """Function `sample(n, rng)` that draws n word indices with probability proportional to 1 / (rank + 1)^exponent
+
+    The ranks are a fixed random permutation of the words, such that common words are spread over the vocabulary.
+    """
+    weights = 1. / np.arange(1, vocabulary_size + 1) ** exponent
+    cdf = np.cumsum(weights)
+    cdf /= cdf[-1]
+    ranked_words = np.random.RandomState(vocabulary_size).permutation(vocabulary_size)
+
+    def sample(n, rng):
+        ranks = np.minimum(np.searchsorted(cdf, rng.rand(n)), vocabulary_size - 1)
+        return ranked_words[ranks]
+
+    return sample
+
+
+def synthetic_descriptors(vocabulary, words, rng, noise=0.05):
+    """Descriptors close to the given vocabulary words"""
+    descriptors = vocabulary[words] + noise * rng.randn(len(words), vocabulary.shape[1]).astype('float32')
+    return np.clip(descriptors, 0, None)
+
+
+def synthetic_keypoints(n, image_size, rng):
+    """List of n random cv2.KeyPoint objects inside an image of size (width, height)"""
+    width, height = image_size
+    points = rng.rand(n, 2) * [width - 1, height - 1]
+    sizes = rng.uniform(2, 20, size=n)
+    angles = rng.uniform(0, 360, size=n)
+    return [cv2.KeyPoint(float(x), float(y), float(size), float(angle), 0.01, 0)
+            for (x, y), size, angle in zip(points, sizes, angles)]
+
+
+def synthetic_image(image_size, rng):
+    """Random smooth RGB uint8 image of size (width, height)"""
+    width, height = image_size
+    small = rng.randint(0, 256, size=(max(1, height // 16), max(1, width // 16), 3)).astype('uint8')
+    return cv2.resize(small, (width, height), interpolation=cv2.INTER_LINEAR)
+
+
+def generate_collection(directory, vocabulary, n_images, feature_type='sift', descriptors_per_image=500,
+                        zipf_exponent=1.0, noise=0.05, image_size=(640, 480), write_images=True, seed=0, progress=None):
+    """Write a synthetic collection of descriptor files
+
+    Parameters
+    -------------
+    directory : str
+        Output directory. The descriptor files are named `image0000000` + feature extension, and the images
+        `image0000000.jpg`.
+    vocabulary : array_like
+        KxD vocabulary, where D must match the feature type
+    n_images : int
+        Number of descriptor files
+    feature_type : str
+        Key of :data:`vsearch.utils.FEATURE_TYPES`
+    descriptors_per_image : int
+        Number of descriptors per file
+    zipf_exponent : float
+        Exponent of the word distribution
+    noise : float
+        Standard deviation of the descriptor noise
+    image_size : tuple
+        (width, height) of the area that keypoints are placed in
+    write_images : bool
+        Also write a small image for each descriptor file, unless it exists, such that the collection is found by
+        :func:`vsearch.utils.iter_images`. The images are written before the descriptor files, so the descriptor
+        files are never older than their image.
+    seed : int
+        Random seed
+    progress : callable
+        Optional function called with the number of written files after each file
+
+    Returns
+    -------------
+    List of descriptor file paths
+    """
+    feat_type = FEATURE_TYPES[feature_type]
+    if vocabulary.shape[1] != feat_type.featsize:
+        raise ValueError("Vocabulary dimension {:d} does not match {} ({:d})".format(
+            vocabulary.shape[1], feat_type.name, feat_type.featsize))
+    os.makedirs(directory, exist_ok=True)
+    rng = np.random.RandomState(seed)
+    image_rng = np.random.RandomState(seed + 1)
+    sample = zipf_word_sampler(len(vocabulary), zipf_exponent)
+    paths = []
+    for i in range(n_images):
+        image_path = os.path.join(directory, 'image{:07d}.jpg'.format(i))
+        if write_images and not os.path.exists(image_path):
+            small_size = (max(1, image_size[0] // 8), max(1, image_size[1] // 8))
+            cv2.imwrite(image_path, synthetic_image(small_size, image_rng))
+        descriptors = synthetic_descriptors(vocabulary, sample(descriptors_per_image, rng), rng, noise)
+        keypoints = synthetic_keypoints(descriptors_per_image, image_size, rng)
+        path = os.path.join(directory, 'image{:07d}{}'.format(i, feat_type.extension))
+        save_keypoints_and_descriptors(path, keypoints, descriptors)
+        paths.append(path)
+        if progress is not None:
+            progress(i + 1)
+    return paths
+
+
+def generate_bow_database(path, vocabulary, n_images, words_per_image=500, zipf_exponent=1.0,
+                          keypoint_words=False, image_size=(640, 480), seed=0, progress=None):
+    """Write a synthetic Bag of Words database file, in the same format as the `vsearch_database` script
+
+    The database stores a dense vector of K word counts per image, so the file size grows as N x K.
+
+    Parameters
+    -------------
+    path : str
+        Output database file
+    vocabulary : array_like
+        KxD vocabulary
+    n_images : int
+        Number of database images
+    words_per_image : int
+        Number of visual words (keypoints) per image
+    zipf_exponent : float
+        Exponent of the word distribution
+    keypoint_words : bool
+        Also store the word and location of each keypoint
+    image_size : tuple
+        (width, height) of the area that keypoints are placed in
+    seed : int
+        Random seed
+    progress : callable
+        Optional function called with the number of written images after each image
+    """
+    rng = np.random.RandomState(seed)
+    sample = zipf_word_sampler(len(vocabulary), zipf_exponent)
+    with h5py.File(path, 'w') as f:
+        words_group = f.create_group(KEYPOINT_WORDS_GROUP) if keypoint_words else None
+        points_group = f.create_group(KEYPOINT_POINTS_GROUP) if keypoint_words else None
+        for i in range(n_images):
+            key = 'image{:07d}'.format(i)
+            words = sample(words_per_image, rng)
+            f[key] = np.bincount(words, minlength=len(vocabulary))
+            if keypoint_words:
+                words_group[key] = words.astype('int32')
+                points_group[key] = (rng.rand(words_per_image, 2) * image_size).astype('float32')
+            if progress is not None:
+                progress(i + 1)
+        f['vocabulary'] = vocabulary
+
+
+def _max_rss_bytes(who=resource.RUSAGE_SELF):
+    # ru_maxrss is in kilobytes on Linux, and bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(who).ru_maxrss * scale
+
+
+def measure(func, repeats=3, memory=True):
+    """Time a function, and measure its peak memory use
+
+    Parameters
+    -------------
+    func : callable
+        Function without arguments
+    repeats : int
+        Number of timed calls
+    memory : bool
+        Make an extra call to measure the peak memory allocated by Python and NumPy, using tracemalloc.
+        Memory allocated by OpenCV, annoy and HDF5 is not seen by tracemalloc, but is included in the process
+        peak resident set size which is also reported.
+
+    Returns
+    -------------
+    dict with keys 'seconds' (best time), 'mean_seconds', 'peak_bytes' (None if not measured) and 'max_rss_bytes'
+    """
+    times = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t0)
+
+    peak = None
+    if memory:
+        tracemalloc.start()
+        try:
+            func()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+    return {'seconds': min(times), 'mean_seconds': float(np.mean(times)), 'peak_bytes': peak,
+            'max_rss_bytes': _max_rss_bytes()}
+
+
+def _find_script(name):
+    # Scripts are installed on the PATH, or found next to the package in a source checkout
+    path = shutil.which(name)
+    if path is None:
+        path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'scripts', name)
+    return path if os.path.exists(path) else None
+
+
+def measure_build(collection_directory, vocabulary_file, out_file, feature_type='sift', nproc=None):
+    """Time the `vsearch_database` script on a collection of descriptor files
+
+    Returns
+    -------------
+    dict like :func:`measure`, where 'max_rss_bytes' is the peak resident set size of the largest child process,
+    or None if the script was not found
+    """
+    script = _find_script('vsearch_database')
+    if script is None:
+        return None
+    command = [sys.executable, script, collection_directory, vocabulary_file, out_file, feature_type, '--overwrite']
+    if nproc is not None:
+        command += ['--nproc', str(nproc)]
+    env = dict(os.environ)
+    package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = os.pathsep.join(p for p in (package_root, env.get('PYTHONPATH')) if p)
+    t0 = time.perf_counter()
+    subprocess.run(command, check=True, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    seconds = time.perf_counter() - t0
+    return {'seconds': seconds, 'mean_seconds': seconds, 'peak_bytes': None,
+            'max_rss_bytes': _max_rss_bytes(resource.RUSAGE_CHILDREN)}
+
+
+def environment_info():
+    """Description of the machine and software versions, stored with benchmark results"""
+    info = {'python': platform.python_version(), 'numpy': np.__version__, 'opencv': cv2.__version__,
+            'h5py': h5py.__version__, 'platform': platform.platform(), 'cpu_count': os.cpu_count(),
+            'revision': None}
+    try:
+        package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        info['revision'] = subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=package_root,
+                                          stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                          check=True).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        pass
+    return info
+
+
+def run_suite(directory, n_images=1000, vocabulary_size=10000, feature_type='sift', words_per_image=500,
+              build_images=100, queries=20, max_results=10, repeats=3, stages=None, seed=0, progress=None):
+    """Run the benchmark suite on a synthetic collection
+
+    Parameters
+    -------------
+    directory : str
+        Working directory for the synthetic files. Existing files with the same parameters are reused.
+    n_images : int
+        Number of images in the benchmark database
+    vocabulary_size : int
+        Number of visual words K
+    feature_type : str
+        Key of :data:`vsearch.utils.FEATURE_TYPES`
+    words_per_image : int
+        Number of descriptors per image
+    build_images : int
+        Number of descriptor files to build a database from in the 'build' stage
+    queries : int
+        Number of query images in the query stages
+    max_results : int
+        Number of matches per query
+    repeats : int
+        Number of timed runs of each stage
+    stages : list
+        Stages to run, from :data:`STAGES`. If None, all stages are run.
+    seed : int
+        Random seed
+    progress : callable
+        Optional function called with the name of each stage before it is run
+
+    Returns
+    -------------
+    List of result dicts, one per stage, with keys 'stage', 'items' (number of images or queries),
+    'seconds', 'mean_seconds', 'per_item_seconds', 'peak_bytes' and 'max_rss_bytes'.
+    The times are the best and the mean of `repeats` runs.
+    """
+    stages = STAGES if stages is None else stages
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        raise ValueError("Unknown benchmark stages: {}".format(', '.join(sorted(unknown))))
+
+    def report(stage):
+        if progress is not None:
+            progress(stage)
+
+    os.makedirs(directory, exist_ok=True)
+    feat_type = FEATURE_TYPES[feature_type]
+    vocabulary = synthetic_vocabulary(vocabulary_size, feat_type.featsize, seed)
+    name = '{}_{:d}_{:d}_{:d}_{:d}'.format(feature_type, n_images, vocabulary_size, words_per_image, seed)
+    vocabulary_file = os.path.join(directory, name + '.vocabulary.h5')
+    database_file = os.path.join(directory, name + '.db.h5')
+    if not os.path.exists(vocabulary_file):
+        save_vocabulary(vocabulary, vocabulary_file)
+
+    rng = np.random.RandomState(seed + 1)
+    sample = zipf_word_sampler(vocabulary_size)
+    image_size = (640, 480)
+    query_descriptors = [synthetic_descriptors(vocabulary, sample(words_per_image, rng), rng)
+                         for _ in range(queries)]
+
+    results = []
+
+    def add(stage, items, measurement):
+        if measurement is None:
+            return
+        measurement = dict(measurement, stage=stage, items=items,
+                           per_item_seconds=measurement['seconds'] / max(items, 1))
+        results.append(measurement)
+
+    database = None
+    if 'index' in stages or any(s in stages for s in ('bag', 'query_descriptors', 'query_bow')):
+        report('index')
+        holder = []
+        measurement = measure(lambda: holder.append(AnnDatabase(vocabulary)), repeats=1, memory='index' in stages)
+        database = holder[0]
+        if 'index' in stages:
+            add('index', vocabulary_size, measurement)
+
+    if 'build' in stages:
+        report('build')
+        collection = os.path.join(directory, '{}_images_{:d}_{:d}_{:d}'.format(
+            feature_type, build_images, vocabulary_size, words_per_image))
+        if not os.path.isdir(collection):
+            generate_collection(collection + '.tmp', vocabulary, build_images, feature_type, words_per_image,
+                                image_size=image_size, seed=seed)
+            os.rename(collection + '.tmp', collection)
+        add('build', build_images, measure_build(collection, vocabulary_file, os.path.join(directory, 'build.h5'),
+                                                 feature_type))
+
+    if 'load' in stages or 'query_descriptors' in stages or 'query_bow' in stages:
+        if not os.path.exists(database_file):
+            report('generate')
+            generate_bow_database(database_file + '.tmp', vocabulary, n_images, words_per_image, seed=seed)
+            os.replace(database_file + '.tmp', database_file)
+
+    if 'load' in stages:
+        report('load')
+        add('load', n_images, measure(lambda: AnnDatabase.from_file(database_file), repeats))
+
+    if 'bag' in stages:
+        report('bag')
+        add('bag', queries, measure(lambda: [database.bag(d) for d in query_descriptors], repeats))
+
+    if 'query_descriptors' in stages or 'query_bow' in stages:
+        # Reuse the vocabulary index of the 'index' stage instead of building it again
+        with h5py.File(database_file, 'r') as f:
+            database.add_images((key, f[dataset_name(key)][()]) for key in database_keys(f))
+        database.distances(np.zeros(vocabulary_size))  # Build the scoring matrix outside of the timed stages
+
+    if 'query_descriptors' in stages:
+        report('query_descriptors')
+        add('query_descriptors', queries,
+            measure(lambda: [database.query_descriptors(d, max_results) for d in query_descriptors], repeats))
+
+    if 'query_bow' in stages:
+        report('query_bow')
+        bows = [database.bag(d) for d in query_descriptors]
+        add('query_bow', queries, measure(lambda: [database.query_bow(bow, max_results) for bow in bows], repeats))
+
+    if 'colornames' in stages:
+        report('colornames')
+        images = [(synthetic_image(image_size, rng), synthetic_keypoints(words_per_image, image_size, rng))
+                  for _ in range(max(1, queries // 10))]
+        add('colornames', len(images),
+            measure(lambda: [calculate_colornames(image, keypoints=kps) for image, kps in images], repeats))
+
+    return results
+
+
+def suite_report(results, parameters):
+    """Machine-readable benchmark report, with the environment the results were measured in"""
+    return {'format': RESULTS_FORMAT_VERSION, 'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'environment': environment_info(), 'parameters': parameters, 'results': results}
+
+
+def compare_results(old, new):
+    """Compare two benchmark reports, stage by stage
+
+    Parameters
+    -------------
+    old, new : dict
+        Reports from :func:`suite_report`
+
+    Returns
+    -------------
+    List of dicts with keys 'stage', 'old_seconds', 'new_seconds', 'ratio' (new / old time),
+    'old_peak_bytes' and 'new_peak_bytes', for the stages that are in both reports
+    """
+    if old.get('parameters') != new.get('parameters'):
+        raise ValueError("The reports were measured with different parameters")
+    old_results = {r['stage']: r for r in old['results']}
+    comparison = []
+    for r in new['results']:
+        o = old_results.get(r['stage'])
+        if o is None:
+            continue
+        comparison.append({'stage': r['stage'], 'old_seconds': o['seconds'], 'new_seconds': r['seconds'],
+                           'ratio': r['seconds'] / o['seconds'] if o['seconds'] > 0 else float('inf'),
+                           'old_peak_bytes': o['peak_bytes'], 'new_peak_bytes': r['peak_bytes']})
+    return comparison
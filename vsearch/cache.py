@@ -0,0 +1,113 @@
+# Copyright 2017 Hannes Ovrén
+#
+# This file is part of vsearch.
+#
+# vsearch is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# vsearch is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with vsearch.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import os
+import threading
+
+import numpy as np
+
+
+def nbytes(value):
+    """Approximate memory size of a value in bytes
+
+    Arrays are counted by their buffer size, and tuples/lists by the sum of their items.
+    Other objects count as zero bytes.
+    """
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    elif isinstance(value, (tuple, list)):
+        return sum(nbytes(v) for v in value)
+    elif isinstance(value, (bytes, bytearray)):
+        return len(value)
+    else:
+        return 0
+
+
+def user_cache_directory(name):
+    """Directory for on-disk caches of the given kind, following the XDG base directory convention"""
+    root = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(root, 'vsearch', name)
+
+
+def file_cache_key(path):
+    """Cache key for the contents of a file: its absolute path and modification time
+
+    Raises OSError if the file does not exist.
+    """
+    return os.path.abspath(path), os.stat(path).st_mtime_ns
+
+
+class LRUCache:
+    """Least recently used cache, bounded by the total memory size of its values
+
+    The cache is safe to use from several threads.
+    """
+    def __init__(self, max_bytes, sizeof=nbytes):
+        """Create the cache
+
+        Parameters
+        ------------
+        max_bytes : int
+            Maximum total size of the cached values. The least recently used items are evicted to stay within the limit.
+        sizeof : callable
+            Function that returns the size in bytes of a value
+        """
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.nbytes = 0
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key, default=None):
+        """Return the value for key (marking it as recently used), or default if it is not cached"""
+        with self._lock:
+            try:
+                value, size = self._items[key]
+            except KeyError:
+                return default
+            self._items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        """Insert a value, evicting least recently used items if needed
+
+        Values larger than the whole cache are not stored.
+        """
+        size = self.sizeof(value)
+        with self._lock:
+            if key in self._items:
+                self.nbytes -= self._items.pop(key)[1]
+            if size > self.max_bytes:
+                return
+            self._items[key] = (value, size)
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                _, (_, evicted_size) = self._items.popitem(last=False)
+                self.nbytes -= evicted_size
+
+    def clear(self):
+        """Remove all items"""
+        with self._lock:
+            self._items.clear()
+            self.nbytes = 0
@@ -18,11 +18,14 @@
 import os
 
 import numpy as np
-import scipy.io
 
+from . import instrumentation
+from .lazy import lazy_import
 from .sift import calculate_sift
 from .utils import FEATURE_TYPES, filter_roi
 
+scipy_io = lazy_import('scipy.io')
+
 CNAMES = FEATURE_TYPES['colornames']
 
 COLOR_NAMES = ['black', 'blue', 'brown', 'grey', 'green', 'orange',
@@ -31,7 +34,31 @@ COLOR_RGB = [[0, 0, 0] , [0, 0, 1], [.5, .4, .25] , [.5, .5, .5] , [0, 1, 0] , [
              [1, .5, 1] ,[1, 0, 1], [1, 0, 0], [1, 1, 1 ] , [ 1, 1, 0 ]]
 
 COLORNAMES_TABLE_PATH = os.path.join(os.path.dirname(__file__), 'colornames_w2c.mat')
-COLORNAMES_TABLE = scipy.io.loadmat(COLORNAMES_TABLE_PATH)['w2c']
+
+_colornames_table = None
+
+
+def colornames_table():
+    """The 32768x11 table of color name probabilities per (R, G, B) bin, loaded at first use"""
+    global _colornames_table
+    if _colornames_table is None:
+        with instrumentation.timer('colornames.load_table'):
+            _colornames_table = scipy_io.loadmat(COLORNAMES_TABLE_PATH)['w2c']
+    return _colornames_table
+
+
+def use_colornames_table(table):
+    """Use an already loaded color names table, e.g. one in shared memory, instead of loading it from disk"""
+    global _colornames_table
+    _colornames_table = table
+
+
+def __getattr__(name):
+    # COLORNAMES_TABLE is loaded lazily, such that processes that never use it do not pay for loading it
+    if name == 'COLORNAMES_TABLE':
+        return colornames_table()
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
 
 def colornames_image(image, mode='index'):
     """Apply color names to an image
@@ -52,7 +79,7 @@ def colornames_image(image, mode='index'):
     """
     image = image.astype('double')
     idx = np.floor(image[..., 0] / 8) + 32 * np.floor(image[..., 1] / 8) + 32 * 32 * np.floor(image[..., 2] / 8)
-    m = COLORNAMES_TABLE[idx.astype('int')]
+    m = colornames_table()[idx.astype('int')]
 
     if mode == 'index':
         return np.argmax(m, 2)
@@ -69,7 +96,8 @@ def cname_file_for_image(path):
     return cname_file
 
 
-def calculate_colornames(image, roi=None, keypoints=None):
+@instrumentation.timed('colornames.calculate')
+def calculate_colornames(image, roi=None, keypoints=None, policy=None):
     """Calculate colornames descriptors and/or keypoints
 
     For color names we still use SIFT to detect keypoints.
@@ -87,6 +115,8 @@ def calculate_colornames(image, roi=None, keypoints=None):
     keypoints : list
         List of keypoints for which to compute the color names descriptors.
         If None, then SIFT keypoints for the image will be computed.
+    policy : vsearch.sift.KeypointPolicy
+        Which SIFT keypoints to keep, when they are computed
 
     Returns
     -------------
@@ -96,7 +126,7 @@ def calculate_colornames(image, roi=None, keypoints=None):
         List of N cv2.Keypoint objects
         """
     if not keypoints:
-        _, keypoints = calculate_sift(image, only_keypoints=True)
+        _, keypoints = calculate_sift(image, only_keypoints=True, policy=policy)
 
     _, keypoints = filter_roi([], keypoints, roi)
 
@@ -122,4 +152,5 @@ def calculate_colornames(image, roi=None, keypoints=None):
         probabilities = cname_patch[mask]
         cname_des[i] = np.sum(probabilities, 0) / len(probabilities)
 
+    instrumentation.count('colornames.keypoints', len(keypoints))
     return cname_des, keypoints
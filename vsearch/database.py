@@ -17,16 +17,27 @@
 
 import collections
 import collections.abc
+import concurrent.futures
 import os
+import re
+import threading
+import time
 
-import cv2
 import numpy as np
-import h5py
-import annoy
 
-from .utils import filter_roi, load_descriptors_and_keypoints
+from .lazy import lazy_import
+from .cache import LRUCache, file_cache_key
+from .geo import SpatialIndex, BoundingBox, Circle, haversine_distance
+from . import geo
+from . import instrumentation
+from .utils import load_descriptors_and_points_in_roi, roi_mask, FEATURE_TYPES
 from .colornames import calculate_colornames, cname_file_for_image
-from vsearch.sift import sift_file_for_image, calculate_sift
+from vsearch.sift import sift_file_for_image, calculate_sift, keypoint_policy_from_attrs
+
+cv2 = lazy_import('cv2')
+h5py = lazy_import('h5py')
+annoy = lazy_import('annoy')
+sparse = lazy_import('scipy.sparse')
 
 
 def cos_distance(x, y):
@@ -41,11 +52,122 @@ def cos_distance(x, y):
     return 1 - np.dot(x / np.linalg.norm(x), y / np.linalg.norm(y))
 
 
+def top_k(distances, k=None):
+    """Indices of the k smallest distances, sorted by distance (ascending)
+
+    Parameters
+    ---------------
+    distances : array_like
+        1D array of distances
+    k : int
+        Number of indices to return. If None, all indices are returned.
+
+    Returns
+    --------------
+    Array of at most k indices into `distances`
+    """
+    distances = np.asarray(distances)
+    if k is None or k >= len(distances):
+        return np.argsort(distances, kind='stable')
+    candidates = np.argpartition(distances, k)[:k]
+    return candidates[np.argsort(distances[candidates], kind='stable')]
+
+
+def fuse_min_top_k(a, b, k=None):
+    """Top k of the elementwise minimum of two aligned distance arrays
+
+    Since the minimum is monotone in both arguments, any of the k best fused items must also be among the k best items
+    of either `a` or `b` (this is the stopping rule of the threshold algorithm).
+    Only those at most 2k candidates are therefore fused and ranked, instead of all N items.
+
+    Parameters
+    ---------------
+    a, b : array_like
+        1D arrays of distances, where a[i] and b[i] refer to the same item
+    k : int
+        Number of items to return. If None, all items are returned.
+
+    Returns
+    --------------
+    indices : array_like
+        Indices of the (at most) k best items, sorted by fused distance
+    distances : array_like
+        The corresponding fused distances
+    """
+    a = np.asarray(a)
+    b = np.asarray(b)
+    if not a.shape == b.shape:
+        raise ValueError("Distance arrays must be aligned: {} != {}".format(a.shape, b.shape))
+
+    if k is None or k >= len(a):
+        candidates = np.arange(len(a))
+    else:
+        candidates = np.union1d(np.argpartition(a, k)[:k], np.argpartition(b, k)[:k])
+
+    fused = np.minimum(a[candidates], b[candidates])
+    order = top_k(fused, k)
+    return candidates[order], fused[order]
+
+
 class DatabaseError(Exception):
     """Error raised on database errors"""
     pass
 
 
+class _LoadAborted(Exception):
+    """Raised in a loading thread to stop it after another one has failed"""
+    pass
+
+
+class QueryCancelled(DatabaseError):
+    """Error raised when a query is cancelled through its :class:`CancellationToken`"""
+    pass
+
+
+class CancellationToken:
+    """Token used to cancel a running query from another thread
+
+    The query checks the token between its stages, and between blocks of scored database images.
+    """
+    def __init__(self):
+        self._event = threading.Event()
+
+    def cancel(self):
+        """Request cancellation"""
+        self._event.set()
+
+    @property
+    def cancelled(self):
+        """True if cancellation has been requested"""
+        return self._event.is_set()
+
+    def check(self):
+        """Raise :class:`QueryCancelled` if cancellation has been requested"""
+        if self._event.is_set():
+            raise QueryCancelled("Query was cancelled")
+
+
+QueryProgress = collections.namedtuple('QueryProgress', 'stage fraction elapsed matches')
+"""Progress report of a query, see :meth:`SiftColornamesWrapper.query_progressive`
+
+.. py:attribute:: stage
+
+    Name of the current stage: 'features', 'quantization', 'scoring' or 'fusion'
+
+.. py:attribute:: fraction
+
+    Fraction (0 to 1) of the current stage that is done
+
+.. py:attribute:: elapsed
+
+    Seconds since the stage started
+
+.. py:attribute:: matches
+
+    Provisional sorted list of matches, or None if there are no results yet
+"""
+
+
 LatLng = collections.namedtuple('LatLng', 'lat lng')
 """Tuple for locations in the form of a latitude and longitude
 
@@ -76,11 +198,49 @@ DatabaseEntry = collections.namedtuple('DatabaseEntry', ['key', 'bow', 'latlng']
 
 SUBCLASS_MESSAGE = "Please use one of the subclasses"
 
+KEYPOINT_WORDS_GROUP = 'keypoint_words'
+"""Database file group with the visual word index of each keypoint, for each key"""
+
+KEYPOINT_POINTS_GROUP = 'keypoint_points'
+"""Database file group with the (x, y) location of each keypoint, for each key"""
+
+RESERVED_DATABASE_NAMES = ('vocabulary', KEYPOINT_WORDS_GROUP, KEYPOINT_POINTS_GROUP)
+"""Names in a database file that are not image keys"""
+
+QUERY_CHUNK_SIZE = 64
+"""Number of queries of a batch that are scored together. This bounds the size of the dense distance matrix."""
+
+PROVISIONAL_RESULTS = 100
+"""Maximum number of provisional matches reported by progressive queries before the final result"""
+
+
+def _chunks(n):
+    return [slice(start, start + QUERY_CHUNK_SIZE) for start in range(0, n, QUERY_CHUNK_SIZE)]
+
+
+def dataset_name(key):
+    """Name of the dataset of a key in a database file
+
+    HDF5 uses '/' to separate groups, so '/' in keys (which are relative image paths) is stored as '%2F', and '%'
+    as '%25'. Other keys are stored unchanged.
+    """
+    return key.replace('%', '%25').replace('/', '%2F')
+
+
+def key_for_dataset(name):
+    """Key of a dataset in a database file, the inverse of :func:`dataset_name`"""
+    return re.sub('%(25|2F)', lambda m: '%' if m.group(1) == '25' else '/', name)
+
+
+def database_keys(f):
+    """Keys of all images in an open database file"""
+    return [key_for_dataset(name) for name in f if name not in RESERVED_DATABASE_NAMES]
+
 
 class QueryableDatabase(collections.abc.Mapping):
     """Baseclass for a database that can be queried by an image"""
 
-    def query_image(self, image, roi):
+    def query_image(self, image, roi, max_results=None):
         """Query using an image array and region of interest
 
         Parameters
@@ -89,6 +249,8 @@ class QueryableDatabase(collections.abc.Mapping):
             Image array
         roi : array_like
             Region of interest encoded as [x, y, width, height]
+        max_results : int
+            Maximum number of matches to return. If None, all database images are returned.
 
         Returns
         --------------
@@ -96,7 +258,7 @@ class QueryableDatabase(collections.abc.Mapping):
         """
         raise NotImplementedError
 
-    def query_path(self, path, roi):
+    def query_path(self, path, roi, max_results=None):
         """Query using an image path and region of interest
 
         Parameters
@@ -105,6 +267,8 @@ class QueryableDatabase(collections.abc.Mapping):
             Path to the query image
         roi : array_like
             Region of interest encoded as [x, y, width, height]
+        max_results : int
+            Maximum number of matches to return. If None, all database images are returned.
 
         Returns
         --------------
@@ -113,8 +277,42 @@ class QueryableDatabase(collections.abc.Mapping):
         raise NotImplementedError
 
 
+def _normalize_rows(matrix):
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    norms[norms == 0] = 1
+    return sparse.diags(1 / norms).dot(matrix).tocsr()
+
+
+class SparseVectors(collections.abc.Mapping):
+    """Read-only mapping from keys to dense BoW vectors, stored as the rows of a sparse matrix"""
+    def __init__(self, keys, matrix):
+        self._keys = keys
+        self.matrix = matrix
+        self._index = {key: i for i, key in enumerate(keys)}
+
+    def __getitem__(self, key):
+        return self.matrix[self._index[key]].toarray().ravel()
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __setitem__(self, key, value):
+        raise DatabaseError("The database is read-only")
+
+    def pop(self, key, *default):
+        raise DatabaseError("The database is read-only")
+
+
 class BagOfWordsDatabase(collections.abc.MutableMapping):
     """Bag of Words (Bag of Features) database
+
+    The most frequent visual words can be ignored when scoring, see :meth:`set_stop_words`.
     """
     def __init__(self, vocabulary):
         """Initialize the database
@@ -126,8 +324,15 @@ class BagOfWordsDatabase(collections.abc.MutableMapping):
         """
         self.image_vectors = {}
         self.idf = None
+        self.database_file = None
+        self._key_order = None
+        self._key_index = None
+        self._scoring_matrix = None
         self._load_vocabulary(vocabulary)
         self._word_counts = np.zeros(self.vocabulary_size, dtype='int')
+        self.stop_words = np.zeros(0, dtype='int')
+        self._stop_fraction = None
+        self._stop_min_idf = None
 
     def add_image(self, key, descriptors_or_bow):
         """Add image to the database
@@ -140,6 +345,25 @@ class BagOfWordsDatabase(collections.abc.MutableMapping):
             If 1D it is treated as a single, precomputed BoW-vector.
             If 2D it is treated as a set of feature descriptors, which will be bagged using the database vocabulary.
         """
+        self._insert(key, descriptors_or_bow)
+        self._update_idf()
+
+    def add_images(self, items):
+        """Add several images to the database
+
+        This is equivalent to, but much faster than, calling :meth:`add_image` for each image, since the IDF weights are
+        only updated once.
+
+        Parameters
+        ----------------
+        items : iterable
+            Iterable of (key, descriptors_or_bow) pairs, see :meth:`add_image`
+        """
+        for key, descriptors_or_bow in items:
+            self._insert(key, descriptors_or_bow)
+        self._update_idf()
+
+    def _insert(self, key, descriptors_or_bow):
         if key in self.image_vectors:
             raise DatabaseError("Image '{}' is already in the database".format(key))
 
@@ -153,10 +377,65 @@ class BagOfWordsDatabase(collections.abc.MutableMapping):
             raise DatabaseError("Bag of Words vector had wrong size: {:d} (expected {:d})".format(len(bow), self.vocabulary_size))
 
         self.image_vectors[key] = bow
-
-        # Update IDF
         self._word_counts += (bow > 0)
-        self.idf = np.log(len(self.image_vectors) / (1 + self._word_counts).astype('float'))
+
+    def _update_idf(self):
+        if self.image_vectors:
+            self.idf = np.log(len(self.image_vectors) / (1 + self._word_counts).astype('float'))
+            # Stop words get zero weight, which removes them from both database and query vectors
+            self.stop_words = self._select_stop_words(self.idf)
+            self.idf[self.stop_words] = 0
+        else:
+            self.idf = None
+            self.stop_words = np.zeros(0, dtype='int')
+        self._invalidate_scoring()
+
+    def _select_stop_words(self, idf):
+        stop = np.zeros(self.vocabulary_size, dtype='bool')
+        if self._stop_fraction:
+            n_stop = int(round(self._stop_fraction * self.vocabulary_size))
+            used = np.flatnonzero(self._word_counts > 0)
+            order = used[np.argsort(-self._word_counts[used], kind='stable')]
+            stop[order[:n_stop]] = True
+        if self._stop_min_idf is not None:
+            stop |= idf < self._stop_min_idf
+        return np.flatnonzero(stop)
+
+    def set_stop_words(self, fraction=None, min_idf=None):
+        """Ignore the most frequent visual words when scoring
+
+        Frequent words carry almost no weight (their IDF is close to zero), but they are in a large part of the
+        database vectors, and therefore account for much of the scoring cost. Stop words are removed from both the
+        database and the query vectors, while the stored BoW vectors are kept. The stop list is updated when images
+        are added, and the document frequencies of the words change.
+
+        Parameters
+        ----------------
+        fraction : float
+            Fraction of the vocabulary to ignore, taking the words that are in the most images
+        min_idf : float
+            Ignore words with a lower IDF weight than this
+
+        If both are None, all words are used.
+
+        For a read-only database, e.g. one opened from a snapshot, the TF-IDF vectors are recomputed from the stored
+        word counts with sparse matrix operations. Setting the stop words that the database already uses keeps its
+        TF-IDF vectors.
+
+        Returns
+        ----------------
+        Array of the stop words
+        """
+        if (fraction, min_idf) == (self._stop_fraction, self._stop_min_idf) and self._scoring_matrix is not None:
+            return self.stop_words
+        self._stop_fraction = fraction
+        self._stop_min_idf = min_idf
+        self._update_idf()
+        return self.stop_words
+
+    def document_frequencies(self):
+        """Fraction of the database images that contain each visual word"""
+        return self._word_counts / max(len(self.image_vectors), 1)
 
     @property
     def vocabulary_size(self):
@@ -170,7 +449,9 @@ class BagOfWordsDatabase(collections.abc.MutableMapping):
         return len(self.image_vectors)
 
     def __delitem__(self, key):
-        del self.image_vectors[key]
+        bow = self.image_vectors.pop(key)
+        self._word_counts -= (bow > 0)
+        self._update_idf()
 
     def __getitem__(self, key):
         return self.image_vectors[key]
@@ -184,28 +465,245 @@ class BagOfWordsDatabase(collections.abc.MutableMapping):
         else:
             self.add_image(key, value)
 
-    def query_descriptors(self, descriptors):
+    @property
+    def key_order(self):
+        """List of database keys, in the order used by :meth:`distances`"""
+        self._update_scoring()
+        return self._key_order
+
+    def rows_for_keys(self, keys):
+        """Positions in :attr:`key_order` of the given keys
+
+        Keys that are not in the database are ignored.
+
+        Returns
+        --------------
+        Sorted integer array of row positions
+        """
+        self._update_scoring()
+        if self._key_index is None:
+            self._key_index = {key: i for i, key in enumerate(self._key_order)}
+        rows = [self._key_index[key] for key in keys if key in self._key_index]
+        return np.sort(np.array(rows, dtype='int'))
+
+    def _invalidate_scoring(self):
+        self._key_order = None
+        self._key_index = None
+        self._scoring_matrix = None
+
+    def _update_scoring(self):
+        # The IDF weights change with every insertion, so the matrix of normalized TF-IDF vectors is (re)built
+        # lazily at the first query after a change.
+        if self._scoring_matrix is not None:
+            return
+
+        keys = list(self.image_vectors)
+        if isinstance(self.image_vectors, SparseVectors):
+            # Read-only databases keep their BoW vectors as the rows of a sparse matrix
+            self._scoring_matrix = self._tfidf_from_counts(self.image_vectors.matrix)
+        else:
+            self._scoring_matrix = self._tfidf_matrix(self.image_vectors[key] for key in keys)
+        self._key_order = keys
+
+    def _load_state(self, keys, counts, idf, word_counts, scoring_matrix):
+        """Use precomputed database contents, e.g. from a snapshot, instead of adding images one at a time
+
+        The database becomes read-only.
+
+        Parameters
+        ---------------
+        keys : list
+            Database keys, in row order
+        counts : scipy.sparse.csr_matrix
+            NxK matrix of BoW vectors
+        idf : array_like
+            IDF weights
+        word_counts : array_like
+            Number of images that contain each word
+        scoring_matrix : scipy.sparse.csr_matrix
+            NxK matrix of row-normalized TF-IDF vectors
+        """
+        self.image_vectors = SparseVectors(keys, counts)
+        self.idf = idf
+        self._word_counts = word_counts
+        self._key_order = keys
+        self._key_index = self.image_vectors._index
+        self._scoring_matrix = scoring_matrix
+
+    def _tfidf_matrix(self, bows):
+        """Sparse matrix with one row-normalized TF-IDF vector per BoW vector"""
+        indptr = [0]
+        indices = []
+        data = []
+        for bow in bows:
+            bow = np.asarray(bow)
+            words = np.flatnonzero(bow)
+            words = words[self.idf[words] != 0]
+            indices.append(words)
+            data.append(bow[words] * self.idf[words])
+            indptr.append(indptr[-1] + len(words))
+
+        if data:
+            data = np.concatenate(data).astype('float64')
+            indices = np.concatenate(indices)
+        else:
+            data = np.zeros(0)
+            indices = np.zeros(0, dtype='int')
+        matrix = sparse.csr_matrix((data, indices, indptr), shape=(len(indptr) - 1, self.vocabulary_size))
+        return _normalize_rows(matrix)
+
+    def _tfidf_from_counts(self, counts):
+        """Row-normalized TF-IDF matrix from a sparse NxK matrix of BoW vectors"""
+        matrix = counts.dot(sparse.diags(self.idf)).tocsr()
+        matrix.eliminate_zeros()  # Stop words
+        return _normalize_rows(matrix)
+
+    def distances(self, bow, rows=None):
+        """Cosine distances between a query BoW vector and all database images
+
+        The vectors are TF-IDF weighted before the distances are computed.
+
+        Parameters
+        ---------------
+        bow : array_like
+            K-dimensional vector of word frequencies, where K is the size of the vocabulary
+        rows : slice or array_like
+            If given, only the database images at these positions in :attr:`key_order` are scored
+
+        Returns
+        --------------
+        Array of distances, in the same order as :attr:`key_order` (or `rows`)
+        """
+        self._update_scoring()
+        with instrumentation.timer('database.score'):
+            matrix = self._scoring_matrix if rows is None else self._scoring_matrix[rows]
+            if matrix.shape[0] == 0:
+                return np.zeros(0)
+            q = np.asarray(bow) * self.idf
+            norm = np.linalg.norm(q)
+            if norm > 0:
+                q = q / norm
+            instrumentation.count('database.images_scored', matrix.shape[0])
+            return 1 - matrix.dot(q)
+
+    def distances_batch(self, bows):
+        """Cosine distances between several query BoW vectors and all database images
+
+        All queries are scored by a single sparse matrix product.
+
+        Parameters
+        ---------------
+        bows : list
+            List of Q K-dimensional vectors of word frequencies
+
+        Returns
+        --------------
+        QxN array of distances, where the columns are in the same order as :attr:`key_order`
+        """
+        self._update_scoring()
+        if len(self._key_order) == 0 or self.idf is None:
+            return np.zeros((len(bows), len(self._key_order)))
+        with instrumentation.timer('database.score'):
+            queries = self._tfidf_matrix(bows)
+            similarities = queries.dot(self._scoring_matrix.T).toarray()
+        instrumentation.count('database.images_scored', similarities.size)
+        return 1 - similarities
+
+    def bag_batch(self, descriptors_list, max_workers=None):
+        """Create bag vectors for several sets of descriptors, in parallel threads
+
+        Parameters
+        ---------------
+        descriptors_list : list
+            List of NxD descriptor arrays
+        max_workers : int
+            Number of threads to use. If None the default of :class:`concurrent.futures.ThreadPoolExecutor` is used.
+
+        Returns
+        --------------
+        List of K-dimensional vectors of word frequencies
+        """
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(self.bag, descriptors_list))
+
+    def top_k_batch(self, bows, k=None):
+        """Best database matches for several query BoW vectors
+
+        Parameters
+        ---------------
+        bows : list
+            List of Q K-dimensional vectors of word frequencies
+        k : int
+            Maximum number of matches per query. If None, all database images are returned.
+
+        Returns
+        --------------
+        List of Q (indices, distances) array tuples, sorted by distance.
+        The indices refer to :attr:`key_order`.
+        """
+        results = []
+        for distances in self.distances_batch(bows):
+            indices = top_k(distances, k)
+            results.append((indices, distances[indices]))
+        return results
+
+    def query_descriptors_batch(self, descriptors_list, max_results=None):
+        """Query the database by several sets of descriptors
+
+        The queries are scored in chunks of :data:`QUERY_CHUNK_SIZE`, so memory use does not grow with the number of
+        queries beyond the returned matches.
+
+        Parameters
+        ---------------
+        descriptors_list : list
+            List of NxD descriptor arrays, one per query
+        max_results : int
+            Maximum number of matches per query. If None, all database images are returned.
+
+        Returns
+        --------------
+        List of sorted match lists [(key1, distance1), (key2, distance2), ...], one per query
+        """
+        keys = self.key_order
+        matches = []
+        for chunk in _chunks(len(descriptors_list)):
+            results = self.top_k_batch(self.bag_batch(descriptors_list[chunk]), max_results)
+            matches.extend([(keys[i], d) for i, d in zip(indices, distances)] for indices, distances in results)
+        return matches
+
+    def query_bow(self, bow, max_results=None):
+        """Query the database by a BoW vector
+
+        Parameters
+        ---------------
+        bow : array_like
+            K-dimensional vector of word frequencies, where K is the size of the vocabulary
+        max_results : int
+            Maximum number of matches to return. If None, all database images are returned.
+
+        Returns
+        --------------
+        Sorted list of database matches [(key1, distance1), (key2, distance2), ...] where distance1 < distance2.
+        """
+        distances = self.distances(bow)
+        keys = self.key_order
+        return [(keys[i], distances[i]) for i in top_k(distances, max_results)]
+
+    def query_descriptors(self, descriptors, max_results=None):
         """Query the database by a set of descriptors
 
         Parameters
         ---------------
         descriptors : array_like
             NxD array of N descriptors of dimensionality D (which must match the database vocabulary)
+        max_results : int
+            Maximum number of matches to return. If None, all database images are returned.
 
         Returns
         --------------
         Sorted list of database matches [(key1, distance1), (key2, distance2), ...] where distance1 < distance2.
         """
-        q_tf = self.bag(descriptors)
-        q_tfidf = q_tf * self.idf
-
-        matches = []
-        for key, t_tf in self.image_vectors.items():
-            t_tfidf = t_tf * self.idf
-            distance = cos_distance(q_tfidf, t_tfidf)
-            matches.append((key, distance))
-
-        return sorted(matches, key=lambda x: x[1])
+        return self.query_bow(self.bag(descriptors), max_results)
 
     def bag(self, descriptors):
         """Create bag vector from descriptors
@@ -226,19 +724,68 @@ class BagOfWordsDatabase(collections.abc.MutableMapping):
         raise NotImplementedError(SUBCLASS_MESSAGE)
 
     @classmethod
-    def from_file(cls, database_file):
-        """Load database from file"""
-        with h5py.File(database_file, 'r') as f:
+    def from_file(cls, database_file, progress=None, chunk_size=1000):
+        """Load database from file
+
+        Parameters
+        ----------------
+        database_file : str
+            Path to the database file
+        progress : callable
+            Optional function called as `progress(keys, num_loaded, num_total)` after each chunk of images has been
+            loaded, where `keys` are the keys of the chunk.
+        chunk_size : int
+            Number of images per chunk
+        """
+        with instrumentation.timer('database.load'), h5py.File(database_file, 'r') as f:
             vocabulary = f['vocabulary']
             instance = cls(vocabulary)
 
-            for key in f:
-                if not key == 'vocabulary':
-                    descriptors = f[key].value
-                    instance.add_image(key, descriptors)
+            keys = database_keys(f)
+            for start in range(0, len(keys), chunk_size):
+                chunk = keys[start:start + chunk_size]
+                instance.add_images((key, f[dataset_name(key)][()]) for key in chunk)
+                if progress is not None:
+                    progress(chunk, start + len(chunk), len(keys))
+            instrumentation.count('database.images_loaded', len(keys))
 
+        instance.database_file = database_file
         return instance
 
+    def keys_in_file(self):
+        """Keys of all images in the database file, or an empty list if the database has no file"""
+        if self.database_file is None:
+            return []
+        with h5py.File(self.database_file, 'r') as f:
+            return database_keys(f)
+
+    def update_from_file(self, keys=None):
+        """Add images that are in the database file, but not in the database
+
+        This picks up images that were added to the file after it was loaded, e.g. by
+        :class:`vsearch.ingest.IngestPipeline`. Images that were replaced in the file keep their old BoW vectors
+        until the database is loaded again.
+
+        Parameters
+        ----------------
+        keys : iterable
+            Only add these keys. If None, all new keys in the file are added.
+
+        Returns
+        ----------------
+        List of added keys
+        """
+        if self.database_file is None:
+            return []
+        with h5py.File(self.database_file, 'r') as f:
+            if keys is None:
+                keys = database_keys(f)
+            new_keys = [key for key in keys if key not in self.image_vectors and dataset_name(key) in f]
+            if new_keys:
+                self.add_images((key, f[dataset_name(key)][()]) for key in new_keys)
+        instrumentation.count('database.images_loaded', len(new_keys))
+        return new_keys
+
 
 class AnnDatabase(BagOfWordsDatabase):
     """Approximate Nearest Neighbour database
@@ -248,21 +795,32 @@ class AnnDatabase(BagOfWordsDatabase):
 
     This implementation usses the annoy NN-library.
     """
-    def __init__(self, vocabulary):
+    def __init__(self, vocabulary, n_trees=20, annoy_index_file=None):
         """Initialize the database
 
         Parameters
         -------------
         vocabulary : array_like
             The vocabulary, a KxD array with K words/prototypes of dimensionality D.
+        n_trees : int
+            Number of trees in the annoy index. More trees give more accurate quantization, but slower bagging.
+        annoy_index_file : str
+            A prebuilt annoy index of the vocabulary, which is memory mapped instead of building a new index
         """
         self.annoy_index = None
-        self.n_trees = 20
+        self.n_trees = n_trees
+        self.annoy_index_file = annoy_index_file
         super().__init__(vocabulary)
 
     def _load_vocabulary(self, vocabulary):
         feat_size = vocabulary.shape[1]
         self.annoy_index = annoy.AnnoyIndex(feat_size, metric='euclidean')
+        if self.annoy_index_file is not None:
+            self.annoy_index.load(self.annoy_index_file)
+            if self.annoy_index.get_n_items() != len(vocabulary):
+                raise DatabaseError("The annoy index has {:d} items, but the vocabulary has {:d} words".format(
+                    self.annoy_index.get_n_items(), len(vocabulary)))
+            return
         for i, x in enumerate(vocabulary):
             self.annoy_index.add_item(i, x)
         self.annoy_index.build(self.n_trees)
@@ -274,78 +832,314 @@ class AnnDatabase(BagOfWordsDatabase):
         if not descriptors.shape[1] == self.annoy_index.f:
             raise DatabaseError(
                 "Descriptor vectors had wrong size: {:d} (expected {:d})".format(descriptors.shape[1], self.annoy_index.f))
-        document_word_count = np.zeros(self.vocabulary_size)
-        for i, d in enumerate(descriptors):
-            l, *_ = self.annoy_index.get_nns_by_vector(d, 1)
-            document_word_count[l] += 1
-        return document_word_count
+        words = self.quantize(descriptors)
+        return np.bincount(words, minlength=self.vocabulary_size).astype('float')
 
+    def quantize(self, descriptors):
+        """Assign each descriptor to its (approximately) nearest visual word
+
+        Parameters
+        ---------------
+        descriptors : array_like
+            NxD array of N descriptors of dimensionality D (which must match the database vocabulary)
+
+        Returns
+        --------------
+        Array of N word indices
+        """
+        with instrumentation.timer('database.quantize'):
+            words = np.zeros(len(descriptors), dtype='int')
+            for i, d in enumerate(descriptors):
+                words[i], *_ = self.annoy_index.get_nns_by_vector(d, 1)
+        instrumentation.count('database.descriptors_quantized', len(descriptors))
+        return words
+
+
+QueryFeatures = collections.namedtuple('QueryFeatures', 'descriptors points words')
+"""Cached features of a query image
+
+.. py:attribute:: descriptors
+
+    NxD array of descriptors
+
+.. py:attribute:: points
+
+    Nx2 array of keypoint locations
+
+.. py:attribute:: words
+
+    Array of N visual word indices, where -1 marks descriptors that are not yet quantized
+"""
 
-class SiftFeatureDatabase(QueryableDatabase, AnnDatabase):
-    """An ANN database for SIFT features"""
-    def query_image(self, image, roi):
-        """Query using an image array and region of interest
+
+class FeatureFileDatabase(QueryableDatabase, AnnDatabase):
+    """An ANN database for features that can be precomputed into a descriptor file next to each image
+
+    Subclasses define which feature is used, by implementing :meth:`feature_file_for_image` and
+    :meth:`calculate_features`.
+
+    The features and visual words of recent query images are kept in a memory bounded LRU cache.
+    Repeated queries on the same image, e.g. with a different region of interest, then only need to filter the
+    cached keypoints.
+
+    Features of query images are calculated with :attr:`keypoint_policy`, which is the policy recorded in the
+    database file, such that queries are extracted like the database images.
+    """
+    feature_type = None
+
+    def __init__(self, vocabulary, feature_cache_bytes=256 * 2**20, n_trees=20, annoy_index_file=None):
+        """Initialize the database
 
         Parameters
+        -------------
+        vocabulary : array_like
+            The vocabulary, a KxD array with K words/prototypes of dimensionality D.
+        feature_cache_bytes : int
+            Memory budget for cached query features
+        n_trees, annoy_index_file
+            See :class:`AnnDatabase`
+        """
+        super().__init__(vocabulary, n_trees, annoy_index_file)
+        self.feature_cache = LRUCache(feature_cache_bytes)
+        self.stored_keypoints = None
+        self.keypoint_policy = None
+
+    @classmethod
+    def from_file(cls, database_file, progress=None, chunk_size=1000):
+        """Load database from file, see :meth:`BagOfWordsDatabase.from_file`
+
+        The keypoint policy recorded in the file is used for query images.
+        """
+        instance = super().from_file(database_file, progress, chunk_size)
+        with h5py.File(database_file, 'r') as f:
+            instance.keypoint_policy = keypoint_policy_from_attrs(f.attrs)
+        return instance
+
+    def feature_file_for_image(self, path):
+        """Return descriptor filename corresponding to an image path"""
+        raise NotImplementedError(SUBCLASS_MESSAGE)
+
+    def calculate_features(self, image, roi):
+        """Calculate descriptors and keypoints for an image and region of interest"""
+        raise NotImplementedError(SUBCLASS_MESSAGE)
+
+    def descriptors_for_image(self, image, roi):
+        """Descriptors for the region of interest of an image array"""
+        descriptors, keypoints = self.calculate_features(image, roi)
+        return descriptors
+
+    def features_for_path(self, path, roi=None):
+        """Features for an image file
+
+        If there is a precomputed descriptor file for the image it is used, otherwise the features are computed.
+        The result is cached, keyed by the path and modification time of the file it was created from.
+
+        If a region of interest is given and the descriptor file is spatially sorted, only the grid cells that
+        intersect the region are read, unless the features of the whole image are already cached.
+        The features can include keypoints outside the region, which are removed with :func:`roi_mask`.
+
+        Returns
         ---------------
-        image : np.ndarray
-            Image array
+        A :class:`QueryFeatures` object
+        """
+        feature_file = self.feature_file_for_image(path)
+        source = feature_file if os.path.exists(feature_file) else path
+        cache_key = file_cache_key(source)
+        features = self.feature_cache.get(cache_key)
+        roi_cache_key = cache_key + (tuple(float(x) for x in roi),) if roi is not None else None
+        if features is None and roi_cache_key is not None:
+            features = self.feature_cache.get(roi_cache_key)
+        instrumentation.count('database.feature_cache_hits' if features is not None else 'database.feature_cache_misses')
+
+        if features is None:
+            complete = True
+            if source == feature_file:
+                with instrumentation.timer('database.feature_load'):
+                    descriptors, points, complete = load_descriptors_and_points_in_roi(feature_file, roi)
+            else:
+                with instrumentation.timer('database.imread'):
+                    image = cv2.imread(path)
+                    image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+                descriptors, keypoints = self.calculate_features(image, None)
+                points = np.array([kp.pt for kp in keypoints], dtype='float32').reshape(-1, 2)
+            words = np.full(len(descriptors), -1, dtype='int')
+            features = QueryFeatures(descriptors, points, words)
+            self.feature_cache.put(cache_key if complete else roi_cache_key, features)
+
+        return features
+
+    def descriptors_for_path(self, path, roi):
+        """Descriptors for the region of interest of an image file
+
+        If there is a precomputed descriptor file for the image it is used, otherwise the features are computed.
+        """
+        features = self.features_for_path(path, roi)
+        return features.descriptors[roi_mask(features.points, roi)]
+
+    def bow_for_path(self, path, roi):
+        """BoW vector for the region of interest of an image file
+
+        Only descriptors that were not quantized by an earlier query on the same image are quantized.
+        """
+        features = self.features_for_path(path, roi)
+        inside = np.flatnonzero(roi_mask(features.points, roi))
+        missing = inside[features.words[inside] < 0]
+        if len(missing):
+            features.words[missing] = self.quantize(features.descriptors[missing])
+        return np.bincount(features.words[inside], minlength=self.vocabulary_size).astype('float')
+
+    def stored_features(self, key):
+        """Keypoint locations and visual words of a database image, as stored when the database was created
+
+        Parameters
+        ---------------
+        key : str
+            Database key
+
+        Returns
+        ---------------
+        A :class:`QueryFeatures` object, without descriptors
+
+        Raises
+        ---------------
+        KeyError if the database file has no stored keypoint words for the key
+        """
+        if self.stored_keypoints is not None:
+            # Keypoints that are already in memory (or memory mapped), e.g. from a snapshot
+            words, points = self.stored_keypoints(key)
+            return QueryFeatures(None, points, words)
+        if self.database_file is None:
+            raise KeyError(key)
+        cache_key = (os.path.abspath(self.database_file), key)
+        features = self.feature_cache.get(cache_key)
+        if features is None:
+            with h5py.File(self.database_file, 'r') as f:
+                try:
+                    words = f[KEYPOINT_WORDS_GROUP][dataset_name(key)][()]
+                    points = f[KEYPOINT_POINTS_GROUP][dataset_name(key)][()].reshape(-1, 2)
+                except KeyError:
+                    raise KeyError(key)
+            instrumentation.count('utils.bytes_read', words.nbytes + points.nbytes)
+            features = QueryFeatures(None, points, words)
+            self.feature_cache.put(cache_key, features)
+        return features
+
+    def bow_for_key(self, key, roi):
+        """BoW vector for the region of interest of a database image
+
+        This uses the keypoint words stored in the database file, so no descriptors are loaded or quantized.
+
+        Raises
+        ---------------
+        KeyError if the database file has no stored keypoint words for the key
+        """
+        features = self.stored_features(key)
+        words = features.words[roi_mask(features.points, roi)]
+        return np.bincount(words, minlength=self.vocabulary_size).astype('float')
+
+    def query_key(self, key, roi, max_results=None):
+        """Query using a database image and region of interest
+
+        Parameters
+        ---------------
+        key : str
+            Database key of the query image
         roi : array_like
             Region of interest encoded as [x, y, width, height]
+        max_results : int
+            Maximum number of matches to return. If None, all database images are returned.
 
         Returns
         --------------
         Sorted list of database matches [(key1, distance1), (key2, distance2), ...] where distance1 < distance2.
         """
-        descriptors, keypoints = calculate_sift(image, roi)
-        return self.query_descriptors(descriptors)
+        return self.query_bow(self.bow_for_key(key, roi), max_results)
 
-    def query_path(self, path, roi):
-        """Query using an image path and region of interest
+    def bows_for_paths(self, paths, rois, max_workers=None):
+        """BoW vectors for several image files, computed in parallel threads
 
         Parameters
         ---------------
-        path : str
-            Path to the query image
+        paths : list
+            Paths to the images
+        rois : list
+            One region of interest per path, or None to use the whole images
+
+        Returns
+        --------------
+        List of BoW vectors, one per path
+        """
+        if rois is None:
+            rois = [None] * len(paths)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(self.bow_for_path, paths, rois))
+
+    def descriptors_for_paths(self, paths, rois, max_workers=None):
+        """Descriptors for several image files, loaded or computed in parallel threads
+
+        Parameters
+        ---------------
+        paths : list
+            Paths to the images
+        rois : list
+            One region of interest per path, or None to use the whole images
+
+        Returns
+        --------------
+        List of descriptor arrays, one per path
+        """
+        if rois is None:
+            rois = [None] * len(paths)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(self.descriptors_for_path, paths, rois))
+
+    def query_image(self, image, roi, max_results=None):
+        """Query using an image array and region of interest
+
+        Parameters
+        ---------------
+        image : np.ndarray
+            Image array
         roi : array_like
             Region of interest encoded as [x, y, width, height]
+        max_results : int
+            Maximum number of matches to return. If None, all database images are returned.
 
         Returns
         --------------
         Sorted list of database matches [(key1, distance1), (key2, distance2), ...] where distance1 < distance2.
         """
-        sift_file = sift_file_for_image(path)
-        if os.path.exists(sift_file):
-            print('Loading SIFT features from', sift_file)
-            descriptors, keypoints = load_descriptors_and_keypoints(sift_file)
-            descriptors, keypoints = filter_roi(descriptors, keypoints, roi)
-            return self.query_descriptors(descriptors)
-        else:
-            image = cv2.imread(path)
-            image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-            return self.query_image(image, roi)
+        return self.query_descriptors(self.descriptors_for_image(image, roi), max_results)
 
+    def query_paths(self, paths, rois=None, max_results=None):
+        """Query using several image paths and regions of interest
 
-class ColornamesFeatureDatabase(QueryableDatabase, AnnDatabase):
-    """An ANN database for color names features"""
-    def query_image(self, image, roi):
-        """Query using an image array and region of interest
+        The queries are scored in chunks of :data:`QUERY_CHUNK_SIZE`, so memory use does not grow with the number of
+        queries beyond the returned matches.
+
+        Parameters
+        ---------------
+        paths : list
+            Paths to the query images
+        rois : list
+            One region of interest per path, encoded as [x, y, width, height], or None to use the whole images
+        max_results : int
+            Maximum number of matches per query. If None, all database images are returned.
 
-            Parameters
-            ---------------
-            image : np.ndarray
-                Image array
-            roi : array_like
-                Region of interest encoded as [x, y, width, height]
-
-            Returns
-            --------------
-            Sorted list of database matches [(key1, distance1), (key2, distance2), ...] where distance1 < distance2.
-            """
-        descriptors, keypoints = calculate_colornames(image, roi)
-        return self.query_descriptors(descriptors)
-
-    def query_path(self, path, roi):
+        Returns
+        --------------
+        List of sorted match lists [(key1, distance1), (key2, distance2), ...], one per query
+        """
+        if rois is None:
+            rois = [None] * len(paths)
+        keys = self.key_order
+        matches = []
+        for chunk in _chunks(len(paths)):
+            results = self.top_k_batch(self.bows_for_paths(paths[chunk], rois[chunk]), max_results)
+            matches.extend([(keys[i], d) for i, d in zip(indices, distances)] for indices, distances in results)
+        return matches
+
+    def query_path(self, path, roi, max_results=None):
         """Query using an image path and region of interest
 
         Parameters
@@ -354,44 +1148,100 @@ class ColornamesFeatureDatabase(QueryableDatabase, AnnDatabase):
             Path to the query image
         roi : array_like
             Region of interest encoded as [x, y, width, height]
+        max_results : int
+            Maximum number of matches to return. If None, all database images are returned.
 
         Returns
         --------------
         Sorted list of database matches [(key1, distance1), (key2, distance2), ...] where distance1 < distance2.
         """
-        cname_file = cname_file_for_image(path)
-        if os.path.exists(cname_file):
-            print('Loading Colorname features from', cname_file)
-            descriptors, keypoints = load_descriptors_and_keypoints(cname_file)
-            descriptors, keypoints = filter_roi(descriptors, keypoints, roi)
-            return self.query_descriptors(descriptors)
-        else:
-            image = cv2.imread(path)
-            image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-            return self.query_image(image, roi)
+        return self.query_bow(self.bow_for_path(path, roi), max_results)
+
+
+class SiftFeatureDatabase(FeatureFileDatabase):
+    """An ANN database for SIFT features"""
+    feature_type = FEATURE_TYPES['sift']
+
+    def feature_file_for_image(self, path):
+        return sift_file_for_image(path)
+
+    def calculate_features(self, image, roi):
+        return calculate_sift(image, roi, policy=self.keypoint_policy)
+
+
+class ColornamesFeatureDatabase(FeatureFileDatabase):
+    """An ANN database for color names features"""
+    feature_type = FEATURE_TYPES['colornames']
+
+    def feature_file_for_image(self, path):
+        return cname_file_for_image(path)
+
+    def calculate_features(self, image, roi):
+        return calculate_colornames(image, roi, policy=self.keypoint_policy)
 
 
 class SiftColornamesWrapper(QueryableDatabase):
     """A database that combines a SIFT and color names databse
 
-    For each query, both the SIFT and color names database will be queried.
+    For each query, both the SIFT and color names database will be queried concurrently.
     The resulting matches are then sorted using the minimum of the SIFT and color names distance value.
     """
     def __init__(self, sift_db, cname_db):
         self.sift_db = sift_db
         self.cname_db = cname_db
+        self._alignment = None
         if not self.sift_db.image_vectors.keys() == self.cname_db.image_vectors.keys():
             raise DatabaseError("SIFT and Colornames databases had different keys!")
 
     @classmethod
-    def from_files(cls, sift_db_path, cname_db_path):
-        """Load the database from a SIFT and color names database"""
-        sift_db = SiftFeatureDatabase.from_file(sift_db_path)
-        cname_db = ColornamesFeatureDatabase.from_file(cname_db_path)
+    def from_files(cls, sift_db_path, cname_db_path, progress=None):
+        """Load the database from a SIFT and color names database
+
+        The two databases are loaded concurrently.
+
+        Parameters
+        ----------------
+        sift_db_path : str
+            Path to the SIFT database file
+        cname_db_path : str
+            Path to the color names database file
+        progress : callable
+            Optional function called as `progress(name, keys, num_loaded, num_total)` after each chunk of images has
+            been loaded, where `name` is either 'sift' or 'colornames'.
+            An exception raised by this function aborts the loading of both databases, and is re-raised.
+        """
+        abort = threading.Event()
+
+        def load(db_class, path):
+            name = db_class.feature_type.key
+
+            def on_progress(*args):
+                if abort.is_set():
+                    raise _LoadAborted()
+                if progress is not None:
+                    progress(name, *args)
+            return db_class.from_file(path, progress=on_progress)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            sift_future = executor.submit(load, SiftFeatureDatabase, sift_db_path)
+            cname_future = executor.submit(load, ColornamesFeatureDatabase, cname_db_path)
+            futures = [sift_future, cname_future]
+            done, pending = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_EXCEPTION)
+            errors = [future.exception() for future in futures if future in done and future.exception() is not None]
+            if errors:
+                # The other database stops loading at its next chunk
+                abort.set()
+                for future in pending:
+                    future.cancel()
+                raise errors[0]
+            sift_db = sift_future.result()
+            cname_db = cname_future.result()
+
         instance = cls(sift_db, cname_db)
         return instance
 
-    def query_path(self, path, roi):
+    @instrumentation.timed('database.query_path')
+    def query_path(self, path, roi, max_results=None, candidates=None):
         """Query using an image path and region of interest
 
         Parameters
@@ -400,32 +1250,319 @@ class SiftColornamesWrapper(QueryableDatabase):
             Path to the query image
         roi : array_like
             Region of interest encoded as [x, y, width, height]
+        max_results : int
+            Maximum number of matches to return. If None, all database images are returned.
+        candidates : iterable
+            If given, only these database keys are scored
 
         Returns
         --------------
         Sorted list of database matches [(key1, distance1), (key2, distance2), ...] where distance1 < distance2.
         """
-        sift_matches = dict(self.sift_db.query_path(path, roi))
-        cname_matches = dict(self.cname_db.query_path(path, roi))
-        return self.combine_matches(sift_matches, cname_matches)
+        return self._query_both(lambda db: db.bow_for_path(path, roi), max_results, candidates)
+
+    @instrumentation.timed('database.query_key')
+    def query_key(self, key, roi, max_results=None, path=None, candidates=None):
+        """Query using a database image and region of interest
 
-    def query_image(self, image, roi):
+        The keypoint words stored in the database files are used, so that no features are loaded or quantized.
+        For database files without stored keypoint words, the image at `path` is used instead.
+
+        Parameters
+        ---------------
+        key : str
+            Database key of the query image
+        roi : array_like
+            Region of interest encoded as [x, y, width, height]
+        max_results : int
+            Maximum number of matches to return. If None, all database images are returned.
+        path : str
+            Path to the query image, used as fallback
+        candidates : iterable
+            If given, only these database keys are scored
+
+        Returns
+        --------------
+        Sorted list of database matches [(key1, distance1), (key2, distance2), ...] where distance1 < distance2.
+        """
+        def bow(db):
+            try:
+                return db.bow_for_key(key, roi)
+            except KeyError:
+                if path is None:
+                    raise
+                return db.bow_for_path(path, roi)
+
+        return self._query_both(bow, max_results, candidates)
+
+    def query_image(self, image, roi, max_results=None, candidates=None):
         """Query using an image array and region of interest
 
-            Parameters
-            ---------------
-            image : np.ndarray
-                Image array
-            roi : array_like
-                Region of interest encoded as [x, y, width, height]
-
-            Returns
-            --------------
-            Sorted list of database matches [(key1, distance1), (key2, distance2), ...] where distance1 < distance2.
-            """
-        sift_matches = dict(self.sift_db.query_image(image, roi))
-        cname_matches = dict(self.cname_db.query_image(image, roi))
-        return self.combine_matches(sift_matches, cname_matches)
+        Parameters
+        ---------------
+        image : np.ndarray
+            Image array
+        roi : array_like
+            Region of interest encoded as [x, y, width, height]
+        max_results : int
+            Maximum number of matches to return. If None, all database images are returned.
+        candidates : iterable
+            If given, only these database keys are scored
+
+        Returns
+        --------------
+        Sorted list of database matches [(key1, distance1), (key2, distance2), ...] where distance1 < distance2.
+        """
+        return self._query_both(lambda db: db.bag(db.descriptors_for_image(image, roi)), max_results, candidates)
+
+    def query_paths(self, paths, rois=None, max_results=None):
+        """Query using several image paths and regions of interest
+
+        The queries are scored in chunks of :data:`QUERY_CHUNK_SIZE`, so memory use does not grow with the number of
+        queries beyond the returned matches.
+
+        Parameters
+        ---------------
+        paths : list
+            Paths to the query images
+        rois : list
+            One region of interest per path, encoded as [x, y, width, height], or None to use the whole images
+        max_results : int
+            Maximum number of matches per query. If None, all database images are returned.
+
+        Returns
+        --------------
+        List of sorted match lists [(key1, distance1), (key2, distance2), ...], one per query
+        """
+        if rois is None:
+            rois = [None] * len(paths)
+
+        def distances(db, chunk):
+            return db.distances_batch(db.bows_for_paths(paths[chunk], rois[chunk]))
+
+        matches = []
+        for chunk in _chunks(len(paths)):
+            matches.extend(self._fuse_batch(lambda: distances(self.sift_db, chunk),
+                                            lambda: distances(self.cname_db, chunk), max_results))
+        return matches
+
+    def query_descriptors_batch(self, sift_descriptors_list, cname_descriptors_list, max_results=None):
+        """Query using several precomputed sets of SIFT and colornames descriptors
+
+        The queries are scored in chunks of :data:`QUERY_CHUNK_SIZE`, so memory use does not grow with the number of
+        queries beyond the returned matches.
+
+        Parameters
+        ---------------
+        sift_descriptors_list : list
+            List of SIFT descriptor arrays, one per query
+        cname_descriptors_list : list
+            List of colornames descriptor arrays, one per query
+        max_results : int
+            Maximum number of matches per query. If None, all database images are returned.
+
+        Returns
+        --------------
+        List of sorted match lists [(key1, distance1), (key2, distance2), ...], one per query
+        """
+        if not len(sift_descriptors_list) == len(cname_descriptors_list):
+            raise DatabaseError("Got {:d} SIFT queries but {:d} colornames queries".format(
+                len(sift_descriptors_list), len(cname_descriptors_list)))
+
+        def distances(db, descriptors_list):
+            return db.distances_batch(db.bag_batch(descriptors_list))
+
+        matches = []
+        for chunk in _chunks(len(sift_descriptors_list)):
+            matches.extend(self._fuse_batch(lambda: distances(self.sift_db, sift_descriptors_list[chunk]),
+                                            lambda: distances(self.cname_db, cname_descriptors_list[chunk]),
+                                            max_results))
+        return matches
+
+    def _fuse_batch(self, sift_task, cname_task, max_results):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            sift_future = executor.submit(sift_task)
+            cname_future = executor.submit(cname_task)
+            sift_distances = sift_future.result()
+            cname_distances = cname_future.result()
+
+        return [self.fuse_distances(sd, cd, max_results) for sd, cd in zip(sift_distances, cname_distances)]
+
+    def query_progressive(self, path, roi, max_results=None, key=None, token=None, callback=None, block_size=10000,
+                          candidates=None):
+        """Query in stages, with progress reports and provisional results, that can be cancelled
+
+        The query is done in the stages 'features' (loading or computing features), 'quantization', 'scoring' and
+        'fusion'. Scoring is done in blocks of database images, and after each block the provisional best matches
+        among the images scored so far are reported. At most :data:`PROVISIONAL_RESULTS` provisional matches are
+        reported, so that the cost of each report does not grow with the number of scored images.
+
+        Parameters
+        ---------------
+        path : str
+            Path to the query image
+        roi : array_like
+            Region of interest encoded as [x, y, width, height]
+        max_results : int
+            Maximum number of matches to return. If None, all database images are returned.
+        key : str
+            If the query image is in the database, its key. The stored keypoint words are then used if available.
+        token : CancellationToken
+            Token that is checked between stages and blocks
+        callback : callable
+            Function called as `callback(progress)` with a :class:`QueryProgress` object
+        block_size : int
+            Number of database images to score per block
+        candidates : iterable
+            If given, only these database keys are scored
+
+        Returns
+        --------------
+        Sorted list of database matches [(key1, distance1), (key2, distance2), ...] where distance1 < distance2.
+
+        Raises
+        --------------
+        QueryCancelled if the token was cancelled
+        """
+        def report(stage, fraction, t0, matches=None):
+            if token is not None:
+                token.check()
+            if callback is not None:
+                callback(QueryProgress(stage, fraction, time.perf_counter() - t0, matches))
+
+        def features(db):
+            if key is not None:
+                try:
+                    return db.stored_features(key)
+                except KeyError:
+                    pass
+            return db.features_for_path(path, roi)
+
+        def bow(db):
+            if key is not None:
+                try:
+                    return db.bow_for_key(key, roi)
+                except KeyError:
+                    pass
+            return db.bow_for_path(path, roi)
+
+        dbs = (self.sift_db, self.cname_db)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            t0 = time.perf_counter()
+            report('features', 0., t0)
+            list(executor.map(features, dbs))
+            report('features', 1., t0)
+
+            t0 = time.perf_counter()
+            sift_bow, cname_bow = executor.map(bow, dbs)
+            report('quantization', 1., t0)
+
+        t0 = time.perf_counter()
+        keys = self.sift_db.key_order
+        order = self._cname_alignment()
+        sift_rows, cname_rows = self._candidate_rows(candidates)
+        num_provisional = PROVISIONAL_RESULTS if max_results is None else min(max_results, PROVISIONAL_RESULTS)
+        provisional_indices = np.zeros(0, dtype='int')
+        provisional_distances = np.zeros(0)
+        block_indices = []
+        block_distances = []
+        n = len(keys) if candidates is None else len(sift_rows)
+        for start in range(0, n, block_size):
+            block = slice(start, min(start + block_size, n))
+            if candidates is None:
+                rows = block
+                sift_distances = self.sift_db.distances(sift_bow, rows)
+                cname_distances = self.cname_db.distances(cname_bow, rows if order is None else order[rows])
+            else:
+                rows = sift_rows[block]
+                sift_distances = self.sift_db.distances(sift_bow, rows)
+                cname_distances = self.cname_db.distances(cname_bow, cname_rows[block])
+            indices, distances = fuse_min_top_k(sift_distances, cname_distances, max_results)
+            indices = indices + start if candidates is None else rows[indices]
+            block_indices.append(indices)
+            block_distances.append(distances)
+
+            # Merge the best matches of the block, which are sorted, with the provisional matches
+            provisional_indices = np.concatenate([provisional_indices, indices[:num_provisional]])
+            provisional_distances = np.concatenate([provisional_distances, distances[:num_provisional]])
+            best = top_k(provisional_distances, num_provisional)
+            provisional_indices, provisional_distances = provisional_indices[best], provisional_distances[best]
+
+            matches = [(keys[i], d) for i, d in zip(provisional_indices, provisional_distances)]
+            report('scoring', block.stop / n, t0, matches)
+
+        t0 = time.perf_counter()
+        best_indices = np.concatenate(block_indices) if block_indices else np.zeros(0, dtype='int')
+        best_distances = np.concatenate(block_distances) if block_distances else np.zeros(0)
+        best = top_k(best_distances, max_results)
+        matches = [(keys[i], d) for i, d in zip(best_indices[best], best_distances[best])]
+        report('fusion', 1., t0, matches)
+        return matches
+
+    def _query_both(self, bow_func, max_results, candidates=None):
+        # Feature loading, quantization and scoring are dominated by OpenCV, annoy and NumPy calls, which release
+        # the GIL, so the two databases are queried in parallel threads.
+        sift_rows, cname_rows = self._candidate_rows(candidates)
+
+        def distances(db, rows):
+            return db.distances(bow_func(db), rows)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            sift_future = executor.submit(distances, self.sift_db, sift_rows)
+            cname_future = executor.submit(distances, self.cname_db, cname_rows)
+            sift_distances = sift_future.result()
+            cname_distances = cname_future.result()
+
+        if candidates is None:
+            return self.fuse_distances(sift_distances, cname_distances, max_results)
+        keys = self.sift_db.key_order
+        indices, distances = fuse_min_top_k(sift_distances, cname_distances, max_results)
+        return [(keys[sift_rows[i]], d) for i, d in zip(indices, distances)]
+
+    def _candidate_rows(self, candidates):
+        """Rows of the candidate keys in the SIFT and colornames databases, in the same (SIFT) order"""
+        if candidates is None:
+            return None, None
+        sift_rows = self.sift_db.rows_for_keys(candidates)
+        order = self._cname_alignment()
+        return sift_rows, sift_rows if order is None else order[sift_rows]
+
+    def _cname_alignment(self):
+        """Index array that reorders colornames distances to the SIFT database key order"""
+        sift_keys = self.sift_db.key_order
+        cname_keys = self.cname_db.key_order
+        if self._alignment is None or not (self._alignment[0] is sift_keys and self._alignment[1] is cname_keys):
+            if sift_keys == cname_keys:
+                order = None
+            else:
+                cname_index = {key: i for i, key in enumerate(cname_keys)}
+                order = np.array([cname_index[key] for key in sift_keys], dtype='int')
+            self._alignment = (sift_keys, cname_keys, order)
+        return self._alignment[2]
+
+    def fuse_distances(self, sift_distances, cname_distances, max_results=None):
+        """Combine SIFT and colornames distance arrays into a sorted list of matches
+
+        Parameters
+        ---------------
+        sift_distances : array_like
+            Distances in the order of the SIFT database `key_order`
+        cname_distances : array_like
+            Distances in the order of the colornames database `key_order`
+        max_results : int
+            Maximum number of matches to return. If None, all database images are returned.
+
+        Returns
+        --------------
+        Sorted list of database matches [(key1, distance1), (key2, distance2), ...] where distance1 < distance2.
+        """
+        with instrumentation.timer('database.fuse'):
+            order = self._cname_alignment()
+            if order is not None:
+                cname_distances = cname_distances[order]
+            keys = self.sift_db.key_order
+            indices, distances = fuse_min_top_k(sift_distances, cname_distances, max_results)
+            return [(keys[i], d) for i, d in zip(indices, distances)]
 
     def combine_matches(self, sift_matches, cname_matches):
         """Combine SIFT and colornames matches"""
@@ -438,6 +1575,22 @@ class SiftColornamesWrapper(QueryableDatabase):
     def __getitem__(self, key):
         return self.sift_db[key], self.cname_db[key]
 
+    def update_from_files(self):
+        """Add images that are in both database files, but not in the databases
+
+        See :meth:`BagOfWordsDatabase.update_from_file`. Images that so far are only in one of the files are
+        added by a later call.
+
+        Returns
+        ----------------
+        List of added keys
+        """
+        keys = set(self.sift_db.keys_in_file()) & set(self.cname_db.keys_in_file())
+        keys = sorted(keys.difference(self.sift_db.image_vectors))
+        self.sift_db.update_from_file(keys)
+        self.cname_db.update_from_file(keys)
+        return keys
+
     def __iter__(self):
         return iter(self.sift_db)
 
@@ -451,10 +1604,14 @@ class DatabaseWithLocation(QueryableDatabase):
         super().__init__()
         self.visualdb = visualdb
         self.locations = collections.defaultdict(lambda: None)
+        self.spatial_index = SpatialIndex()
+        self._changed_locations = set()
 
     def __delitem__(self, key):
         del self.visualdb[key]
-        del self.locations[key]
+        self.locations.pop(key, None)
+        self.spatial_index.remove(key)
+        self._changed_locations.add(key)
 
     def __getitem__(self, key):
         e = DatabaseEntry(key, self.visualdb[key], self.locations[key])
@@ -466,10 +1623,222 @@ class DatabaseWithLocation(QueryableDatabase):
     def __len__(self):
         return len(self.visualdb) if self.visualdb is not None else 0
 
+    def update_from_files(self):
+        """Add new images from the database files, see :meth:`SiftColornamesWrapper.update_from_files`"""
+        return self.visualdb.update_from_files()
+
     def __setitem__(self, key, latlng):
+        self._set_location(key, latlng)
+        self._changed_locations.add(key)
+
+    def _set_location(self, key, latlng):
         self.locations[key] = latlng
+        if latlng is None:
+            self.spatial_index.remove(key)
+        else:
+            self.spatial_index.insert(key, latlng)
+
+    def set_locations(self, keys, latlngs):
+        """Set the locations of many images at once
+
+        Parameters
+        ---------------
+        keys : list
+            Database keys
+        latlngs : array_like
+            Nx2 array of (lat, lng) locations. Rows with `nan` remove the location.
+        """
+        self._set_locations(keys, latlngs)
+        self._changed_locations.update(keys)
+
+    def _set_locations(self, keys, latlngs):
+        latlngs = np.asarray(latlngs, dtype='float64').reshape(-1, 2)
+        missing = np.isnan(latlngs).any(axis=1)
+        for key, (lat, lng), is_missing in zip(keys, latlngs.tolist(), missing):
+            self._set_location(key, None if is_missing else LatLng(lat, lng))
+
+    def location_arrays(self):
+        """Keys and locations of all images that have a location
+
+        Returns
+        --------------
+        keys : list
+            Database keys
+        latlngs : np.ndarray
+            Nx2 float64 array of (lat, lng) locations
+        """
+        items = [(key, latlng) for key, latlng in self.locations.items() if latlng is not None]
+        keys = [key for key, _ in items]
+        latlngs = np.array([latlng for _, latlng in items], dtype='float64').reshape(-1, 2)
+        return keys, latlngs
+
+    @property
+    def has_unsaved_locations(self):
+        """True if locations have changed since they were last loaded or saved"""
+        return bool(self._changed_locations)
+
+    def load_locations(self, path, sidecar=False):
+        """Load locations from a CSV file with lines `key, lat, lng`
+
+        Edits in the journal of the file (see :meth:`commit_locations`) are applied after the file has been read.
+
+        Parameters
+        ---------------
+        path : str
+            Path to the CSV file
+        sidecar : bool
+            If True, the binary sidecar file is read instead of the CSV file if it is up to date,
+            and otherwise written after the CSV file has been read. The sidecar is a file next to `path`,
+            so this is off by default.
+
+        Returns
+        --------------
+        List of (path, line number) of lines that could not be parsed and were skipped
+        """
+        malformed = []
+        data = geo.read_location_sidecar(path) if sidecar else None
+        if data is None:
+            keys, latlngs, bad_lines = geo.read_location_csv(path)
+            malformed.extend((path, i) for i in bad_lines)
+            if sidecar:
+                try:
+                    geo.write_location_sidecar(path, keys, latlngs)
+                except OSError:
+                    pass # The sidecar is only a cache
+        else:
+            keys, latlngs = data
+        self._set_locations(keys, latlngs)
+
+        keys, latlngs, bad_lines = geo.read_location_journal(path)
+        malformed.extend((path + geo.JOURNAL_SUFFIX, i) for i in bad_lines)
+        self._set_locations(keys, latlngs)
+
+        self._changed_locations.clear()
+        return malformed
+
+    def save_locations(self, path, sidecar=False):
+        """Write all locations to a CSV file with lines `key, lat, lng`
+
+        The journal of the file is removed, since it is included in the new file.
+
+        Parameters
+        ---------------
+        path : str
+            Path to the CSV file
+        sidecar : bool
+            If True, the binary sidecar file is also written
+        """
+        keys, latlngs = self.location_arrays()
+        geo.write_location_csv(path, keys, latlngs)
+        geo.remove_location_journal(path)
+        if sidecar:
+            geo.write_location_sidecar(path, keys, latlngs)
+        self._changed_locations.clear()
+
+    def commit_locations(self, path, sidecar=False):
+        """Save the locations that changed since they were last loaded or saved
+
+        The changes are appended to the journal of the file, so that the whole file does not need to be rewritten.
+        When the journal has grown larger than the file itself, or if the file does not exist,
+        all locations are written with :meth:`save_locations` instead, which also writes the sidecar file
+        if `sidecar` is True.
+        """
+        journal_path = path + geo.JOURNAL_SUFFIX
+        if not os.path.exists(path) or \
+                (os.path.exists(journal_path) and os.path.getsize(journal_path) > os.path.getsize(path)):
+            self.save_locations(path, sidecar)
+            return
+
+        keys = sorted(self._changed_locations)
+        latlngs = [self.locations.get(key) or (np.nan, np.nan) for key in keys]
+        if keys:
+            geo.append_location_journal(path, keys, latlngs)
+        self._changed_locations.clear()
+
+    def _candidates(self, region):
+        # Keyword arguments that restrict visual queries to the images inside the region
+        return {} if region is None else {'candidates': self.spatial_index.in_region(region)}
+
+    def rerank_by_location(self, matches, weight=0.5, scale=100., center=None):
+        """Rerank matches by combining the visual distance with geographic proximity
+
+        The new distance is `(1 - weight) * visual_distance + weight * geo_distance`, where `geo_distance` is in [0, 1].
+        If `center` is given, `geo_distance = 1 - exp(-d / scale)` where `d` is the distance in meters to the center.
+        Otherwise the matches vote for each other: `geo_distance` is one minus the similarity-weighted fraction
+        of the other matches that are located close to the match, using a Gaussian kernel of width `scale` meters.
+        Matches without a location get `geo_distance = 1`.
+
+        Parameters
+        ---------------
+        matches : list
+            Matches [(entry1, distance1), ...] as returned by the query methods, typically the top few results
+        weight : float
+            Weight of the geographic distance, between 0 and 1
+        scale : float
+            Distance scale in meters
+        center : LatLng
+            Approximate location of the query image, if known
+
+        Returns
+        --------------
+        Sorted list of matches [(entry1, distance1), (entry2, distance2), ...] with the combined distances
+        """
+        if not matches:
+            return []
+        visual = np.array([d for _, d in matches], dtype='float')
+        latlngs = np.array([entry.latlng if entry.latlng is not None else (np.nan, np.nan) for entry, _ in matches],
+                           dtype='float')
+        has_location = ~np.isnan(latlngs[:, 0])
+        geo_distance = np.ones(len(matches))
+
+        if center is not None:
+            d = haversine_distance(center[0], center[1], latlngs[has_location, 0], latlngs[has_location, 1])
+            geo_distance[has_location] = 1 - np.exp(-d / scale)
+        elif np.count_nonzero(has_location) > 1:
+            located = latlngs[has_location]
+            d = haversine_distance(located[:, None, 0], located[:, None, 1], located[None, :, 0], located[None, :, 1])
+            similarity = np.clip(1 - visual[has_location], 0, None)
+            votes = np.exp(-(d / scale) ** 2) * similarity[None, :]
+            np.fill_diagonal(votes, 0)
+            total = similarity.sum() - similarity
+            total[total == 0] = 1
+            geo_distance[has_location] = 1 - votes.sum(axis=1) / total
+
+        fused = (1 - weight) * visual + weight * geo_distance
+        order = np.argsort(fused, kind='stable')
+        return [(matches[i][0], fused[i]) for i in order]
+
+    def keys_in_bbox(self, south, west, north, east):
+        """Keys of all images located inside a bounding box
+
+        Parameters
+        ---------------
+        south, west, north, east : float
+            Bounding box in degrees. If west > east the box crosses the antimeridian.
 
-    def query_image(self, image, roi):
+        Returns
+        --------------
+        List of keys
+        """
+        return self.spatial_index.in_bbox(south, west, north, east)
+
+    def keys_within_radius(self, latlng, radius):
+        """Keys of all images located within a distance of a point
+
+        Parameters
+        ---------------
+        latlng : LatLng
+            Center point
+        radius : float
+            Distance in meters
+
+        Returns
+        --------------
+        List of (key, distance) pairs, sorted by distance in meters
+        """
+        return self.spatial_index.within_radius(latlng, radius)
+
+    def query_image(self, image, roi, max_results=None, region=None):
         """Query using an image array and region of interest
 
         Parameters
@@ -478,16 +1847,20 @@ class DatabaseWithLocation(QueryableDatabase):
             Image array
         roi : array_like
             Region of interest encoded as [x, y, width, height]
+        max_results : int
+            Maximum number of matches to return. If None, all database images are returned.
+        region : BoundingBox or Circle
+            If given, only images located inside this region are scored
 
         Returns
         --------------
         Sorted list of database matches [(entry1, distance1), (entry2, distance2), ...] where distance1 < distance2 and entryX are :class:`DatabaseEntry` instances.
         """
-        visual_matches = self.visualdb.query_image(image, roi)
+        visual_matches = self.visualdb.query_image(image, roi, max_results, **self._candidates(region))
         matches = [(self[key], score) for key, score in visual_matches]
         return matches
 
-    def query_path(self, path, roi):
+    def query_path(self, path, roi, max_results=None, region=None):
         """Query using an image path and region of interest
 
         Parameters
@@ -496,11 +1869,90 @@ class DatabaseWithLocation(QueryableDatabase):
             Path to the query image
         roi : array_like
             Region of interest encoded as [x, y, width, height]
+        max_results : int
+            Maximum number of matches to return. If None, all database images are returned.
+        region : BoundingBox or Circle
+            If given, only images located inside this region are scored
 
         Returns
         --------------
         Sorted list of database matches [(entry1, distance1), (entry2, distance2), ...] where distance1 < distance2 and entryX are :class:`DatabaseEntry` instances.
         """
-        visual_matches = self.visualdb.query_path(path, roi)
+        visual_matches = self.visualdb.query_path(path, roi, max_results, **self._candidates(region))
         matches = [(self[key], score) for key, score in visual_matches]
-        return matches
\ No newline at end of file
+        return matches
+
+    def query_key(self, key, roi, max_results=None, path=None, region=None):
+        """Query using a database image and region of interest
+
+        Parameters
+        ---------------
+        key : str
+            Database key of the query image
+        roi : array_like
+            Region of interest encoded as [x, y, width, height]
+        max_results : int
+            Maximum number of matches to return. If None, all database images are returned.
+        path : str
+            Path to the query image, used if the database has no stored keypoint words
+        region : BoundingBox or Circle
+            If given, only images located inside this region are scored
+
+        Returns
+        --------------
+        Sorted list of database matches [(entry1, distance1), (entry2, distance2), ...] where distance1 < distance2 and entryX are :class:`DatabaseEntry` instances.
+        """
+        visual_matches = self.visualdb.query_key(key, roi, max_results, path=path, **self._candidates(region))
+        return [(self[key], score) for key, score in visual_matches]
+
+    def query_paths(self, paths, rois=None, max_results=None):
+        """Query using several image paths and regions of interest
+
+        The queries are scored in chunks of :data:`QUERY_CHUNK_SIZE`, so memory use does not grow with the number of
+        queries beyond the returned matches.
+
+        Parameters
+        ---------------
+        paths : list
+            Paths to the query images
+        rois : list
+            One region of interest per path, encoded as [x, y, width, height], or None to use the whole images
+        max_results : int
+            Maximum number of matches per query. If None, all database images are returned.
+
+        Returns
+        --------------
+        List of sorted match lists [(entry1, distance1), (entry2, distance2), ...], one per query
+        """
+        return [[(self[key], score) for key, score in visual_matches]
+                for visual_matches in self.visualdb.query_paths(paths, rois, max_results)]
+
+    def query_descriptors_batch(self, *descriptors_lists, max_results=None):
+        """Query using several precomputed sets of descriptors
+
+        The descriptor lists are passed on to the `query_descriptors_batch` method of the visual database.
+
+        Returns
+        --------------
+        List of sorted match lists [(entry1, distance1), (entry2, distance2), ...], one per query
+        """
+        return [[(self[key], score) for key, score in visual_matches]
+                for visual_matches in self.visualdb.query_descriptors_batch(*descriptors_lists, max_results=max_results)]
+
+    def query_progressive(self, path, roi, max_results=None, key=None, token=None, callback=None, region=None,
+                          **kwargs):
+        """Query in stages, with progress reports and provisional results, that can be cancelled
+
+        See :meth:`SiftColornamesWrapper.query_progressive`. The provisional matches reported to `callback`,
+        and the returned matches, are lists of (:class:`DatabaseEntry`, distance) pairs.
+        If `region` is given, only images located inside it are scored.
+        """
+        def entry_callback(progress):
+            if progress.matches is not None:
+                progress = progress._replace(matches=[(self[k], score) for k, score in progress.matches])
+            callback(progress)
+
+        visual_matches = self.visualdb.query_progressive(path, roi, max_results, key=key, token=token,
+                                                         callback=entry_callback if callback is not None else None,
+                                                         **self._candidates(region), **kwargs)
+        return [(self[key], score) for key, score in visual_matches]
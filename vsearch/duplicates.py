@@ -0,0 +1,275 @@
+# Copyright 2017 Hannes Ovrén
+#
+# This file is part of vsearch.
+#
+# vsearch is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# vsearch is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with vsearch.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Database-wide near-duplicate detection
+
+Every image in a Bag of Words database is compared to every other image by computing the product of the sparse
+TF-IDF matrix with itself. The product is computed in blocks of rows, so that only a bounded part of the
+(potentially dense) similarity matrix exists at any time, and the blocks are spread over a process pool.
+"""
+
+import collections
+import csv
+import multiprocessing
+
+import numpy as np
+
+from .database import database_keys, dataset_name
+from .lazy import lazy_import
+from .shared import SharedArrays, attach_arrays
+
+h5py = lazy_import('h5py')
+sparse = lazy_import('scipy.sparse')
+
+_worker_matrix = None
+
+
+def load_bow_matrix(database_file):
+    """Load all BoW vectors of a database file into a sparse matrix
+
+    The vectors are read one at a time, so memory use is proportional to the number of non-zero elements.
+
+    Parameters
+    --------------
+    database_file : str
+        Path to a database file created by `vsearch_database`
+
+    Returns
+    --------------
+    keys : list
+        Database keys, one per row
+    counts : scipy.sparse.csr_matrix
+        NxK matrix of raw word frequencies
+    """
+    keys = []
+    indptr = [0]
+    indices = []
+    data = []
+    with h5py.File(database_file, 'r') as f:
+        vocabulary_size = f['vocabulary'].shape[0]
+        for key in database_keys(f):
+            bow = f[dataset_name(key)][()]
+            words = np.flatnonzero(bow)
+            keys.append(key)
+            indices.append(words)
+            data.append(bow[words])
+            indptr.append(indptr[-1] + len(words))
+
+    data = np.concatenate(data).astype('float64') if data else np.zeros(0)
+    indices = np.concatenate(indices) if indices else np.zeros(0, dtype='int')
+    counts = sparse.csr_matrix((data, indices, indptr), shape=(len(keys), vocabulary_size))
+    return keys, counts
+
+
+def tfidf_normalize(counts):
+    """Row-normalized TF-IDF matrix from a matrix of word frequencies
+
+    The IDF weights are the same as those used by :class:`vsearch.database.BagOfWordsDatabase`.
+    """
+    word_counts = np.asarray((counts > 0).sum(axis=0)).ravel()
+    idf = np.log(counts.shape[0] / (1 + word_counts).astype('float'))
+    tfidf = counts.dot(sparse.diags(idf)).tocsr()
+    norms = np.sqrt(np.asarray(tfidf.multiply(tfidf).sum(axis=1)).ravel())
+    norms[norms == 0] = 1
+    return sparse.diags(1 / norms).dot(tfidf).tocsr()
+
+
+def similar_rows(matrix, start, stop, threshold, top_k=None):
+    """Find the most similar other rows for a block of rows
+
+    Parameters
+    --------------
+    matrix : scipy.sparse.csr_matrix
+        Row-normalized TF-IDF matrix
+    start, stop : int
+        The block of rows, [start, stop), to find similar rows for
+    threshold : float
+        Minimum cosine similarity
+    top_k : int
+        Maximum number of similar rows to keep per row. If None, all rows above the threshold are kept.
+
+    Returns
+    --------------
+    rows, cols : array_like
+        Row indices of the pairs
+    similarities : array_like
+        Cosine similarity of the pairs
+    """
+    block = matrix[start:stop].dot(matrix.T).tocsr()
+    result_rows = []
+    result_cols = []
+    result_sims = []
+    for i in range(block.shape[0]):
+        row = start + i
+        lo, hi = block.indptr[i], block.indptr[i + 1]
+        cols = block.indices[lo:hi]
+        sims = block.data[lo:hi]
+        valid = (sims >= threshold) & (cols != row)
+        cols = cols[valid]
+        sims = sims[valid]
+        if top_k is not None and len(sims) > top_k:
+            best = np.argpartition(-sims, top_k)[:top_k]
+            cols = cols[best]
+            sims = sims[best]
+        order = np.argsort(-sims, kind='stable')
+        result_rows.append(np.full(len(order), row, dtype='int'))
+        result_cols.append(cols[order])
+        result_sims.append(sims[order])
+
+    if not result_rows:
+        return np.zeros(0, dtype='int'), np.zeros(0, dtype='int'), np.zeros(0)
+    return np.concatenate(result_rows), np.concatenate(result_cols), np.concatenate(result_sims)
+
+
+def _init_worker(specs, shape):
+    global _worker_matrix
+    arrays = attach_arrays(specs)
+    _worker_matrix = sparse.csr_matrix((arrays['data'], arrays['indices'], arrays['indptr']), shape=shape,
+                                       copy=False)
+
+
+def _block_worker(args):
+    start, stop, threshold, top_k = args
+    return similar_rows(_worker_matrix, start, stop, threshold, top_k)
+
+
+def find_near_duplicates(keys, matrix, threshold=0.8, top_k=10, block_size=256, nproc=None):
+    """Find near-duplicate pairs among all database images
+
+    The `top_k` most similar images of each image are taken from all other images. A pair that both of its images
+    find is reported once, and every pair has `key1` before `key2` in database order.
+
+    Parameters
+    --------------
+    keys : list
+        Database keys, one per row of `matrix`
+    matrix : scipy.sparse.csr_matrix
+        Row-normalized TF-IDF matrix, as returned by :func:`tfidf_normalize`
+    threshold : float
+        Minimum cosine similarity for a pair to be reported
+    top_k : int
+        Maximum number of most similar images to take per image. If None, all pairs above the threshold are reported.
+    block_size : int
+        Number of rows to process at a time. Bounds the size of each partial similarity matrix.
+    nproc : int
+        Number of processes to use. If None, the number of CPU cores is used. If 1, no process pool is created.
+        At most two blocks per process are in flight, so results are not queued faster than they are consumed.
+
+    Yields
+    --------------
+    List of (key1, key2, similarity) tuples for each block of rows, in row order
+    """
+    tasks = [(start, min(start + block_size, len(keys)), threshold, top_k)
+             for start in range(0, len(keys), block_size)]
+
+    # The most similar images of each image, to tell whether a pair was already found from its earlier image.
+    # Blocks are handled in row order, so the earlier image of a pair has always been handled.
+    neighbours = np.full((len(keys), top_k), -1, dtype='int32') if top_k is not None else None
+
+    def to_pairs(result):
+        rows, cols, sims = result
+        if neighbours is None:
+            # Without a top k, both images of a pair find each other
+            keep = cols > rows
+        else:
+            # The rows are sorted, so this is the position of each pair among the pairs of its row
+            position = np.arange(len(rows)) - np.searchsorted(rows, rows)
+            neighbours[rows, position] = cols
+            earlier = np.flatnonzero(cols < rows)
+            keep = np.ones(len(rows), dtype='bool')
+            keep[earlier] = ~np.any(neighbours[cols[earlier]] == rows[earlier, None], axis=1)
+        first = np.minimum(rows, cols)[keep]
+        second = np.maximum(rows, cols)[keep]
+        return [(keys[i], keys[j], s) for i, j, s in zip(first, second, sims[keep])]
+
+    if nproc == 1:
+        for start, stop, threshold, top_k in tasks:
+            yield to_pairs(similar_rows(matrix, start, stop, threshold, top_k))
+    else:
+        # The matrix is shared with the workers instead of being pickled to each of them
+        arrays = {'data': matrix.data, 'indices': matrix.indices, 'indptr': matrix.indptr}
+        max_pending = 2 * (nproc or multiprocessing.cpu_count())
+        pending = collections.deque()
+        with SharedArrays(arrays) as shared, \
+                multiprocessing.Pool(processes=nproc, initializer=_init_worker,
+                                     initargs=(shared.specs, matrix.shape)) as pool:
+            for task in tasks:
+                pending.append(pool.apply_async(_block_worker, (task,)))
+                if len(pending) >= max_pending:
+                    yield to_pairs(pending.popleft().get())
+            while pending:
+                yield to_pairs(pending.popleft().get())
+
+
+class CsvPairWriter:
+    """Write near-duplicate pairs to a CSV file with rows `key1,key2,similarity`
+
+    Keys that contain commas or quotes are quoted.
+    """
+    def __init__(self, path):
+        self.file = open(path, 'w', newline='')
+        self.writer = csv.writer(self.file)
+
+    def write(self, pairs):
+        self.writer.writerows((key1, key2, '{:f}'.format(similarity)) for key1, key2, similarity in pairs)
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class Hdf5PairWriter:
+    """Write near-duplicate pairs to resizable `key1`, `key2` and `similarity` datasets of a HDF5 file"""
+    def __init__(self, path):
+        self.file = h5py.File(path, 'w')
+        string_dtype = h5py.special_dtype(vlen=str)
+        self.datasets = [self.file.create_dataset(name, shape=(0,), maxshape=(None,), dtype=dtype, chunks=True)
+                         for name, dtype in (('key1', string_dtype), ('key2', string_dtype),
+                                             ('similarity', 'float64'))]
+
+    def write(self, pairs):
+        if not pairs:
+            return
+        columns = list(zip(*pairs))
+        for dataset, column in zip(self.datasets, columns):
+            n = dataset.shape[0]
+            dataset.resize((n + len(column),))
+            dataset[n:] = column
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def pair_writer(path):
+    """Return a CSV or HDF5 pair writer, depending on the file extension"""
+    if path.endswith('.h5') or path.endswith('.hdf5'):
+        return Hdf5PairWriter(path)
+    else:
+        return CsvPairWriter(path)
@@ -0,0 +1,215 @@
+# Copyright 2017 Hannes Ovrén
+#
+# This file is part of vsearch.
+#
+# vsearch is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# vsearch is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with vsearch.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Retrieval quality and query latency evaluation
+
+Ground truth is a dict from query key to the set of relevant database keys. It can be derived from image locations,
+where all images within some radius of the query are relevant, or read from a file with lines
+`query_key, relevant_key_1, relevant_key_2, ...`.
+
+:func:`evaluate` runs batched queries against a Bag of Words database, and reports mean average precision and
+recall at k, next to the query latency percentiles and throughput. Comparing these between database configurations
+(e.g. vocabulary size, number of annoy trees or stop words) shows what retrieval quality is traded for speed.
+
+:func:`document_frequency_report` describes how the visual words are spread over the database images, which shows
+how much of the scoring cost comes from the most frequent words.
+"""
+
+import time
+
+import numpy as np
+
+from .database import AnnDatabase
+from .geo import SpatialIndex
+
+
+def ground_truth_from_locations(keys, latlngs, radius):
+    """Ground truth where all images within a radius of the query image are relevant
+
+    Parameters
+    -------------
+    keys : list
+        Image keys
+    latlngs : array_like
+        Nx2 array of (lat, lng) locations of the images
+    radius : float
+        Distance in meters
+
+    Returns
+    -------------
+    dict from each key to the set of other keys within the radius. Keys without any neighbours are left out.
+    """
+    index = SpatialIndex()
+    for key, latlng in zip(keys, latlngs):
+        index.insert(key, latlng)
+    ground_truth = {}
+    for key, latlng in zip(keys, latlngs):
+        relevant = {other for other, _ in index.within_radius(latlng, radius) if other != key}
+        if relevant:
+            ground_truth[key] = relevant
+    return ground_truth
+
+
+def read_ground_truth(path):
+    """Read a ground truth file with lines `query_key, relevant_key_1, relevant_key_2, ...`"""
+    ground_truth = {}
+    with open(path, 'r') as f:
+        for line in f:
+            query, *relevant = [part.strip() for part in line.split(',')]
+            if query:
+                ground_truth.setdefault(query, set()).update(key for key in relevant if key)
+    return ground_truth
+
+
+def average_precision(ranked_keys, relevant):
+    """Average precision of a ranked list of keys
+
+    The precision at each relevant key in the list is averaged over all relevant keys, such that relevant keys that
+    are not in the (possibly truncated) list count as zero precision.
+    """
+    if not relevant:
+        return 0.
+    hits = 0
+    precision_sum = 0.
+    for rank, key in enumerate(ranked_keys, start=1):
+        if key in relevant:
+            hits += 1
+            precision_sum += hits / rank
+    return precision_sum / len(relevant)
+
+
+def recall_at_k(ranked_keys, relevant, k):
+    """Fraction of the relevant keys that are among the first k keys of the ranked list"""
+    if not relevant:
+        return 0.
+    return len(relevant.intersection(ranked_keys[:k])) / len(relevant)
+
+
+def with_n_trees(database, n_trees, vocabulary=None):
+    """Copy of an :class:`vsearch.database.AnnDatabase` with another number of annoy trees
+
+    The stored BoW vectors are kept, so only the quantization of queries is affected.
+    If the vocabulary is not given, it is read back from the annoy index of the database.
+    """
+    if vocabulary is None:
+        vocabulary = np.array([database.annoy_index.get_item_vector(i) for i in range(database.vocabulary_size)],
+                              dtype='float32')
+    copy = AnnDatabase(vocabulary, n_trees)
+    copy.add_images((key, database[key]) for key in database.key_order)
+    return copy
+
+
+def document_frequency_report(database, fractions=(0.001, 0.01, 0.05, 0.1), percentiles=(50, 90, 99, 100)):
+    """Document frequency distribution of the visual words of a database
+
+    The scoring cost is proportional to the number of postings, i.e. the number of (image, word) pairs where the
+    word is in the image. The report shows how many of those the most frequent words account for, which is what
+    :meth:`vsearch.database.BagOfWordsDatabase.set_stop_words` with the same fraction would remove.
+
+    Parameters
+    -------------
+    database : BagOfWordsDatabase
+        The database
+    fractions : tuple
+        Fractions of the vocabulary to report, taking the most frequent words first
+    percentiles : tuple
+        Percentiles of the document frequency of the words that are used by any image
+
+    Returns
+    -------------
+    dict with keys 'images', 'vocabulary_size', 'unused_words', 'postings', 'df_percentiles' (dict from percentile to
+    document frequency) and 'top', a list with one dict per fraction with keys 'fraction', 'words', 'min_df' (lowest
+    document frequency of the words), 'max_idf' and 'postings_share' (fraction of all postings)
+    """
+    word_counts = np.asarray(database._word_counts)
+    n_images = len(database)
+    df = database.document_frequencies()
+    used = np.flatnonzero(word_counts > 0)
+    order = used[np.argsort(-word_counts[used], kind='stable')]
+    postings = int(word_counts.sum())
+
+    report = {'images': n_images, 'vocabulary_size': database.vocabulary_size,
+              'unused_words': database.vocabulary_size - len(used), 'postings': postings,
+              'df_percentiles': {p: float(np.percentile(df[used], p)) if len(used) else 0. for p in percentiles},
+              'top': []}
+    for fraction in fractions:
+        top = order[:int(round(fraction * database.vocabulary_size))]
+        min_df = float(df[top].min()) if len(top) else 0.
+        report['top'].append({'fraction': fraction, 'words': len(top), 'min_df': min_df,
+                              'max_idf': float(np.log(n_images / (1 + word_counts[top].min()))) if len(top) else 0.,
+                              'postings_share': float(word_counts[top].sum() / postings) if postings else 0.})
+    return report
+
+
+def evaluate(database, queries, ground_truth, ks=(1, 5, 10), max_results=100, batch_size=16, exclude_query=True):
+    """Evaluate retrieval quality and query latency
+
+    Parameters
+    -------------
+    database : BagOfWordsDatabase
+        The database to query
+    queries : list
+        List of (query_key, query) pairs, where query is a BoW vector or an NxD array of descriptors.
+        Descriptors are bagged as part of the timed query.
+    ground_truth : dict
+        Map from query key to the set of relevant database keys
+    ks : tuple
+        Values of k for recall at k
+    max_results : int
+        Length of the ranked match lists. Average precision only counts relevant keys within this length.
+    batch_size : int
+        Number of queries scored together
+    exclude_query : bool
+        Remove the query key from its match list, for queries that are also database images
+
+    Returns
+    -------------
+    dict with keys 'queries', 'mAP', 'recall@k' for each k, 'latency_p50' and 'latency_p95' (seconds per batch,
+    which is the time a query waits for its results) and 'queries_per_second'
+    """
+    queries = [(key, query) for key, query in queries if ground_truth.get(key)]
+    if not queries:
+        raise ValueError("None of the queries have any relevant keys in the ground truth")
+
+    n_results = max_results + 1 if exclude_query else max_results
+    latencies = []
+    ranked = []
+    t_start = time.perf_counter()
+    for start in range(0, len(queries), batch_size):
+        batch = queries[start:start + batch_size]
+        t0 = time.perf_counter()
+        bows = [query if np.ndim(query) == 1 else database.bag(query) for _, query in batch]
+        results = database.top_k_batch(bows, n_results)
+        latencies.append(time.perf_counter() - t0)
+        keys = database.key_order
+        for (query_key, _), (indices, _) in zip(batch, results):
+            matches = [keys[i] for i in indices]
+            if exclude_query:
+                matches = [key for key in matches if key != query_key]
+            ranked.append(matches[:max_results])
+    total = time.perf_counter() - t_start
+
+    metrics = {'queries': len(queries),
+               'mAP': float(np.mean([average_precision(matches, ground_truth[key])
+                                     for (key, _), matches in zip(queries, ranked)]))}
+    for k in ks:
+        metrics['recall@{:d}'.format(k)] = float(np.mean([recall_at_k(matches, ground_truth[key], k)
+                                                           for (key, _), matches in zip(queries, ranked)]))
+    metrics['latency_p50'] = float(np.percentile(latencies, 50))
+    metrics['latency_p95'] = float(np.percentile(latencies, 95))
+    metrics['queries_per_second'] = len(queries) / total
+    return metrics
@@ -0,0 +1,332 @@
+# Copyright 2017 Hannes Ovrén
+#
+# This file is part of vsearch.
+#
+# vsearch is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# vsearch is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with vsearch.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Geographic distances, a spatial index over image locations, and location file input/output
+
+Locations are stored in CSV files with lines `key, lat, lng`.
+Reading large CSV files is slow, so a binary sidecar file with the same contents can be written next to it.
+Edits are appended to a journal file instead of rewriting the whole CSV file. A location of `nan, nan` in the
+journal means that the location was removed.
+"""
+
+import collections
+import math
+import os
+
+import numpy as np
+
+EARTH_RADIUS = 6371008.8  # Mean earth radius in meters
+
+METERS_PER_DEGREE = EARTH_RADIUS * math.pi / 180
+
+
+BoundingBox = collections.namedtuple('BoundingBox', 'south west north east')
+"""Geographic region between two latitudes and two longitudes, in degrees
+
+If west > east the box crosses the antimeridian.
+"""
+
+Circle = collections.namedtuple('Circle', 'center radius')
+"""Geographic region within `radius` meters of the `center` (lat, lng) point"""
+
+
+def haversine_distance(lat1, lng1, lat2, lng2):
+    """Great circle distance in meters between points given in degrees
+
+    The arguments can be scalars or arrays that broadcast against each other.
+    """
+    lat1, lng1, lat2, lng2 = (np.radians(x) for x in (lat1, lng1, lat2, lng2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def radius_bbox(lat, lng, radius):
+    """Bounding box (south, west, north, east) in degrees of all points within radius meters of (lat, lng)"""
+    dlat = radius / METERS_PER_DEGREE
+    south, north = max(lat - dlat, -90.), min(lat + dlat, 90.)
+    coslat = min(math.cos(math.radians(south)), math.cos(math.radians(north)))
+    if coslat <= 1e-12 or dlat / coslat >= 180:
+        return south, -180., north, 180.
+    dlng = dlat / coslat
+    return south, _wrap_lng(lng - dlng), north, _wrap_lng(lng + dlng)
+
+
+def _wrap_lng(lng):
+    return (lng + 180.) % 360. - 180. if not -180. <= lng <= 180. else lng
+
+
+class SpatialIndex:
+    """Grid index over (lat, lng) locations
+
+    Locations are stored in square grid cells of `cell_size` degrees, such that bounding box and radius
+    queries only need to look at the cells that overlap the query region.
+    """
+    def __init__(self, cell_size=0.01):
+        """Create an empty index
+
+        Parameters
+        -------------
+        cell_size : float
+            Size of the grid cells in degrees. The default of 0.01 degrees is roughly 1 km.
+        """
+        self.cell_size = cell_size
+        self._cells = collections.defaultdict(dict)
+        self._cell_of_key = {}
+
+    def __len__(self):
+        return len(self._cell_of_key)
+
+    def __contains__(self, key):
+        return key in self._cell_of_key
+
+    def _cell(self, lat, lng):
+        return int(math.floor(lat / self.cell_size)), int(math.floor(lng / self.cell_size))
+
+    def insert(self, key, latlng):
+        """Insert or move a location"""
+        self.remove(key)
+        lat, lng = float(latlng[0]), float(latlng[1])
+        cell = self._cell(lat, lng)
+        self._cells[cell][key] = (lat, lng)
+        self._cell_of_key[key] = cell
+
+    def remove(self, key):
+        """Remove a location, if it is in the index"""
+        cell = self._cell_of_key.pop(key, None)
+        if cell is not None:
+            items = self._cells[cell]
+            del items[key]
+            if not items:
+                del self._cells[cell]
+
+    def clear(self):
+        self._cells.clear()
+        self._cell_of_key.clear()
+
+    def _cells_in_bbox(self, south, west, north, east):
+        row0, col0 = self._cell(south, west)
+        row1, col1 = self._cell(north, east)
+        n_cells = (row1 - row0 + 1) * (col1 - col0 + 1)
+        if n_cells > len(self._cells):
+            # Large regions: it is cheaper to look at the occupied cells only
+            return [items for (row, col), items in self._cells.items() if row0 <= row <= row1 and col0 <= col <= col1]
+        else:
+            return [self._cells[cell] for cell in ((row, col)
+                                                   for row in range(row0, row1 + 1)
+                                                   for col in range(col0, col1 + 1)) if cell in self._cells]
+
+    def _candidates(self, south, west, north, east):
+        if west > east:
+            # Crosses the antimeridian
+            return self._candidates(south, west, north, 180.) + self._candidates(south, -180., north, east)
+        keys = []
+        latlngs = []
+        for items in self._cells_in_bbox(south, west, north, east):
+            keys.extend(items.keys())
+            latlngs.extend(items.values())
+        if not keys:
+            return []
+        latlngs = np.array(latlngs)
+        inside = ((latlngs[:, 0] >= south) & (latlngs[:, 0] <= north) &
+                  (latlngs[:, 1] >= west) & (latlngs[:, 1] <= east))
+        return [(keys[i], latlngs[i]) for i in np.flatnonzero(inside)]
+
+    def in_bbox(self, south, west, north, east):
+        """Keys of all locations inside a bounding box
+
+        Parameters
+        -------------
+        south, west, north, east : float
+            Bounding box in degrees, in the order returned by :meth:`vsearch.gui.LeafletWidget.getBounds`.
+            If west > east the box crosses the antimeridian.
+
+        Returns
+        -------------
+        List of keys
+        """
+        return [key for key, _ in self._candidates(south, west, north, east)]
+
+    def within_radius(self, latlng, radius):
+        """Keys of all locations within a distance of a point
+
+        Parameters
+        -------------
+        latlng : tuple
+            Center point (lat, lng) in degrees
+        radius : float
+            Distance in meters
+
+        Returns
+        -------------
+        List of (key, distance) pairs, sorted by distance in meters
+        """
+        lat, lng = float(latlng[0]), float(latlng[1])
+        candidates = self._candidates(*radius_bbox(lat, lng, radius))
+        if not candidates:
+            return []
+        keys, latlngs = zip(*candidates)
+        latlngs = np.array(latlngs)
+        distances = haversine_distance(lat, lng, latlngs[:, 0], latlngs[:, 1])
+        order = np.argsort(distances, kind='stable')
+        return [(keys[i], float(distances[i])) for i in order if distances[i] <= radius]
+
+    def in_region(self, region):
+        """Keys of all locations inside a :class:`BoundingBox` or :class:`Circle` region"""
+        if isinstance(region, Circle):
+            return [key for key, _ in self.within_radius(region.center, region.radius)]
+        elif isinstance(region, BoundingBox):
+            return self.in_bbox(*region)
+        else:
+            raise TypeError("Expected a BoundingBox or Circle region, got {!r}".format(region))
+
+
+SIDECAR_SUFFIX = '.npz'
+JOURNAL_SUFFIX = '.journal'
+
+
+def _parse_location_lines(lines):
+    """Parse `key, lat, lng` lines
+
+    Returns
+    -------------
+    keys : list
+        Keys of the valid lines
+    latlngs : np.ndarray
+        Nx2 float64 array of locations
+    malformed : list
+        Line numbers (starting at 1) of malformed lines
+    """
+    numbers = []
+    fields = []
+    malformed = []
+    for i, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        parts = line.split(',')
+        if len(parts) == 3:
+            numbers.append(i)
+            fields.append(parts)
+        else:
+            malformed.append(i)
+
+    if not fields:
+        return [], np.zeros((0, 2)), malformed
+
+    fields = np.char.strip(np.array(fields))
+    try:
+        latlngs = fields[:, 1:].astype('float64')
+    except ValueError:
+        # Slow path: find the lines with invalid numbers
+        valid = np.ones(len(fields), dtype='bool')
+        for j, (lat, lng) in enumerate(fields[:, 1:]):
+            try:
+                float(lat), float(lng)
+            except ValueError:
+                valid[j] = False
+                malformed.append(numbers[j])
+        fields = fields[valid]
+        latlngs = fields[:, 1:].astype('float64')
+        malformed.sort()
+
+    return fields[:, 0].tolist(), latlngs.reshape(-1, 2), malformed
+
+
+def _format_location_lines(keys, latlngs):
+    return ''.join('{:s}, {:f}, {:f}\n'.format(key, lat, lng) for key, (lat, lng) in zip(keys, latlngs))
+
+
+def read_location_csv(path):
+    """Read a location CSV file
+
+    Parameters
+    -------------
+    path : str
+        Path to a file with lines `key, lat, lng`
+
+    Returns
+    -------------
+    keys : list
+        Keys of the valid lines
+    latlngs : np.ndarray
+        Nx2 float64 array of locations
+    malformed : list
+        Line numbers (starting at 1) of lines that could not be parsed
+    """
+    with open(path, 'r') as f:
+        return _parse_location_lines(f.read().splitlines())
+
+
+def write_location_csv(path, keys, latlngs):
+    """Write locations to a CSV file with lines `key, lat, lng`
+
+    The file is written to a temporary file first, and then moved in place.
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(_format_location_lines(keys, latlngs))
+    os.replace(tmp_path, path)
+
+
+def read_location_sidecar(path):
+    """Read the binary sidecar of a location CSV file
+
+    Returns
+    -------------
+    (keys, latlngs) if the sidecar exists and is at least as new as the CSV file, otherwise None
+    """
+    sidecar_path = path + SIDECAR_SUFFIX
+    try:
+        if os.path.exists(path) and os.stat(sidecar_path).st_mtime_ns < os.stat(path).st_mtime_ns:
+            return None
+        with np.load(sidecar_path) as data:
+            return data['keys'].tolist(), data['latlngs'].astype('float64')
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def write_location_sidecar(path, keys, latlngs):
+    """Write the binary sidecar of a location CSV file: an array of keys and an Nx2 float64 array of locations"""
+    sidecar_path = path + SIDECAR_SUFFIX
+    tmp_path = sidecar_path + '.tmp.npz'
+    np.savez(tmp_path, keys=np.array(keys, dtype='U'), latlngs=np.asarray(latlngs, dtype='float64').reshape(-1, 2))
+    os.replace(tmp_path, sidecar_path)
+
+
+def read_location_journal(path):
+    """Read the journal of edits of a location CSV file
+
+    Returns
+    -------------
+    keys, latlngs, malformed
+        As for :func:`read_location_csv`. Removed locations are `nan`. If there is no journal, the lists are empty.
+    """
+    journal_path = path + JOURNAL_SUFFIX
+    if not os.path.exists(journal_path):
+        return [], np.zeros((0, 2)), []
+    return read_location_csv(journal_path)
+
+
+def append_location_journal(path, keys, latlngs):
+    """Append edits to the journal of a location CSV file. Use `nan` locations for removed locations."""
+    with open(path + JOURNAL_SUFFIX, 'a') as f:
+        f.write(_format_location_lines(keys, latlngs))
+
+
+def remove_location_journal(path):
+    journal_path = path + JOURNAL_SUFFIX
+    if os.path.exists(journal_path):
+        os.remove(journal_path)
@@ -1,2 +1,3 @@
 from .image import ImageWidget, ImageWithROI
 from .leaflet import LeafletWidget, LeafletMarker
+from .preview import PreviewLoader
@@ -27,6 +27,8 @@ class ImageWidget(QLabel):
     def __init__(self, parent=None):
         super().__init__(parent)
         self.image_array = None
+        self._pixmap = None
+        self._scaled_size = None
         self.setSizePolicy(QSizePolicy.MinimumExpanding, QSizePolicy.MinimumExpanding)
         self.setAlignment(QtCore.Qt.AlignHCenter | QtCore.Qt.AlignVCenter)
 
@@ -49,19 +51,29 @@ class ImageWidget(QLabel):
 
     def set_array(self, array):
         self.image_array = array
+        if array is None:
+            self._pixmap = None
+        else:
+            # Convert once, such that resizing only needs to rescale the pixmap
+            array = np.ascontiguousarray(array)
+            height, width, channels = array.shape
+            assert channels == 3
+            bytes_per_line = channels * width
+            qt_image = QImage(array.data, width, height, bytes_per_line, QImage.Format_RGB888)
+            self._pixmap = QPixmap.fromImage(qt_image)
+        self._scaled_size = None
         self.update_image()
 
     def update_image(self):
-        if self.image_array is None:
+        if self._pixmap is None:
             self.clear()
             return
 
-        height, width, channels = self.image_array.shape
-        assert channels == 3
-        bytes_per_line = channels * width
-        qt_image = QImage(self.image_array.data, width, height, bytes_per_line, QImage.Format_RGB888)
-        pix = QPixmap(qt_image)
-        self.setPixmap(pix.scaled(self.size(), QtCore.Qt.KeepAspectRatio | QtCore.Qt.SmoothTransformation))
+        target = self._pixmap.size().scaled(self.size(), QtCore.Qt.KeepAspectRatio)
+        if target == self._scaled_size:
+            return
+        self._scaled_size = target
+        self.setPixmap(self._pixmap.scaled(target, QtCore.Qt.IgnoreAspectRatio, QtCore.Qt.SmoothTransformation))
 
     def map_to_image(self, widget_point):
         pix = self.pixmap()
@@ -15,6 +15,7 @@
 # You should have received a copy of the GNU General Public License
 # along with vsearch.  If not, see <http://www.gnu.org/licenses/>.
 
+import json
 import os
 
 from PyQt5.QtWebKitWidgets import QWebView
@@ -25,12 +26,13 @@ MAP_HTML = os.path.join(RESOURCE_DIR, 'map.html')
 MAP_JS = os.path.join(RESOURCE_DIR, 'map.js')
 
 class LeafletMarker:
-    def __init__(self, id, widget):
+    def __init__(self, id, widget, latlng=None):
         self.id = id
         self.map_widget = widget
+        self._latlng = latlng
 
     def __repr__(self):
-        return '<LeafletMarker id={:d} widget={}>'.format(self.id, self.map_widget)
+        return '<LeafletMarker id={} widget={}>'.format(self.id, self.map_widget)
 
     def get_property(self, property):
         js_fmt = "marker_dict[{:d}].{:s};"
@@ -39,32 +41,28 @@ class LeafletMarker:
 
     @property
     def latlng(self):
-        res = self.get_property('getLatLng()')
-        return res['lat'], res['lng']
+        """Marker position, from the Python side cache which is updated when a marker is moved"""
+        if self._latlng is None:
+            res = self.get_property('getLatLng()')
+            self._latlng = (res['lat'], res['lng'])
+        return self._latlng
 
     def object_call(self, js_method, return_value=True):
         js = 'marker_dict[{:d}].'.format(self.id) + js_method
         return self.map_widget.run_js(js, return_value=return_value)
 
     def remove(self, update=True):
-        js = "marker_dict[{id:d}].remove(); delete marker_dict[{id:d}];".format(id=self.id)
-        self.map_widget.run_js(js)
-
-        if update:
-            self.map_widget.on_marker_removed(self.id)
-            self.map_widget.update()
-
-        self.id = None
+        self.map_widget.remove_markers([self], update=update)
 
     def setDraggable(self, draggable):
-        if draggable:
-            self.object_call('dragging.enable();'.format(draggable), return_value=False)
-        else:
-            self.object_call('dragging.disable();'.format(draggable), return_value=False)
+        self.map_widget.set_markers_draggable([self], draggable)
 
     def setOpacity(self, opacity):
         self.object_call("setOpacity({:f});".format(opacity), return_value=False)
 
+    def setLatLng(self, lat, lng):
+        self.map_widget.move_markers({self: (lat, lng)})
+
     @classmethod
     def create_js(cls, lat, lng):
         js_fmt = """L.marker([{lat}, {lng}])"""
@@ -72,31 +70,16 @@ class LeafletMarker:
 
     @classmethod
     def add_to_map(cls, map_widget, latlng_list):
-        statements = ["var ids = [];"]
-        for lat, lng in latlng_list:
-            statements.append("var marker = " + cls.create_js(lat, lng) + ";")
-            statements.append("marker.addTo(mymap);")
-            statements.append("marker.on('click', onMarkerClicked);")
-            statements.append("marker.on('moveend', onMarkerMoveEnded);")
-            statements.append("var id = L.stamp(marker);")
-            statements.append("marker_dict[id] = marker;")
-            statements.append("ids.push(id);")
-        statements.append("ids")
-
-        js = "\n".join(statements)
-        marker_ids = map_widget.run_js(js)
-
-        markers = [cls(int(mid), map_widget) for mid in marker_ids]
-        map_widget.markers.update({m.id: m for m in markers})
-
-        return markers
+        return map_widget.add_markers(latlng_list)
 
 class LeafletWidget(QWebView):
 
     onMove = pyqtSignal()
+    onMoveEnd = pyqtSignal()  # Emitted once when panning or zooming has finished
     onClick = pyqtSignal(float, float)
     onMarkerClicked = pyqtSignal(int)
     onMarkerMoved = pyqtSignal(int)
+    mapReady = pyqtSignal()
 
     next_marker_id = 0
 
@@ -105,6 +88,7 @@ class LeafletWidget(QWebView):
         super().__init__(parent=parent)
         page = self.page()
         self.markers = {}
+        self.is_ready = False
         self.frame = page.mainFrame()
 
         self.frame.addToJavaScriptWindowObject("QtWidget", self)
@@ -120,6 +104,8 @@ class LeafletWidget(QWebView):
             frame.evaluateJavaScript(f.read())
         print('Loaded javascript')
         self.setView(lat, lng)
+        self.is_ready = True
+        self.mapReady.emit()
 
     def map_command(self, map_command_str, return_value=True):
         js_str = 'mymap.{};'.format(map_command_str)
@@ -140,16 +126,74 @@ class LeafletWidget(QWebView):
         return res['lat'], res['lng']
 
     def getBounds(self):
+        """Visible map region as (south, west, north, east)"""
         res = self.map_command('getBounds()')
         return res['_southWest']['lat'], res['_southWest']['lng'], res['_northEast']['lat'], res['_northEast']['lng']
 
     def on_marker_removed(self, marker_id):
         del self.markers[marker_id]
 
+    @pyqtSlot(int, float, float)
+    def markerMovedTo(self, marker_id, lat, lng):
+        """Called from javascript when a marker has been dragged to a new position"""
+        marker = self.markers.get(marker_id)
+        if marker is not None:
+            marker._latlng = (lat, lng)
+        self.onMarkerMoved.emit(marker_id)
+
+    def add_markers(self, latlng_list):
+        """Add markers at a list of (lat, lng) positions, using a single javascript call
+
+        Returns
+        -----------
+        List of :class:`LeafletMarker` objects
+        """
+        latlng_list = [(float(lat), float(lng)) for lat, lng in latlng_list]
+        if not latlng_list:
+            return []
+        marker_ids = self.run_js('addMarkers({});'.format(json.dumps(latlng_list)))
+        markers = [LeafletMarker(int(mid), self, latlng) for mid, latlng in zip(marker_ids, latlng_list)]
+        self.markers.update({m.id: m for m in markers})
+        return markers
+
+    def remove_markers(self, markers, update=True):
+        """Remove markers using a single javascript call"""
+        ids = [m.id for m in markers if m.id is not None]
+        if not ids:
+            return
+        self.run_js('removeMarkers({});'.format(json.dumps(ids)), return_value=False)
+        for m in markers:
+            self.markers.pop(m.id, None)
+            m.id = None
+        if update:
+            self.update()
+
+    def move_markers(self, positions):
+        """Move markers using a single javascript call
+
+        Parameters
+        -----------
+        positions : dict
+            Mapping from :class:`LeafletMarker` to new (lat, lng) position
+        """
+        updates = [(m.id, float(lat), float(lng)) for m, (lat, lng) in positions.items() if m.id is not None]
+        if not updates:
+            return
+        self.run_js('moveMarkers({});'.format(json.dumps(updates)), return_value=False)
+        for m, (lat, lng) in positions.items():
+            m._latlng = (float(lat), float(lng))
+
+    def set_markers_draggable(self, markers, draggable):
+        """Enable or disable dragging of markers using a single javascript call"""
+        ids = [m.id for m in markers if m.id is not None]
+        if ids:
+            js = 'setMarkersDraggable({}, {});'.format(json.dumps(ids), 'true' if draggable else 'false')
+            self.run_js(js, return_value=False)
+
     def remove_all_markers(self):
         if self.markers:
+            self.run_js('clearMarkers();', return_value=False)
             for m in self.markers.values():
-                m.remove(update=False)
-
+                m.id = None
             self.markers.clear()
             self.update()
@@ -9,14 +9,77 @@ L.tileLayer('http://{s}.tile.openstreetmap.org/{z}/{x}/{y}.png', {
 }).addTo(mymap);
 
 var marker_dict = {};
+var marker_layer = L.layerGroup().addTo(mymap);
+
+var onMarkerClicked = function(e) {};
+var onMarkerMoveEnded = function(e) {};
 
 if(typeof QtWidget != 'undefined') {
     //var onMarkerClicked = function(e) { QtWidget.onMarkerClicked(this.options.marker_id) };
-    var onMarkerClicked = function(e) { QtWidget.onMarkerClicked(L.stamp(this)) };
-    var onMarkerMoveEnded = function(e) { QtWidget.onMarkerMoved(L.stamp(this)) };
+    onMarkerClicked = function(e) { QtWidget.onMarkerClicked(L.stamp(this)) };
+    onMarkerMoveEnded = function(e) {
+        var latlng = this.getLatLng();
+        QtWidget.markerMovedTo(L.stamp(this), latlng.lat, latlng.lng);
+    };
     var onMapMove = function() { QtWidget.onMove() };
+    var onMapMoveEnd = function() { QtWidget.onMoveEnd() };
     var onMapClick = function(e) { QtWidget.onClick(e.latlng.lat, e.latlng.lng) };
 
     mymap.on('move', onMapMove);
+    mymap.on('moveend', onMapMoveEnd);
     mymap.on('click', onMapClick);
 }
+
+// Batched marker operations, such that many markers only need a single call from Python
+
+function addMarkers(latlngs) {
+    var ids = [];
+    for (var i = 0; i < latlngs.length; i++) {
+        var marker = L.marker(latlngs[i]);
+        marker.on('click', onMarkerClicked);
+        marker.on('moveend', onMarkerMoveEnded);
+        marker_layer.addLayer(marker);
+        var id = L.stamp(marker);
+        marker_dict[id] = marker;
+        ids.push(id);
+    }
+    return ids;
+}
+
+function removeMarkers(ids) {
+    for (var i = 0; i < ids.length; i++) {
+        var marker = marker_dict[ids[i]];
+        if (marker) {
+            marker_layer.removeLayer(marker);
+            delete marker_dict[ids[i]];
+        }
+    }
+}
+
+function clearMarkers() {
+    marker_layer.clearLayers();
+    marker_dict = {};
+}
+
+function moveMarkers(updates) {
+    // updates is a list of [id, lat, lng]
+    for (var i = 0; i < updates.length; i++) {
+        var marker = marker_dict[updates[i][0]];
+        if (marker) {
+            marker.setLatLng([updates[i][1], updates[i][2]]);
+        }
+    }
+}
+
+function setMarkersDraggable(ids, draggable) {
+    for (var i = 0; i < ids.length; i++) {
+        var marker = marker_dict[ids[i]];
+        if (marker) {
+            if (draggable) {
+                marker.dragging.enable();
+            } else {
+                marker.dragging.disable();
+            }
+        }
+    }
+}
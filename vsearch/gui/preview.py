@@ -0,0 +1,90 @@
+# Copyright 2017 Hannes Ovrén
+#
+# This file is part of vsearch.
+#
+# vsearch is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# vsearch is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with vsearch.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+
+from PyQt5.QtCore import QObject, QRunnable, QThreadPool, pyqtSignal
+
+from ..thumbnails import PreviewCache, default_cache_directory
+
+REQUEST_PRIORITY = 1
+PREFETCH_PRIORITY = 0
+
+
+class _PreviewTask(QRunnable):
+    def __init__(self, loader, path):
+        super().__init__()
+        self.loader = loader
+        self.path = path
+
+    def run(self):
+        try:
+            image = self.loader.cache.get(self.path)
+        except Exception as e:
+            print('Failed to load preview of', self.path, e)
+            image = None
+        self.loader._task_done(self.path, image)
+
+
+class PreviewLoader(QObject):
+    """Loads downscaled image previews in a pool of worker threads
+
+    Previews are emitted through the :attr:`loaded` signal, with the image path and RGB image array
+    (or None if the image could not be read).
+    """
+    loaded = pyqtSignal(str, object)
+
+    def __init__(self, max_side=1024, memory_bytes=128 * 2**20, cache_directory=None, max_threads=None, parent=None,
+                 disk_bytes=512 * 2**20):
+        super().__init__(parent)
+        if cache_directory is None:
+            cache_directory = default_cache_directory()
+        self.cache = PreviewCache(max_side, memory_bytes, cache_directory, disk_bytes)
+        self.pool = QThreadPool(self)
+        if max_threads is not None:
+            self.pool.setMaxThreadCount(max_threads)
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    def request(self, path):
+        """Request the preview of an image
+
+        If the preview is already in memory, :attr:`loaded` is emitted immediately.
+        """
+        image = self.cache.cached(path)
+        if image is not None:
+            self.loaded.emit(path, image)
+        else:
+            self._schedule(path, REQUEST_PRIORITY)
+
+    def prefetch(self, paths):
+        """Load previews in the background, with lower priority than requested previews"""
+        for path in paths:
+            if self.cache.cached(path) is None:
+                self._schedule(path, PREFETCH_PRIORITY)
+
+    def _schedule(self, path, priority):
+        with self._lock:
+            if path in self._pending:
+                return
+            self._pending.add(path)
+        self.pool.start(_PreviewTask(self, path), priority)
+
+    def _task_done(self, path, image):
+        with self._lock:
+            self._pending.discard(path)
+        self.loaded.emit(path, image)
@@ -0,0 +1,416 @@
+# Copyright 2017 Hannes Ovrén
+#
+# This file is part of vsearch.
+#
+# vsearch is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# vsearch is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with vsearch.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Streaming ingest of new images into database files
+
+:class:`IngestPipeline` passes image files through three stages, which run concurrently:
+
+1. Feature extraction, in a pool of worker processes. The SIFT and color names descriptor files are written next to
+   the image, as by ``vsearch_sift`` and ``vsearch_colornames``. Descriptor files that are newer than the image are
+   used as they are.
+2. Quantization of the descriptors to visual words, in a pool of threads.
+3. Insertion into the SIFT and color names database files, in batches.
+
+The stages are connected by bounded queues, so a stage that falls behind makes the stages before it wait, and
+:meth:`IngestPipeline.submit` blocks when the pipeline is full. :class:`DirectoryPoller` finds new and changed images
+in a directory tree.
+
+Processes that have loaded the databases add the committed images with
+:meth:`vsearch.database.SiftColornamesWrapper.update_from_files`.
+"""
+
+import multiprocessing
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+
+from . import instrumentation
+from .colornames import cname_file_for_image, calculate_colornames, colornames_table, use_colornames_table
+from .database import AnnDatabase, DatabaseError, KEYPOINT_WORDS_GROUP, KEYPOINT_POINTS_GROUP, \
+    RESERVED_DATABASE_NAMES, dataset_name
+from .lazy import lazy_import
+from .shared import SharedArrays, attach_arrays
+from .sift import sift_file_for_image, calculate_sift, keypoint_policy_attrs, keypoint_policy_from_attrs, \
+    load_keypoint_policy, DEFAULT_KEYPOINT_POLICY
+from .utils import load_descriptors_and_points, save_keypoints_and_descriptors, iter_images
+
+cv2 = lazy_import('cv2')
+h5py = lazy_import('h5py')
+
+_STOP = object()
+_WAKE = object()
+
+
+def _is_newer(path, mtime):
+    try:
+        return os.path.getmtime(path) >= mtime
+    except OSError:
+        return False
+
+
+def _points(keypoints):
+    return np.array([kp.pt for kp in keypoints], dtype='float32').reshape(-1, 2)
+
+
+def _reusable(path, mtime, policy):
+    # Files without a recorded policy kept all keypoints
+    return _is_newer(path, mtime) and \
+        (load_keypoint_policy(path) or DEFAULT_KEYPOINT_POLICY) == (policy or DEFAULT_KEYPOINT_POLICY)
+
+
+def extract_features(image_path, policy=None):
+    """SIFT and color names features of an image
+
+    Descriptor files next to the image are used if they are newer than the image, and were extracted with the same
+    keypoint policy. Otherwise the features are calculated, and the descriptor files are written.
+
+    Parameters
+    -------------
+    image_path : str
+        Image file
+    policy : vsearch.sift.KeypointPolicy
+        Keypoint policy, or None to keep all keypoints
+
+    Returns
+    -------------
+    dict with 'sift' and 'colornames' (descriptors, points) pairs, where points is an Nx2 array of keypoint locations
+    """
+    sift_file = sift_file_for_image(image_path)
+    cname_file = cname_file_for_image(image_path)
+    mtime = os.path.getmtime(image_path)
+    if _reusable(sift_file, mtime, policy) and _reusable(cname_file, mtime, policy):
+        return {'sift': load_descriptors_and_points(sift_file), 'colornames': load_descriptors_and_points(cname_file)}
+
+    image = cv2.imread(image_path)
+    if image is None:
+        raise IOError("Could not read image {}".format(image_path))
+    sift_descriptors, keypoints = calculate_sift(image, policy=policy)
+    if not keypoints:
+        raise ValueError("No keypoints found in {}".format(image_path))
+    attrs = keypoint_policy_attrs(policy) if policy is not None else None
+    save_keypoints_and_descriptors(sift_file, keypoints, sift_descriptors, attrs)
+
+    image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    cname_descriptors, cname_keypoints = calculate_colornames(image, keypoints=keypoints)
+    save_keypoints_and_descriptors(cname_file, cname_keypoints, cname_descriptors, attrs)
+    return {'sift': (sift_descriptors, _points(keypoints)), 'colornames': (cname_descriptors, _points(cname_keypoints))}
+
+
+_policy = None
+
+
+def _init_extraction_worker(specs, policy):
+    # The color names table is loaded once by the main process and shared by all workers
+    global _policy
+    use_colornames_table(attach_arrays(specs)['colornames'])
+    _policy = policy
+
+
+def _extract(item):
+    path, key = item
+    try:
+        return path, key, extract_features(path, _policy), None
+    except Exception as e:
+        return path, key, None, '{}: {}'.format(type(e).__name__, e)
+
+
+def create_database_file(path, vocabulary, keypoint_words=True, keypoint_policy=None):
+    """Create an empty database file
+
+    Parameters
+    -------------
+    path : str
+        Database file
+    vocabulary : array_like
+        KxD vocabulary
+    keypoint_words : bool
+        Whether the visual word and location of each keypoint will be stored, as by ``vsearch_database``
+    keypoint_policy : vsearch.sift.KeypointPolicy
+        Keypoint policy that images are added with, and that queries use. None to keep all keypoints.
+    """
+    with h5py.File(path, 'w') as f:
+        if keypoint_policy is not None:
+            f.attrs.update(keypoint_policy_attrs(keypoint_policy))
+        f['vocabulary'] = vocabulary
+        if keypoint_words:
+            f.create_group(KEYPOINT_WORDS_GROUP)
+            f.create_group(KEYPOINT_POINTS_GROUP)
+
+
+def _open_for_writing(path, attempts=50, wait=0.1):
+    # HDF5 locks the file while another process reads it, e.g. a query server loading stored keypoints
+    for attempt in range(attempts):
+        try:
+            return h5py.File(path, 'a')
+        except OSError:
+            if attempt == attempts - 1:
+                raise
+            time.sleep(wait)
+
+
+class DirectoryPoller:
+    """Finds new and changed images in a directory tree, by comparing the size and modification time of the files
+    between scans
+    """
+    def __init__(self, directory, min_age=1.0, include=None, exclude=None):
+        """Create the poller
+
+        Parameters
+        -------------
+        directory : str
+            Root of the directory tree
+        min_age : float
+            Files that were modified less than this many seconds ago are left for a later scan, since they may still
+            be being written.
+        include, exclude : list
+            Glob patterns of images to include or exclude, see :func:`vsearch.utils.iter_images`
+        """
+        self.directory = directory
+        self.min_age = min_age
+        self.include = include
+        self.exclude = exclude
+        self._seen = {}
+
+    def scan(self):
+        """Images that were added or changed since the last scan
+
+        The first scan returns all images.
+
+        Returns
+        -------------
+        List of :class:`vsearch.utils.ImageFile`
+        """
+        now = time.time()
+        changed = []
+        for image in iter_images(self.directory, self.include, self.exclude):
+            try:
+                st = os.stat(image.path)
+            except OSError:
+                continue  # Removed since it was listed
+            signature = (st.st_size, st.st_mtime_ns)
+            if self._seen.get(image.path) == signature or now - st.st_mtime < self.min_age:
+                continue
+            self._seen[image.path] = signature
+            changed.append(image)
+        return changed
+
+
+class IngestPipeline:
+    """Adds images to a SIFT and a color names database file
+
+    Images are passed to :meth:`submit`, and are committed to the database files in batches. Use :meth:`flush` to
+    wait until all submitted images are committed, and :meth:`close` to stop the pipeline.
+    Images that fail (e.g. because they can not be read) are listed in :attr:`failed`.
+    """
+    def __init__(self, sift_db_file, cname_db_file, n_extractors=None, n_quantizers=1, max_pending=32,
+                 batch_size=100, batch_seconds=5., progress=None):
+        """Start the pipeline
+
+        Parameters
+        -------------
+        sift_db_file, cname_db_file : str
+            Database files, see :func:`create_database_file`. An image that is already in the files is replaced.
+            Features are extracted with the keypoint policy of the SIFT database file.
+        n_extractors : int
+            Number of feature extraction processes (default is number of CPU cores)
+        n_quantizers : int
+            Number of quantization threads
+        max_pending : int
+            Maximum number of images waiting in each stage
+        batch_size : int
+            Number of images per commit
+        batch_seconds : float
+            Maximum time an image waits for its batch to fill up before it is committed
+        progress : callable
+            Optional function called as `progress(keys)` after each commit
+        """
+        self.database_files = {'sift': sift_db_file, 'colornames': cname_db_file}
+        self.batch_size = batch_size
+        self.batch_seconds = batch_seconds
+        self.n_quantizers = n_quantizers
+        self.progress = progress
+        self.committed = 0
+        self.failed = []
+
+        self._quantizers = {}
+        for name, path in self.database_files.items():
+            with h5py.File(path, 'r') as f:
+                self._quantizers[name] = AnnDatabase(f['vocabulary'][()])
+                if name == 'sift':
+                    self.keypoint_policy = keypoint_policy_from_attrs(f.attrs)
+
+        self._submitted = 0
+        self._finished = 0
+        self._condition = threading.Condition()
+        self._flushing = threading.Event()
+        self._in_flight = threading.BoundedSemaphore(max_pending)
+        self._paths = queue.Queue(max_pending)
+        self._extracted = queue.Queue(max_pending)
+        self._quantized = queue.Queue(max_pending)
+
+        self._shared = SharedArrays({'colornames': colornames_table()})
+        self._pool = multiprocessing.Pool(n_extractors, initializer=_init_extraction_worker,
+                                          initargs=(self._shared.specs, self.keypoint_policy))
+        self._threads = [threading.Thread(target=self._dispatch, name='ingest-extract')]
+        self._threads += [threading.Thread(target=self._quantize, name='ingest-quantize-{:d}'.format(i))
+                          for i in range(n_quantizers)]
+        self._threads.append(threading.Thread(target=self._write, name='ingest-write'))
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def submit(self, path, key):
+        """Add an image to the pipeline, waiting while the pipeline is full
+
+        Parameters
+        -------------
+        path : str
+            Image file
+        key : str
+            Database key, usually the path relative to the image directory (see :func:`vsearch.utils.iter_images`)
+        """
+        with self._condition:
+            self._submitted += 1
+        self._paths.put((path, key))
+
+    def flush(self):
+        """Wait until all submitted images are committed or have failed"""
+        self._flushing.set()
+        self._quantized.put(_WAKE)
+        with self._condition:
+            self._condition.wait_for(lambda: self._finished == self._submitted)
+        self._flushing.clear()
+
+    def close(self):
+        """Commit all submitted images and stop the pipeline"""
+        self._paths.put(_STOP)
+        for thread in self._threads:
+            thread.join()
+        self._pool.close()
+        self._pool.join()
+        self._shared.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _finish(self, n):
+        with self._condition:
+            self._finished += n
+            self._condition.notify_all()
+
+    def _fail(self, path, message):
+        self.failed.append((path, message))
+        self._finish(1)
+
+    def _path_source(self):
+        while True:
+            item = self._paths.get()
+            if item is _STOP:
+                return
+            self._in_flight.acquire()
+            yield item
+
+    def _dispatch(self):
+        for result in self._pool.imap_unordered(_extract, self._path_source()):
+            self._in_flight.release()
+            self._extracted.put(result)
+        for _ in range(self.n_quantizers):
+            self._extracted.put(_STOP)
+
+    def _quantize(self):
+        while True:
+            item = self._extracted.get()
+            if item is _STOP:
+                self._quantized.put(_STOP)
+                return
+            path, key, features, error = item
+            if error is None:
+                try:
+                    entries = {}
+                    for name, (descriptors, points) in features.items():
+                        db = self._quantizers[name]
+                        if len(descriptors) and descriptors.shape[1] != db.annoy_index.f:
+                            raise DatabaseError("{} descriptors have {:d} dimensions, but the vocabulary has "
+                                                "{:d}".format(name, descriptors.shape[1], db.annoy_index.f))
+                        words = db.quantize(descriptors) if len(descriptors) else np.zeros(0, dtype='int')
+                        bow = np.bincount(words, minlength=db.vocabulary_size)
+                        entries[name] = (bow, words.astype('int32'), np.asarray(points, dtype='float32'))
+                    item = (path, key, entries, None)
+                except Exception as e:
+                    item = (path, key, None, '{}: {}'.format(type(e).__name__, e))
+            self._quantized.put(item)
+
+    def _write(self):
+        batch = []
+        deadline = None
+        running = self.n_quantizers
+        while running:
+            timeout = max(0., deadline - time.monotonic()) if batch else None
+            try:
+                item = self._quantized.get(timeout=timeout)
+            except queue.Empty:
+                item = _WAKE
+            if item is _STOP:
+                running -= 1
+            elif item is not _WAKE:
+                path, key, entries, error = item
+                if error is None and key in RESERVED_DATABASE_NAMES:
+                    error = "'{}' is a reserved name".format(key)
+                if error is not None:
+                    self._fail(path, error)
+                    continue
+                batch.append((key, path, entries))
+                if deadline is None:
+                    deadline = time.monotonic() + self.batch_seconds
+            if batch and (len(batch) >= self.batch_size or time.monotonic() >= deadline or self._flushing.is_set()):
+                self._commit(batch)
+                batch = []
+                deadline = None
+        if batch:
+            self._commit(batch)
+
+    def _commit(self, batch):
+        try:
+            with instrumentation.timer('ingest.commit'):
+                for name, database_file in self.database_files.items():
+                    with _open_for_writing(database_file) as f:
+                        words_group = f.get(KEYPOINT_WORDS_GROUP)
+                        points_group = f.get(KEYPOINT_POINTS_GROUP)
+                        for key, _, entries in batch:
+                            dataset = dataset_name(key)
+                            for group, value in zip((f, words_group, points_group), entries[name]):
+                                if group is None:
+                                    continue
+                                if dataset in group:
+                                    del group[dataset]
+                                group[dataset] = value
+        except Exception as e:
+            for key, path, _ in batch:
+                self.failed.append((path, 'Commit failed: {}: {}'.format(type(e).__name__, e)))
+            self._finish(len(batch))
+            return
+        instrumentation.count('ingest.images_committed', len(batch))
+        self.committed += len(batch)
+        if self.progress is not None:
+            self.progress([key for key, _, _ in batch])
+        self._finish(len(batch))
@@ -0,0 +1,231 @@
+# Copyright 2017 Hannes Ovrén
+#
+# This file is part of vsearch.
+#
+# vsearch is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# vsearch is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with vsearch.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Named timers and counters
+
+The library reports the time spent in named stages (e.g. ``sift.calculate`` or ``database.score``), and counts of
+work done (e.g. ``database.descriptors_quantized`` or ``utils.bytes_read``). The measurements are passed on to
+sinks, which log them, write them to a JSON lines file, or collect statistics in memory::
+
+    from vsearch import instrumentation
+
+    with instrumentation.recording() as stats:
+        database.query_path('image.jpg', roi, max_results=10)
+    print(stats.report())
+
+When no sink is added, timers and counters do nothing, so the instrumentation costs a single check per call.
+"""
+
+import contextlib
+import functools
+import json
+import logging
+import threading
+import time
+
+_sinks = ()
+
+
+def enabled():
+    """True if any sink is added"""
+    return bool(_sinks)
+
+
+def add_sink(sink):
+    """Start passing measurements to a sink
+
+    A sink is any object with a method `record(kind, name, value)`, where kind is 'timer' (value in seconds)
+    or 'counter'. It may be called from several threads at once.
+    """
+    global _sinks
+    _sinks = _sinks + (sink,)
+
+
+def remove_sink(sink):
+    global _sinks
+    _sinks = tuple(s for s in _sinks if s is not sink)
+
+
+@contextlib.contextmanager
+def recording(sink=None):
+    """Context manager that adds a sink while the block runs
+
+    Parameters
+    -------------
+    sink : object
+        The sink to add. If None, a new :class:`StatsSink` is used.
+
+    Returns
+    -------------
+    The sink
+    """
+    if sink is None:
+        sink = StatsSink()
+    add_sink(sink)
+    try:
+        yield sink
+    finally:
+        remove_sink(sink)
+
+
+def _emit(kind, name, value):
+    for sink in _sinks:
+        sink.record(kind, name, value)
+
+
+def count(name, value=1):
+    """Add to a named counter"""
+    if _sinks:
+        _emit('counter', name, value)
+
+
+class _Timer:
+    __slots__ = ('name', 't0')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        _emit('timer', self.name, time.perf_counter() - self.t0)
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NULL_TIMER = _NullTimer()
+
+
+def timer(name):
+    """Context manager that times its block under the given name"""
+    return _Timer(name) if _sinks else _NULL_TIMER
+
+
+def timed(name):
+    """Decorator that times each call of a function under the given name"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _sinks:
+                return func(*args, **kwargs)
+            with _Timer(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class StatsSink:
+    """Collects the number of calls, total, min and max time of each timer, and the sum of each counter"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.timers = {}
+        self.counters = {}
+
+    def record(self, kind, name, value):
+        with self._lock:
+            if kind == 'timer':
+                stats = self.timers.get(name)
+                if stats is None:
+                    self.timers[name] = [1, value, value, value]
+                else:
+                    stats[0] += 1
+                    stats[1] += value
+                    stats[2] = min(stats[2], value)
+                    stats[3] = max(stats[3], value)
+            else:
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    def reset(self):
+        with self._lock:
+            self.timers.clear()
+            self.counters.clear()
+
+    def stats(self):
+        """dict with 'timers' (name -> dict of 'calls', 'total', 'min' and 'max' seconds) and 'counters'"""
+        with self._lock:
+            return {'timers': {name: {'calls': calls, 'total': total, 'min': tmin, 'max': tmax}
+                               for name, (calls, total, tmin, tmax) in self.timers.items()},
+                    'counters': dict(self.counters)}
+
+    def report(self):
+        """Human readable table of the statistics, with the timers sorted by total time"""
+        stats = self.stats()
+        lines = ['{:<40s} {:>8s} {:>12s} {:>12s}'.format('timer', 'calls', 'total ms', 'mean ms')]
+        for name, t in sorted(stats['timers'].items(), key=lambda item: -item[1]['total']):
+            lines.append('{:<40s} {:8d} {:12.3f} {:12.3f}'.format(name, t['calls'], 1000 * t['total'],
+                                                                  1000 * t['total'] / t['calls']))
+        if stats['counters']:
+            lines.append('{:<40s} {:>8s}'.format('counter', 'value'))
+            for name, value in sorted(stats['counters'].items()):
+                lines.append('{:<40s} {:8d}'.format(name, int(value)))
+        return '\n'.join(lines)
+
+
+class LoggingSink:
+    """Logs each measurement"""
+    def __init__(self, logger=None, level=logging.DEBUG):
+        self.logger = logging.getLogger('vsearch.instrumentation') if logger is None else logger
+        self.level = level
+
+    def record(self, kind, name, value):
+        if kind == 'timer':
+            self.logger.log(self.level, '%s: %.3f ms', name, 1000 * value)
+        else:
+            self.logger.log(self.level, '%s: +%s', name, value)
+
+
+class JsonLinesSink:
+    """Writes each measurement as a line of JSON: ``{"time": ..., "thread": ..., "kind": ..., "name": ..., "value": ...}``
+    """
+    def __init__(self, path_or_file):
+        """Open the sink
+
+        Parameters
+        -------------
+        path_or_file : str or file
+            Path of a file to append to, or an open text file
+        """
+        if isinstance(path_or_file, str):
+            self.file = open(path_or_file, 'a')
+            self._owns_file = True
+        else:
+            self.file = path_or_file
+            self._owns_file = False
+        self._lock = threading.Lock()
+
+    def record(self, kind, name, value):
+        line = json.dumps({'time': time.time(), 'thread': threading.current_thread().name, 'kind': kind,
+                           'name': name, 'value': value})
+        with self._lock:
+            self.file.write(line + '\n')
+
+    def close(self):
+        with self._lock:
+            if self._owns_file:
+                self.file.close()
+            else:
+                self.file.flush()
@@ -0,0 +1,59 @@
+# Copyright 2017 Hannes Ovrén
+#
+# This file is part of vsearch.
+#
+# vsearch is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# vsearch is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with vsearch.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Deferred imports of heavy modules
+
+OpenCV, HDF5, annoy and SciPy take a large part of the start-up time of a process, and many processes only need
+some of them (e.g. scoring needs SciPy, but not OpenCV). The modules of this package therefore import them with
+:func:`lazy_import`, which returns a placeholder that imports the real module at first use::
+
+    cv2 = lazy_import('cv2')
+    sparse = lazy_import('scipy.sparse')
+
+    def read(path):
+        return cv2.imread(path)  # OpenCV is imported here
+"""
+
+import importlib
+import sys
+import types
+
+
+class _LazyModule(types.ModuleType):
+    def __getattr__(self, attr):
+        module = importlib.import_module(self.__name__)
+        # Copy the namespace of the real module, such that later lookups are plain attribute lookups
+        self.__dict__.update(module.__dict__)
+        return getattr(module, attr)
+
+
+def lazy_import(name):
+    """Module that is imported at first attribute access
+
+    Parameters
+    -------------
+    name : str
+        Full name of the module, e.g. 'scipy.sparse'
+
+    Returns
+    -------------
+    The module itself if it is already imported, otherwise a placeholder module
+    """
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    return _LazyModule(name)
@@ -0,0 +1,396 @@
+# Copyright 2017 Hannes Ovrén
+#
+# This file is part of vsearch.
+#
+# vsearch is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# vsearch is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with vsearch.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Headless query server
+
+The server keeps a database in memory and answers queries over HTTP, on a local TCP port or a Unix socket.
+Requests and responses are JSON:
+
+``GET /status``
+    Number of database images: ``{"images": 1234}``
+
+``POST /query``
+    Query with an image file: ``{"path": "image.jpg", "roi": [x, y, width, height], "max_results": 10}``.
+    `roi` and `max_results` are optional. If `key` is given, the stored keypoint words of that database image are used.
+
+``POST /query_descriptors``
+    Query with precomputed descriptors: ``{"sift": [[...], ...], "colornames": [[...], ...], "max_results": 10}``
+
+``POST /refresh``
+    Add images that were committed to the database files since they were loaded, e.g. by ``vsearch_ingest``:
+    ``{"added": 12, "images": 1246}``. This can also be done periodically, see `refresh_interval`.
+
+Queries return ``{"matches": [{"key": "image.jpg", "distance": 0.12, "lat": 58.5, "lng": 16.1}, ...]}``,
+where `lat` and `lng` are only included for databases with locations. Errors return ``{"error": "message"}``.
+
+Queries that arrive close in time are collected into batches, which are scored together with the batch query
+methods of the database.
+"""
+
+import asyncio
+import concurrent.futures
+import json
+
+import numpy as np
+
+from .database import DatabaseError
+
+MAX_REQUEST_BYTES = 256 * 2**20
+
+HTTP_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+                413: 'Payload Too Large', 500: 'Internal Server Error'}
+
+
+class RequestError(Exception):
+    """Error in a client request, reported with a HTTP status code"""
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def match_to_json(match):
+    """JSON representation of a (key, distance) or (DatabaseEntry, distance) match"""
+    item, distance = match
+    result = {'key': getattr(item, 'key', item), 'distance': float(distance)}
+    latlng = getattr(item, 'latlng', None)
+    if latlng is not None:
+        result['lat'], result['lng'] = latlng
+    return result
+
+
+def _is_number(x):
+    return isinstance(x, (int, float)) and not isinstance(x, bool)
+
+
+class QueryBatcher:
+    """Collects concurrent queries into batches that are run in a worker thread
+
+    A batch is started when `max_batch` queries are waiting, or `window` seconds after the first query arrived.
+    """
+    def __init__(self, database, window=0.005, max_batch=32):
+        self.database = database
+        self.window = window
+        self.max_batch = max_batch
+        self.batches_run = 0
+        self._pending = {'path': [], 'descriptors': []}
+        self._timers = {}
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    def submit(self, kind, query):
+        """Queue a query of kind 'path' or 'descriptors' and return a future for its matches"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        pending = self._pending[kind]
+        pending.append((query, future))
+        if len(pending) >= self.max_batch:
+            self._flush(kind)
+        elif kind not in self._timers:
+            self._timers[kind] = loop.call_later(self.window, self._flush, kind)
+        return future
+
+    def _flush(self, kind):
+        timer = self._timers.pop(kind, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self._pending[kind]
+        self._pending[kind] = []
+        if batch:
+            self.batches_run += 1
+            run = self._run_paths if kind == 'path' else self._run_descriptors
+            asyncio.ensure_future(self._run(run, batch))
+
+    async def _run(self, run, batch):
+        queries = [query for query, _ in batch]
+        loop = asyncio.get_running_loop()
+        try:
+            results = await loop.run_in_executor(self._executor, run, queries)
+        except Exception as e:
+            results = [e] * len(batch)
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    @staticmethod
+    def _batch_max_results(queries):
+        # Score the batch with the largest requested number of results, and cut each result list afterwards
+        max_results = [q.get('max_results') for q in queries]
+        return None if None in max_results else max(max_results)
+
+    def _run_paths(self, queries):
+        results = [None] * len(queries)
+        by_path = [i for i, q in enumerate(queries) if q.get('key') is None]
+        for i, q in enumerate(queries):
+            if q.get('key') is not None:
+                try:
+                    results[i] = self.database.query_key(q['key'], q.get('roi'), q.get('max_results'),
+                                                         path=q.get('path'))
+                except Exception as e:
+                    results[i] = e
+        if by_path:
+            batch = [queries[i] for i in by_path]
+            try:
+                matches = self.database.query_paths([q['path'] for q in batch], [q.get('roi') for q in batch],
+                                                    self._batch_max_results(batch))
+            except Exception:
+                # Find which queries failed by running them one at a time
+                matches = [self._query_path(q) for q in batch]
+            for i, m in zip(by_path, matches):
+                results[i] = m
+        return [r if isinstance(r, Exception) else r[:queries[i].get('max_results')] for i, r in enumerate(results)]
+
+    def _query_path(self, query):
+        try:
+            return self.database.query_path(query['path'], query.get('roi'), query.get('max_results'))
+        except Exception as e:
+            return e
+
+    def _run_descriptors(self, queries):
+        matches = self.database.query_descriptors_batch([q['sift'] for q in queries],
+                                                        [q['colornames'] for q in queries],
+                                                        max_results=self._batch_max_results(queries))
+        return [m[:q.get('max_results')] for q, m in zip(queries, matches)]
+
+    async def run_exclusive(self, func):
+        """Run a function in the worker thread, between batches"""
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func)
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+
+class QueryServer:
+    """HTTP query server around a :class:`vsearch.database.SiftColornamesWrapper` or
+    :class:`vsearch.database.DatabaseWithLocation`
+    """
+    def __init__(self, database, batch_window=0.005, max_batch=32, refresh_interval=None):
+        """Create the server
+
+        Parameters
+        -------------
+        database : QueryableDatabase
+            Database with `query_paths`, `query_key` and `query_descriptors_batch` methods
+        batch_window : float
+            Time in seconds to wait for more queries before a batch is scored
+        max_batch : int
+            Maximum number of queries per batch
+        refresh_interval : float
+            If given, new images are added from the database files every `refresh_interval` seconds
+        """
+        self.database = database
+        self.batcher = QueryBatcher(database, batch_window, max_batch)
+        self.refresh_interval = refresh_interval
+        self.server = None
+        self._refresh_task = None
+        self._connections = set()
+
+    async def start(self, host='127.0.0.1', port=8080, unix_socket=None):
+        """Start listening on a TCP port, or on a Unix socket if `unix_socket` is given"""
+        if unix_socket is not None:
+            self.server = await asyncio.start_unix_server(self._handle_connection, path=unix_socket)
+        else:
+            self.server = await asyncio.start_server(self._handle_connection, host, port)
+        if self.refresh_interval is not None:
+            self._refresh_task = asyncio.ensure_future(self._refresh_periodically())
+        return self.server
+
+    @property
+    def address(self):
+        """Address the server is listening on: a (host, port) tuple or a Unix socket path"""
+        return self.server.sockets[0].getsockname()
+
+    async def serve_forever(self):
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def close(self):
+        """Stop listening and close all open connections"""
+        if self._refresh_task is not None:
+            self._refresh_task.cancel()
+        if self.server is not None:
+            self.server.close()
+        connections = list(self._connections)
+        for task in connections:
+            task.cancel()
+        await asyncio.gather(*connections, return_exceptions=True)
+        if self.server is not None:
+            await self.server.wait_closed()
+        self.batcher.close()
+
+    async def _handle_connection(self, reader, writer):
+        task = asyncio.current_task()
+        self._connections.add(task)
+        try:
+            while True:
+                request = await self._read_request(reader)
+                if request is None:
+                    break
+                method, path, headers, body = request
+                status, response = await self._dispatch(method, path, body)
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                self._write_response(writer, status, response, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except RequestError as e:
+            self._write_response(writer, e.status, {'error': str(e)}, keep_alive=False)
+        finally:
+            self._connections.discard(task)
+            writer.close()
+
+    async def _read_request(self, reader):
+        line = await reader.readline()
+        if not line:
+            return None
+        try:
+            method, path, _ = line.decode('latin-1').split(' ', 2)
+        except ValueError:
+            raise RequestError('Malformed request line')
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        try:
+            length = int(headers.get('content-length', 0))
+        except ValueError:
+            raise RequestError('Malformed Content-Length header')
+        if length < 0:
+            raise RequestError('Malformed Content-Length header')
+        if length > MAX_REQUEST_BYTES:
+            raise RequestError('Request is too large', status=413)
+        body = await reader.readexactly(length) if length else b''
+        return method, path, headers, body
+
+    def _write_response(self, writer, status, response, keep_alive):
+        body = json.dumps(response).encode('utf-8')
+        head = ('HTTP/1.1 {:d} {}\r\n'
+                'Content-Type: application/json\r\n'
+                'Content-Length: {:d}\r\n'
+                'Connection: {}\r\n\r\n').format(status, HTTP_REASONS[status], len(body),
+                                                 'keep-alive' if keep_alive else 'close')
+        writer.write(head.encode('latin-1') + body)
+
+    async def _dispatch(self, method, path, body):
+        routes = {
+            '/status': ('GET', self._status),
+            '/query': ('POST', self._query),
+            '/query_descriptors': ('POST', self._query_descriptors),
+            '/refresh': ('POST', self._refresh),
+        }
+        try:
+            if path not in routes:
+                raise RequestError('Unknown path {}'.format(path), status=404)
+            route_method, handler = routes[path]
+            if method != route_method:
+                raise RequestError('{} requires {}'.format(path, route_method), status=405)
+            if body:
+                try:
+                    request = json.loads(body.decode('utf-8'))
+                except ValueError:
+                    raise RequestError('Request body is not valid JSON')
+                if not isinstance(request, dict):
+                    raise RequestError('Request body must be a JSON object')
+            else:
+                request = {}
+            return 200, await handler(request)
+        except RequestError as e:
+            return e.status, {'error': str(e)}
+        except (DatabaseError, KeyError, ValueError, IOError) as e:
+            return 400, {'error': '{}: {}'.format(type(e).__name__, e)}
+        except Exception as e:
+            return 500, {'error': '{}: {}'.format(type(e).__name__, e)}
+
+    async def _status(self, request):
+        return {'images': len(self.database)}
+
+    async def _refresh(self, request):
+        # Run between query batches, since adding images changes the scoring matrices
+        keys = await self.batcher.run_exclusive(self.database.update_from_files)
+        return {'added': len(keys), 'images': len(self.database)}
+
+    async def _refresh_periodically(self):
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                response = await self._refresh({})
+            except Exception as e:
+                # E.g. the files are locked by a commit in progress, so try again later
+                print('Refresh failed: {}: {}'.format(type(e).__name__, e))
+            else:
+                if response['added']:
+                    print('Added {:d} images'.format(response['added']))
+
+    @staticmethod
+    def _max_results(request):
+        max_results = request.get('max_results')
+        # bool is a subclass of int, but true is not a number of results
+        if max_results is not None and (not isinstance(max_results, int) or isinstance(max_results, bool) or
+                                        max_results < 1):
+            raise RequestError('max_results must be a positive integer')
+        return max_results
+
+    async def _query(self, request):
+        if 'path' not in request and 'key' not in request:
+            raise RequestError('Query needs a path or key')
+        roi = request.get('roi')
+        if roi is not None and not (isinstance(roi, list) and len(roi) == 4 and
+                                    all(_is_number(x) for x in roi)):
+            raise RequestError('roi must be [x, y, width, height]')
+        query = {'path': request.get('path'), 'key': request.get('key'), 'roi': roi,
+                 'max_results': self._max_results(request)}
+        matches = await self.batcher.submit('path', query)
+        return {'matches': [match_to_json(m) for m in matches]}
+
+    async def _query_descriptors(self, request):
+        try:
+            query = {name: np.array(request[name], dtype='float32') for name in ('sift', 'colornames')}
+        except KeyError:
+            raise RequestError('Query needs sift and colornames descriptors')
+        for name, descriptors in query.items():
+            if descriptors.ndim != 2:
+                raise RequestError('{} descriptors must be a list of descriptor vectors'.format(name))
+        query['max_results'] = self._max_results(request)
+        matches = await self.batcher.submit('descriptors', query)
+        return {'matches': [match_to_json(m) for m in matches]}
+
+
+def run_server(database, host='127.0.0.1', port=8080, unix_socket=None, batch_window=0.005, max_batch=32,
+               refresh_interval=None):
+    """Run a :class:`QueryServer` until interrupted"""
+    async def main():
+        server = QueryServer(database, batch_window, max_batch, refresh_interval)
+        await server.start(host, port, unix_socket)
+        print('Serving {:d} images on {}'.format(len(database), server.address))
+        try:
+            await server.serve_forever()
+        finally:
+            await server.close()
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
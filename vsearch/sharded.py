@@ -0,0 +1,332 @@
+# Copyright 2017 Hannes Ovrén
+#
+# This file is part of vsearch.
+#
+# vsearch is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# vsearch is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with vsearch.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Multi-process sharded query scoring
+
+The rows of the TF-IDF scoring matrix of a Bag of Words database are split into contiguous shards, one per worker
+process. Each shard is stored in shared memory, so it is neither pickled nor copied into the workers.
+The IDF weights are those of the whole database, so the distances are exactly the same as for the unsharded database.
+
+Queries are TF-IDF weighted in the main process and broadcast to all workers as sparse vectors. Each worker returns
+the top-k matches of its shard, and these are merged into the global top-k.
+"""
+
+import multiprocessing
+import time
+import weakref
+
+import numpy as np
+
+from .database import QueryableDatabase, DatabaseError, top_k
+from .lazy import lazy_import
+from .shared import share_array, attach_array
+
+sparse = lazy_import('scipy.sparse')
+
+
+def _query_matrix(queries, n_words):
+    """Sparse QxK matrix from a list of (word indices, weights) queries"""
+    indptr = np.cumsum([0] + [len(words) for words, _ in queries])
+    indices = np.concatenate([words for words, _ in queries]) if queries else np.zeros(0, dtype='int')
+    data = np.concatenate([weights for _, weights in queries]) if queries else np.zeros(0)
+    return sparse.csr_matrix((data, indices, indptr), shape=(len(queries), n_words))
+
+
+def _shard_worker(conn, specs, shape):
+    blocks = []
+    arrays = []
+    for spec in specs:
+        shm, array = attach_array(spec)
+        blocks.append(shm)
+        arrays.append(array)
+    matrix = sparse.csr_matrix(tuple(arrays), shape=shape, copy=False)
+
+    while True:
+        command, *args = conn.recv()
+        if command == 'close':
+            break
+        try:
+            queries, k = args
+            distances = 1 - _query_matrix(queries, shape[1]).dot(matrix.T).toarray()
+            if command == 'distances':
+                result = distances
+            elif command == 'top_k':
+                result = []
+                for d in distances:
+                    indices = top_k(d, k)
+                    result.append((indices, d[indices]))
+            else:
+                raise ValueError('Unknown command {}'.format(command))
+            conn.send((True, result))
+        except Exception as e:
+            conn.send((False, e))
+
+    conn.close()
+    del matrix, arrays
+    for shm in blocks:
+        shm.close()
+
+
+def _release(processes, connections, blocks):
+    for conn in connections:
+        try:
+            conn.send(('close',))
+        except (OSError, ValueError):
+            pass
+    for process in processes:
+        process.join(timeout=5)
+        if process.is_alive():
+            process.terminate()
+    for conn in connections:
+        conn.close()
+    for shm in blocks:
+        shm.close()
+        shm.unlink()
+
+
+class ShardedDatabase(QueryableDatabase):
+    """Read-only snapshot of a Bag of Words database, scored by several worker processes
+
+    The sharded database can be used in place of the database it was created from, e.g. in a
+    :class:`vsearch.database.SiftColornamesWrapper`. Scoring is done by the workers, while everything else
+    (feature loading, quantization, ...) is passed on to the original database.
+
+    Changes to the original database after the sharded database was created are not seen by the workers.
+    Call :meth:`close` (or use the sharded database as a context manager) to stop the workers.
+    """
+    def __init__(self, database, n_shards=None, mp_context='spawn'):
+        """Start the worker processes
+
+        Parameters
+        ---------------
+        database : BagOfWordsDatabase
+            The database to shard
+        n_shards : int
+            Number of shards and worker processes. If None, the number of CPU cores is used.
+        mp_context : str
+            Multiprocessing start method for the workers
+        """
+        super().__init__()
+        if n_shards is None:
+            n_shards = multiprocessing.cpu_count()
+        if n_shards < 1:
+            raise DatabaseError("Need at least one shard")
+        self.database = database
+        self.idf = None if database.idf is None else np.array(database.idf)
+        self._key_order = list(database.key_order)
+        self._key_index = None
+        matrix = database._scoring_matrix
+
+        # Contiguous shards with about the same number of non-zero elements
+        n = len(self._key_order)
+        n_shards = max(1, min(n_shards, n))
+        targets = np.linspace(0, matrix.nnz, n_shards + 1)[1:-1]
+        bounds = [0] + list(np.searchsorted(matrix.indptr, targets)) + [n]
+        self.shard_bounds = [(int(start), int(stop)) for start, stop in zip(bounds[:-1], bounds[1:])]
+
+        ctx = multiprocessing.get_context(mp_context)
+        self._processes = []
+        self._connections = []
+        self._blocks = []
+        self._finalizer = weakref.finalize(self, _release, self._processes, self._connections, self._blocks)
+        for start, stop in self.shard_bounds:
+            shard = matrix[start:stop]
+            specs = []
+            for array in (shard.data, shard.indices, shard.indptr):
+                shm, spec = share_array(array)
+                self._blocks.append(shm)
+                specs.append(spec)
+            parent_conn, child_conn = ctx.Pipe()
+            process = ctx.Process(target=_shard_worker, args=(child_conn, specs, shard.shape), daemon=True)
+            process.start()
+            child_conn.close()
+            self._processes.append(process)
+            self._connections.append(parent_conn)
+
+    @property
+    def n_shards(self):
+        return len(self.shard_bounds)
+
+    def close(self):
+        """Stop the worker processes and free the shared memory"""
+        self._finalizer()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __getattr__(self, name):
+        # Everything but scoring is done by the original database
+        if name == 'database':
+            raise AttributeError(name)
+        return getattr(self.database, name)
+
+    def __getitem__(self, key):
+        return self.database[key]
+
+    def __iter__(self):
+        return iter(self._key_order)
+
+    def __len__(self):
+        return len(self._key_order)
+
+    @property
+    def key_order(self):
+        """List of database keys, in the order used by :meth:`distances`"""
+        return self._key_order
+
+    def rows_for_keys(self, keys):
+        """Positions in :attr:`key_order` of the given keys, ignoring keys that are not in the database"""
+        if self._key_index is None:
+            self._key_index = {key: i for i, key in enumerate(self._key_order)}
+        return np.sort(np.array([self._key_index[key] for key in keys if key in self._key_index], dtype='int'))
+
+    def _weighted(self, bow):
+        q = np.asarray(bow, dtype='float64') * self.idf
+        words = np.flatnonzero(q)
+        weights = q[words]
+        norm = np.linalg.norm(weights)
+        if norm > 0:
+            weights = weights / norm
+        return words, weights
+
+    def _broadcast(self, command, bows, k=None):
+        if not self._finalizer.alive:
+            raise DatabaseError("The sharded database has been closed")
+        queries = [self._weighted(bow) for bow in bows]
+        for conn in self._connections:
+            conn.send((command, queries, k))
+        results = []
+        for conn in self._connections:
+            ok, result = conn.recv()
+            if not ok:
+                raise result
+            results.append(result)
+        return results
+
+    def distances_batch(self, bows):
+        """Cosine distances between several query BoW vectors and all database images
+
+        Returns
+        --------------
+        QxN array of distances, where the columns are in the same order as :attr:`key_order`
+        """
+        if len(self._key_order) == 0 or self.idf is None:
+            return np.zeros((len(bows), len(self._key_order)))
+        return np.hstack(self._broadcast('distances', bows))
+
+    def distances(self, bow, rows=None):
+        """Cosine distances between a query BoW vector and all database images
+
+        Returns
+        --------------
+        Array of distances, in the same order as :attr:`key_order` (or `rows`)
+        """
+        distances = self.distances_batch([bow])[0]
+        return distances if rows is None else distances[rows]
+
+    def top_k_batch(self, bows, k=None):
+        """Best database matches for several query BoW vectors
+
+        Each worker finds the k best matches of its shard, and these are merged.
+
+        Returns
+        --------------
+        List of Q (indices, distances) array tuples, sorted by distance.
+        The indices refer to :attr:`key_order`.
+        """
+        if len(self._key_order) == 0 or self.idf is None:
+            return [(np.zeros(0, dtype='int'), np.zeros(0)) for _ in bows]
+        shard_results = self._broadcast('top_k', bows, k)
+        results = []
+        for q in range(len(bows)):
+            indices = np.concatenate([shard[q][0] + start for shard, (start, _) in zip(shard_results,
+                                                                                       self.shard_bounds)])
+            distances = np.concatenate([shard[q][1] for shard in shard_results])
+            best = top_k(distances, k)
+            results.append((indices[best], distances[best]))
+        return results
+
+    def query_bow(self, bow, max_results=None):
+        """Query the database by a BoW vector
+
+        Returns
+        --------------
+        Sorted list of database matches [(key1, distance1), (key2, distance2), ...] where distance1 < distance2.
+        """
+        indices, distances = self.top_k_batch([bow], max_results)[0]
+        return [(self._key_order[i], d) for i, d in zip(indices, distances)]
+
+    def query_bows(self, bows, max_results=None):
+        """Query the database by several BoW vectors
+
+        Returns
+        --------------
+        List of sorted match lists [(key1, distance1), (key2, distance2), ...], one per query
+        """
+        return [[(self._key_order[i], d) for i, d in zip(indices, distances)]
+                for indices, distances in self.top_k_batch(bows, max_results)]
+
+    def query_image(self, image, roi, max_results=None):
+        return self.query_bow(self.database.bag(self.database.descriptors_for_image(image, roi)), max_results)
+
+    def query_path(self, path, roi, max_results=None):
+        return self.query_bow(self.database.bow_for_path(path, roi), max_results)
+
+
+def benchmark_shards(database, bows, shard_counts, max_results=10, batch_size=1, repeats=3):
+    """Measure query throughput for different numbers of shards
+
+    Parameters
+    ---------------
+    database : BagOfWordsDatabase
+        Database to shard
+    bows : list
+        Query BoW vectors
+    shard_counts : list
+        Numbers of shards (worker processes) to measure
+    max_results : int
+        Number of matches per query
+    batch_size : int
+        Number of queries sent to the workers at a time
+    repeats : int
+        The best of this many runs is used
+
+    Returns
+    --------------
+    List of dicts with keys 'shards', 'seconds', 'queries_per_second', 'speedup' and 'efficiency',
+    where speedup and efficiency are relative to the first shard count
+    """
+    results = []
+    for n_shards in shard_counts:
+        with ShardedDatabase(database, n_shards) as sharded:
+            sharded.top_k_batch(bows[:1], max_results)  # Warm up the workers
+            best = float('inf')
+            for _ in range(repeats):
+                t0 = time.perf_counter()
+                for start in range(0, len(bows), batch_size):
+                    sharded.top_k_batch(bows[start:start + batch_size], max_results)
+                best = min(best, time.perf_counter() - t0)
+        results.append({'shards': sharded.n_shards, 'seconds': best, 'queries_per_second': len(bows) / best})
+
+    base = results[0]
+    for r in results:
+        r['speedup'] = base['seconds'] / r['seconds']
+        r['efficiency'] = r['speedup'] * base['shards'] / r['shards']
+    return results
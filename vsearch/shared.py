@@ -0,0 +1,125 @@
+# Copyright 2017 Hannes Ovrén
+#
+# This file is part of vsearch.
+#
+# vsearch is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# vsearch is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with vsearch.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Read-only data shared between processes
+
+Arrays are published once in shared memory by the main process, and worker processes attach to them, e.g. in a
+:class:`multiprocessing.Pool` initializer. This way the memory use and startup time of the workers do not grow with
+the size of the data, and nothing needs to be pickled per task.
+"""
+
+from multiprocessing import shared_memory
+
+import numpy as np
+
+# Shared memory blocks attached by this process, which must stay open while their arrays are used
+_attached = []
+
+# Names of the shared memory blocks created by this process
+_created = set()
+
+
+def share_array(array):
+    """Copy an array into a new shared memory block
+
+    Returns
+    --------------
+    shm : multiprocessing.shared_memory.SharedMemory
+        The shared memory block, which the caller must close and unlink
+    spec : tuple
+        Picklable (name, shape, dtype) description used by :func:`attach_array`
+    """
+    array = np.ascontiguousarray(array)
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    _created.add(shm.name)
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+    return shm, (shm.name, array.shape, array.dtype.str)
+
+
+def attach_array(spec):
+    """Attach to an array created by :func:`share_array`
+
+    Returns
+    --------------
+    (shm, array) where `shm` must be kept alive as long as `array` is used
+    """
+    name, shape, dtype = spec
+    try:
+        shm = shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Before Python 3.13 attaching registers the block with the resource tracker, which would then unlink it
+        # (or warn about it) when this process exits, although it is owned by the creating process.
+        # The registration of just this block is undone. The tracker keeps one registration per name, so a block
+        # created by this process keeps the registration of its creation.
+        from multiprocessing import resource_tracker
+        shm = shared_memory.SharedMemory(name=name)
+        if name not in _created:
+            resource_tracker.unregister(shm._name, 'shared_memory')
+    return shm, np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+
+
+class SharedArrays:
+    """A set of named arrays published in shared memory
+
+    The picklable :attr:`specs` are passed to worker processes, which get the arrays with :func:`attach_arrays`.
+    The shared memory is freed by :meth:`close`, or when used as a context manager, at exit.
+    """
+    def __init__(self, arrays):
+        """Copy arrays into shared memory
+
+        Parameters
+        -------------
+        arrays : dict
+            Mapping from name to array
+        """
+        self._blocks = []
+        self.specs = {}
+        for name, array in arrays.items():
+            shm, spec = share_array(array)
+            self._blocks.append(shm)
+            self.specs[name] = spec
+
+    def close(self):
+        for shm in self._blocks:
+            shm.close()
+            shm.unlink()
+            _created.discard(shm.name)
+        self._blocks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def attach_arrays(specs):
+    """Attach to the arrays of a :class:`SharedArrays`, using its `specs`
+
+    The shared memory stays attached for the life of the process.
+
+    Returns
+    -------------
+    Mapping from name to (read-only) array
+    """
+    arrays = {}
+    for name, spec in specs.items():
+        shm, array = attach_array(spec)
+        array.flags.writeable = False
+        _attached.append(shm)
+        arrays[name] = array
+    return arrays
@@ -15,14 +15,89 @@
 # You should have received a copy of the GNU General Public License
 # along with vsearch.  If not, see <http://www.gnu.org/licenses/>.
 
+import collections
+import json
 import os
 
-import cv2
+import numpy as np
 
-from vsearch.utils import filter_roi, FEATURE_TYPES
+from vsearch import instrumentation
+from vsearch.lazy import lazy_import
+from vsearch.utils import roi_mask, FEATURE_TYPES
+
+cv2 = lazy_import('cv2')
+h5py = lazy_import('h5py')
 
 SIFT = FEATURE_TYPES['sift']
 
+KeypointPolicy = collections.namedtuple('KeypointPolicy', 'max_side max_keypoints grid min_distance')
+"""How many and which keypoints are kept when features are extracted from an image
+
+.. py:attribute:: max_side
+
+    Keypoints are detected in a copy of the image that is downscaled such that its longest side is at most this
+    many pixels. Keypoint locations and sizes are always given in the coordinates of the original image.
+    None to detect in the original image.
+
+.. py:attribute:: max_keypoints
+
+    Maximum number of keypoints per image, or None to keep all of them.
+    The image is divided into a `grid` x `grid` grid, and the keypoints with the strongest response in each cell
+    are selected in turn, such that a textured part of the image can not use up the whole budget.
+
+.. py:attribute:: grid
+
+    Number of grid cells along each side of the image
+
+.. py:attribute:: min_distance
+
+    Only the strongest keypoint in each `min_distance` x `min_distance` pixel cell is kept, which removes
+    keypoints that are detected at (almost) the same location, e.g. with different orientations.
+    0 to keep all of them.
+"""
+
+DEFAULT_KEYPOINT_POLICY = KeypointPolicy(max_side=None, max_keypoints=None, grid=4, min_distance=0.)
+
+KEYPOINT_POLICY_ATTRIBUTE = 'keypoint_policy'
+
+
+def keypoint_policy_attrs(policy):
+    """HDF5 attributes that record a keypoint policy, for descriptor and database files"""
+    return {KEYPOINT_POLICY_ATTRIBUTE: json.dumps(policy._asdict())}
+
+
+def keypoint_policy_from_attrs(attrs):
+    """The keypoint policy recorded in HDF5 attributes, or None if no policy is recorded"""
+    if KEYPOINT_POLICY_ATTRIBUTE not in attrs:
+        return None
+    fields = DEFAULT_KEYPOINT_POLICY._asdict()
+    fields.update(json.loads(attrs[KEYPOINT_POLICY_ATTRIBUTE]))
+    return KeypointPolicy(**fields)
+
+
+def add_keypoint_policy_arguments(parser, description=None):
+    """Add command line options for a keypoint policy to an argparse parser"""
+    group = parser.add_argument_group('keypoint policy', description)
+    group.add_argument('--max-side', type=int, metavar='PIXELS',
+                       help='detect keypoints in images downscaled to at most this size (default is full size)')
+    group.add_argument('--max-keypoints', type=int, metavar='N',
+                       help='keep at most this many keypoints per image (default is all)')
+    group.add_argument('--grid', type=int, default=DEFAULT_KEYPOINT_POLICY.grid, metavar='CELLS',
+                       help='spread the kept keypoints over a CELLS x CELLS grid (default %(default)d)')
+    group.add_argument('--min-distance', type=float, default=DEFAULT_KEYPOINT_POLICY.min_distance, metavar='PIXELS',
+                       help='keep only the strongest keypoint within each PIXELS x PIXELS cell (default is all)')
+
+
+def keypoint_policy_from_args(args):
+    """The keypoint policy given by the options of :func:`add_keypoint_policy_arguments`"""
+    return KeypointPolicy(args.max_side, args.max_keypoints, args.grid, args.min_distance)
+
+
+def load_keypoint_policy(path):
+    """The keypoint policy recorded in a descriptor or database file, or None if no policy is recorded"""
+    with h5py.File(path, 'r') as f:
+        return keypoint_policy_from_attrs(f.attrs)
+
 
 def sift_file_for_image(path):
     """Return SIFT descriptor filename corresponding to an image path"""
@@ -31,7 +106,74 @@ def sift_file_for_image(path):
     return sift_file
 
 
-def calculate_sift(image, roi=None, only_keypoints=False):
+def sift_detector():
+    """A SIFT detector, from the main OpenCV module if available (OpenCV >= 4.4) and otherwise from the contrib
+    modules"""
+    if hasattr(cv2, 'SIFT_create'):
+        return cv2.SIFT_create()
+    return cv2.xfeatures2d.SIFT_create()
+
+
+def select_keypoints(keypoints, image_shape, policy):
+    """Select keypoints according to a keypoint policy
+
+    The `max_side` of the policy is not used, since the keypoints are already detected.
+
+    Parameters
+    --------------
+    keypoints : list
+        List of cv2.Keypoint objects
+    image_shape : tuple
+        Shape of the image the keypoints were detected in
+    policy : KeypointPolicy
+        The policy
+
+    Returns
+    -------------
+    The selected keypoints, in their original order
+    """
+    if not keypoints:
+        return keypoints
+    points = np.array([kp.pt for kp in keypoints], dtype='float64')
+    response = np.array([kp.response for kp in keypoints], dtype='float64')
+    selected = np.arange(len(keypoints))
+
+    if policy.min_distance > 0:
+        # Keep the first keypoint in each cell, in order of decreasing response
+        order = np.argsort(-response, kind='stable')
+        cells = np.floor(points[order] / policy.min_distance).astype('int64')
+        _, first = np.unique(cells, axis=0, return_index=True)
+        selected = np.sort(order[first])
+
+    if policy.max_keypoints is not None and len(selected) > policy.max_keypoints:
+        H, W = image_shape[:2]
+        grid = max(policy.grid, 1)
+        column = np.clip((points[selected, 0] * grid / W).astype('int64'), 0, grid - 1)
+        row = np.clip((points[selected, 1] * grid / H).astype('int64'), 0, grid - 1)
+        cell = row * grid + column
+
+        # Rank of each keypoint within its cell, the strongest keypoint having rank 0
+        order = np.lexsort((-response[selected], cell))
+        sorted_cells = cell[order]
+        cell_start = np.flatnonzero(np.r_[True, sorted_cells[1:] != sorted_cells[:-1]])
+        starts = np.repeat(cell_start, np.diff(np.r_[cell_start, len(order)]))
+        rank = np.empty(len(order), dtype='int64')
+        rank[order] = np.arange(len(order)) - starts
+
+        # All keypoints of rank 0, then rank 1, and so on, by decreasing response within a rank
+        keep = np.lexsort((-response[selected], rank))[:policy.max_keypoints]
+        selected = np.sort(selected[keep])
+
+    return [keypoints[i] for i in selected]
+
+
+def _scaled_keypoint(kp, factor):
+    x, y = kp.pt
+    return cv2.KeyPoint(x * factor, y * factor, kp.size * factor, kp.angle, kp.response, kp.octave, kp.class_id)
+
+
+@instrumentation.timed('sift.calculate')
+def calculate_sift(image, roi=None, only_keypoints=False, policy=None):
     """Calculate SIFT descriptors and/or keypoints
 
     Parameters
@@ -43,6 +185,9 @@ def calculate_sift(image, roi=None, only_keypoints=False):
         If None, then the whole image is used
     only_keypoints : bool
         If True then only keypoints will be computed
+    policy : KeypointPolicy
+        Which keypoints to keep. The policy is applied to the whole image, before the region of interest.
+        If None, then all detected keypoints are kept.
 
     Returns
     -------------
@@ -51,19 +196,29 @@ def calculate_sift(image, roi=None, only_keypoints=False):
     keypoints : list
         List of N cv2.Keypoint objects
     """
-    detector = cv2.xfeatures2d.SIFT_create()
-    if roi is None: # Entire image
-        if only_keypoints:
-            kps = detector.detect(image)
-            des = None
-        else:
-            kps, des = detector.detectAndCompute(image, None)
-    else:
-        kps = detector.detect()
-        _, kps = filter_roi([], kps, roi)
-        if not only_keypoints:
-            des = detector.compute(kps)
-        else:
-            des = None
-
-    return des, kps
\ No newline at end of file
+    if policy is None:
+        policy = DEFAULT_KEYPOINT_POLICY
+    detector = sift_detector()
+
+    H, W = image.shape[:2]
+    scale = 1.
+    if policy.max_side is not None and max(H, W) > policy.max_side:
+        scale = policy.max_side / max(H, W)
+        size = (max(int(round(W * scale)), 1), max(int(round(H * scale)), 1))
+        image = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+
+    kps = detector.detect(image)
+    instrumentation.count('sift.keypoints_detected', len(kps))
+    kps = select_keypoints(kps, image.shape, policy._replace(min_distance=policy.min_distance * scale))
+    if roi is not None:
+        points = np.array([kp.pt for kp in kps]).reshape(-1, 2) / scale
+        kps = [kps[i] for i in np.flatnonzero(roi_mask(points, roi))]
+
+    des = None
+    if not only_keypoints:
+        kps, des = detector.compute(image, kps)
+    if scale != 1.:
+        kps = [_scaled_keypoint(kp, 1 / scale) for kp in kps]
+
+    instrumentation.count('sift.keypoints', len(kps))
+    return des, kps
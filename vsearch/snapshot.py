@@ -0,0 +1,409 @@
+# Copyright 2017 Hannes Ovrén
+#
+# This file is part of vsearch.
+#
+# vsearch is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# vsearch is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with vsearch.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Single-file database snapshots
+
+A snapshot holds everything needed to query a :class:`vsearch.database.DatabaseWithLocation` around a
+:class:`vsearch.database.SiftColornamesWrapper`: for both the SIFT and colornames databases the vocabulary, a
+prebuilt annoy index, the keys, the BoW vectors and normalized TF-IDF vectors as sparse matrices, the IDF weights and
+the stored keypoint words, and the image locations.
+
+The file starts with a 16 byte magic string, the length of a JSON header as a little-endian uint64, and the header.
+The header lists the dtype, shape, offset and CRC-32 checksum of each array. The arrays follow, aligned to 4096
+bytes, such that they can be memory mapped directly. Opening a snapshot therefore only reads the header and the keys.
+
+Annoy can only memory map an index from a file of its own, so the index is copied into a cache directory the first
+time a snapshot is opened, and reused after that.
+"""
+
+import glob
+import hashlib
+import json
+import os
+import struct
+import tempfile
+import time
+import zlib
+
+import numpy as np
+
+from .cache import user_cache_directory
+from .database import (DatabaseError, DatabaseWithLocation, SiftColornamesWrapper, SiftFeatureDatabase,
+                       ColornamesFeatureDatabase, KEYPOINT_WORDS_GROUP, KEYPOINT_POINTS_GROUP, dataset_name)
+from .lazy import lazy_import
+from .sift import KeypointPolicy
+
+annoy = lazy_import('annoy')
+h5py = lazy_import('h5py')
+sparse = lazy_import('scipy.sparse')
+
+SNAPSHOT_MAGIC = b'VSEARCH-SNAPSHOT'
+SNAPSHOT_VERSION = 1
+ALIGNMENT = 4096
+
+DATABASES = (('sift', SiftFeatureDatabase), ('colornames', ColornamesFeatureDatabase))
+
+
+class SnapshotError(DatabaseError):
+    """The snapshot file is not valid"""
+    pass
+
+
+def _align(n):
+    return (n + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def _encode_keys(keys):
+    for key in keys:
+        if '\n' in key:
+            raise SnapshotError("Keys can not contain newlines: {!r}".format(key))
+    return np.frombuffer('\n'.join(keys).encode('utf-8'), dtype='uint8')
+
+
+def _decode_keys(array):
+    return array.tobytes().decode('utf-8').split('\n') if len(array) else []
+
+
+def _vocabulary(db):
+    return np.array([db.annoy_index.get_item_vector(i) for i in range(db.vocabulary_size)], dtype='float32')
+
+
+def _annoy_index_bytes(vocabulary, n_trees):
+    # The index is built again instead of saving the index of the database, since saving an annoy index reloads it
+    # from the saved file
+    index = annoy.AnnoyIndex(vocabulary.shape[1], metric='euclidean')
+    for i, x in enumerate(vocabulary):
+        index.add_item(i, x)
+    index.build(n_trees)
+    with tempfile.TemporaryDirectory(prefix='vsearch_snapshot_') as directory:
+        path = os.path.join(directory, 'index.ann')
+        index.save(path)
+        index.unload()
+        with open(path, 'rb') as f:
+            return np.frombuffer(f.read(), dtype='uint8')
+
+
+def _csr_arrays(matrix):
+    return {'data': matrix.data, 'indices': matrix.indices, 'indptr': matrix.indptr}
+
+
+def _stored_keypoints(db, keys):
+    """Concatenated keypoint words and points of all keys, and the offset of each key, or None"""
+    if db.database_file is None:
+        return None
+    with h5py.File(db.database_file, 'r') as f:
+        if KEYPOINT_WORDS_GROUP not in f or KEYPOINT_POINTS_GROUP not in f:
+            return None
+        words_group = f[KEYPOINT_WORDS_GROUP]
+        points_group = f[KEYPOINT_POINTS_GROUP]
+        names = [dataset_name(key) for key in keys]
+        if not all(name in words_group and name in points_group for name in names):
+            return None
+        words = [words_group[name][()].astype('int32') for name in names]
+        points = [points_group[name][()].astype('float32').reshape(-1, 2) for name in names]
+    offsets = np.cumsum([0] + [len(w) for w in words]).astype('int64')
+    return {'keypoint_offsets': offsets,
+            'keypoint_words': np.concatenate(words) if words else np.zeros(0, dtype='int32'),
+            'keypoint_points': np.vstack(points) if points else np.zeros((0, 2), dtype='float32')}
+
+
+def _counts_matrix(db, keys):
+    """Sparse matrix of the raw word frequencies of all keys, built row by row without a dense NxK matrix"""
+    indptr = [0]
+    indices = []
+    data = []
+    for key in keys:
+        bow = np.asarray(db[key], dtype='float64')
+        words = np.flatnonzero(bow)
+        indices.append(words)
+        data.append(bow[words])
+        indptr.append(indptr[-1] + len(words))
+    data = np.concatenate(data) if data else np.zeros(0)
+    indices = np.concatenate(indices) if indices else np.zeros(0, dtype='int')
+    return sparse.csr_matrix((data, indices, indptr), shape=(len(keys), db.vocabulary_size))
+
+
+def _database_arrays(db):
+    keys = list(db.key_order)  # Also brings the scoring matrix up to date
+    counts = _counts_matrix(db, keys)
+    vocabulary = _vocabulary(db)
+    arrays = {'keys': _encode_keys(keys),
+              'vocabulary': vocabulary,
+              'annoy_index': _annoy_index_bytes(vocabulary, db.n_trees),
+              'idf': np.asarray(db.idf if db.idf is not None else np.zeros(db.vocabulary_size), dtype='float64'),
+              'word_counts': np.asarray(db._word_counts, dtype='int64'),
+              'stop_words': np.asarray(db.stop_words, dtype='int64')}
+    arrays.update({'counts_' + name: a for name, a in _csr_arrays(counts).items()})
+    arrays.update({'scoring_' + name: a for name, a in _csr_arrays(db._scoring_matrix).items()})
+    keypoints = _stored_keypoints(db, keys)
+    if keypoints is not None:
+        arrays.update(keypoints)
+    return arrays
+
+
+def write_snapshot(path, database):
+    """Write a snapshot of a database
+
+    Parameters
+    -------------
+    path : str
+        Snapshot file. It is written to a temporary file first, and then moved in place.
+    database : DatabaseWithLocation or SiftColornamesWrapper
+        The database. Locations are only included for a :class:`vsearch.database.DatabaseWithLocation`.
+    """
+    wrapper = database.visualdb if isinstance(database, DatabaseWithLocation) else database
+    arrays = {}
+    meta = {'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'n_trees': {}, 'keypoint_policy': {}, 'stop_words': {}}
+    for name, _ in DATABASES:
+        db = wrapper.sift_db if name == 'sift' else wrapper.cname_db
+        meta['n_trees'][name] = db.n_trees
+        if db.keypoint_policy is not None:
+            meta['keypoint_policy'][name] = db.keypoint_policy._asdict()
+        meta['stop_words'][name] = {'fraction': db._stop_fraction, 'min_idf': db._stop_min_idf}
+        for array_name, array in _database_arrays(db).items():
+            arrays[name + '/' + array_name] = array
+    if isinstance(database, DatabaseWithLocation):
+        keys, latlngs = database.location_arrays()
+        arrays['locations/keys'] = _encode_keys(keys)
+        arrays['locations/latlngs'] = latlngs
+
+    # The header size depends on the offsets, which depend on the header size
+    entries = {name: {'dtype': np.asarray(a).dtype.str, 'shape': list(np.shape(a)),
+                      'crc32': zlib.crc32(np.ascontiguousarray(a).tobytes())} for name, a in arrays.items()}
+    header_size = 0
+    while True:
+        offset = _align(header_size)
+        for name, a in arrays.items():
+            entries[name]['offset'] = offset
+            offset = _align(offset + np.asarray(a).nbytes)
+        header = json.dumps({'version': SNAPSHOT_VERSION, 'meta': meta, 'arrays': entries}).encode('utf-8')
+        size = len(SNAPSHOT_MAGIC) + 8 + len(header)
+        if _align(size) == _align(header_size):
+            break
+        header_size = size
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(SNAPSHOT_MAGIC + struct.pack('<Q', len(header)) + header)
+        for name, a in arrays.items():
+            f.seek(entries[name]['offset'])
+            f.write(np.ascontiguousarray(a).tobytes())
+        f.truncate(offset)
+    os.replace(tmp_path, path)
+
+
+class Snapshot:
+    """Memory mapped snapshot file"""
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            magic = f.read(len(SNAPSHOT_MAGIC))
+            if magic != SNAPSHOT_MAGIC:
+                raise SnapshotError("{} is not a vsearch snapshot".format(path))
+            try:
+                header_length, = struct.unpack('<Q', f.read(8))
+                header = json.loads(f.read(header_length).decode('utf-8'))
+            except (struct.error, ValueError) as e:
+                raise SnapshotError("Invalid snapshot header in {}: {}".format(path, e))
+        if header.get('version') != SNAPSHOT_VERSION:
+            raise SnapshotError("Unsupported snapshot version {}".format(header.get('version')))
+        self.meta = header['meta']
+        self.entries = header['arrays']
+        self.size = os.path.getsize(path)
+        for name, entry in self.entries.items():
+            if entry['offset'] + self._nbytes(entry) > self.size:
+                raise SnapshotError("Array {} is outside of the file; the snapshot is truncated".format(name))
+        self._mmap = np.memmap(path, dtype='uint8', mode='r')
+
+    @staticmethod
+    def _nbytes(entry):
+        return int(np.prod(entry['shape'], dtype='int64')) * np.dtype(entry['dtype']).itemsize
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def array(self, name):
+        """Read-only, memory mapped array"""
+        entry = self.entries[name]
+        dtype = np.dtype(entry['dtype'])
+        count = int(np.prod(entry['shape'], dtype='int64'))
+        return np.frombuffer(self._mmap, dtype=dtype, count=count, offset=entry['offset']).reshape(entry['shape'])
+
+    def keys(self, name):
+        return _decode_keys(self.array(name))
+
+    def csr_matrix(self, prefix, shape):
+        return sparse.csr_matrix((self.array(prefix + 'data'), self.array(prefix + 'indices'),
+                                  self.array(prefix + 'indptr')), shape=shape, copy=False)
+
+    def checksum_errors(self):
+        """Names of the arrays whose contents do not match their checksum"""
+        return [name for name, entry in self.entries.items()
+                if zlib.crc32(self.array(name).tobytes()) != entry['crc32']]
+
+    def annoy_index_file(self, name, cache_directory=None):
+        """Path to a copy of the annoy index of a database, in the cache directory
+
+        The copy is made if it does not exist yet. There is one copy per snapshot path and database, so copies made
+        for earlier versions of the snapshot file are removed.
+        """
+        if cache_directory is None:
+            cache_directory = user_cache_directory('annoy')
+        stat = os.stat(self.path)
+        entry = self.entries[name + '/annoy_index']
+        prefix = _sha1(repr((os.path.abspath(self.path), name)))
+        version = _sha1(repr((stat.st_size, stat.st_mtime_ns, entry['offset'], entry['crc32'])))
+        path = os.path.join(cache_directory, '{}-{}.ann'.format(prefix, version))
+        if not os.path.exists(path):
+            os.makedirs(cache_directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(suffix='.ann.tmp', dir=cache_directory)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(self.array(name + '/annoy_index').data)
+            os.replace(tmp_path, path)
+            for stale in glob.glob(os.path.join(cache_directory, prefix + '-*.ann')):
+                if stale != path:
+                    try:
+                        os.remove(stale)
+                    except OSError:
+                        pass  # E.g. still in use by another process on Windows
+        return path
+
+
+def _sha1(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+class _KeypointTable:
+    def __init__(self, snapshot, prefix, key_index):
+        self.offsets = snapshot.array(prefix + 'keypoint_offsets')
+        self.words = snapshot.array(prefix + 'keypoint_words')
+        self.points = snapshot.array(prefix + 'keypoint_points')
+        self.key_index = key_index
+
+    def __call__(self, key):
+        i = self.key_index[key]
+        start, stop = self.offsets[i], self.offsets[i + 1]
+        return self.words[start:stop], self.points[start:stop]
+
+
+def _open_database(snapshot, name, db_class, cache_directory, feature_cache_bytes):
+    prefix = name + '/'
+    vocabulary = snapshot.array(prefix + 'vocabulary')
+    db = db_class(vocabulary, feature_cache_bytes, n_trees=snapshot.meta['n_trees'][name],
+                  annoy_index_file=snapshot.annoy_index_file(name, cache_directory))
+    keys = snapshot.keys(prefix + 'keys')
+    shape = (len(keys), len(vocabulary))
+    idf = snapshot.array(prefix + 'idf') if keys else None
+    db._load_state(keys, snapshot.csr_matrix(prefix + 'counts_', shape), idf,
+                   snapshot.array(prefix + 'word_counts'), snapshot.csr_matrix(prefix + 'scoring_', shape))
+    # The stored IDF weights of stop words are already zero
+    stop_words = snapshot.meta.get('stop_words', {}).get(name)
+    if stop_words is not None:
+        db._stop_fraction = stop_words['fraction']
+        db._stop_min_idf = stop_words['min_idf']
+        db.stop_words = snapshot.array(prefix + 'stop_words')
+    policy = snapshot.meta.get('keypoint_policy', {}).get(name)
+    if policy is not None:
+        db.keypoint_policy = KeypointPolicy(**policy)
+    if prefix + 'keypoint_offsets' in snapshot:
+        db.stored_keypoints = _KeypointTable(snapshot, prefix, db._key_index)
+    return db
+
+
+def open_snapshot(path, cache_directory=None, feature_cache_bytes=256 * 2**20):
+    """Open a database snapshot
+
+    The SIFT and colornames databases are read-only, while locations can still be changed.
+
+    Parameters
+    -------------
+    path : str
+        Snapshot file
+    cache_directory : str
+        Directory for the copies of the annoy indices. If None, a directory in the user cache directory is used.
+    feature_cache_bytes : int
+        Memory budget for cached query features of each database
+
+    Returns
+    -------------
+    A :class:`vsearch.database.DatabaseWithLocation`
+    """
+    snapshot = Snapshot(path)
+    databases = [_open_database(snapshot, name, db_class, cache_directory, feature_cache_bytes)
+                 for name, db_class in DATABASES]
+    database = DatabaseWithLocation(SiftColornamesWrapper(*databases))
+    if 'locations/keys' in snapshot:
+        database._set_locations(snapshot.keys('locations/keys'), snapshot.array('locations/latlngs'))
+    database.snapshot = snapshot
+    return database
+
+
+def verify_snapshot(path, database=None, samples=10, cache_directory=None):
+    """Check a snapshot file
+
+    Parameters
+    -------------
+    path : str
+        Snapshot file
+    database : DatabaseWithLocation or SiftColornamesWrapper
+        If given, the snapshot is also compared to this database: the keys, IDF weights, locations and the
+        distances of some sample queries must be the same.
+    samples : int
+        Number of database images used as sample queries
+    cache_directory : str
+        See :func:`open_snapshot`
+
+    Returns
+    -------------
+    List of problems found. The snapshot is valid if the list is empty.
+    """
+    try:
+        snapshot = Snapshot(path)
+    except (SnapshotError, OSError) as e:
+        return [str(e)]
+    problems = ['Checksum mismatch in {}'.format(name) for name in snapshot.checksum_errors()]
+    if problems:
+        return problems
+
+    try:
+        opened = open_snapshot(path, cache_directory)
+    except Exception as e:
+        return ['Failed to open snapshot: {}: {}'.format(type(e).__name__, e)]
+
+    if database is None:
+        return problems
+    wrapper = database.visualdb if isinstance(database, DatabaseWithLocation) else database
+    for name, db, snap_db in (('sift', wrapper.sift_db, opened.visualdb.sift_db),
+                              ('colornames', wrapper.cname_db, opened.visualdb.cname_db)):
+        if list(db.key_order) != list(snap_db.key_order):
+            problems.append('The {} keys differ'.format(name))
+            continue
+        if db.idf is not None and not np.allclose(db.idf, snap_db.idf):
+            problems.append('The {} IDF weights differ'.format(name))
+        keys = db.key_order
+        for i in np.linspace(0, len(keys) - 1, min(samples, len(keys))).astype('int'):
+            bow = db[keys[i]]
+            if not np.allclose(db.distances(bow), snap_db.distances(bow)):
+                problems.append('The {} distances of {} differ'.format(name, keys[i]))
+    if isinstance(database, DatabaseWithLocation):
+        keys, latlngs = database.location_arrays()
+        snap_locations = dict(zip(*opened.location_arrays()))
+        if len(snap_locations) != len(keys) or any(key not in snap_locations or
+                                                  not np.allclose(snap_locations[key], latlng)
+                                                  for key, latlng in zip(keys, latlngs)):
+            problems.append('The locations differ')
+    return problems
@@ -0,0 +1,213 @@
+# Copyright 2017 Hannes Ovrén
+#
+# This file is part of vsearch.
+#
+# vsearch is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# vsearch is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with vsearch.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Downscaled image previews with memory and disk caching"""
+
+import hashlib
+import os
+import tempfile
+import threading
+
+from .cache import LRUCache, file_cache_key, user_cache_directory
+from .lazy import lazy_import
+
+cv2 = lazy_import('cv2')
+
+_reduced_read_modes = None
+
+
+def reduced_read_modes():
+    """(factor, imread flag) pairs for decoding at 1/8, 1/4, 1/2 and full resolution, built at first use"""
+    global _reduced_read_modes
+    if _reduced_read_modes is None:
+        _reduced_read_modes = [
+            (8, cv2.IMREAD_REDUCED_COLOR_8),
+            (4, cv2.IMREAD_REDUCED_COLOR_4),
+            (2, cv2.IMREAD_REDUCED_COLOR_2),
+            (1, cv2.IMREAD_COLOR),
+        ]
+    return _reduced_read_modes
+
+
+def __getattr__(name):
+    # The flags are looked up lazily, such that importing this module (e.g. through vsearch.gui) does not import cv2
+    if name == 'REDUCED_READ_MODES':
+        return reduced_read_modes()
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+def default_cache_directory():
+    """Directory for on-disk preview caches, following the XDG base directory convention"""
+    return user_cache_directory('previews')
+
+
+def decode_reduced(path, max_side):
+    """Decode an image at reduced resolution
+
+    The image is decoded at the smallest of 1/8, 1/4, 1/2 or full resolution that still has a longest side of at least
+    `max_side`, which for JPEG files is much faster than decoding at full resolution.
+    It is then resized such that the longest side is at most `max_side`.
+
+    Parameters
+    -------------
+    path : str
+        Path to the image
+    max_side : int
+        Maximum length of the longest side of the returned image
+
+    Returns
+    -------------
+    RGB image array
+    """
+    smallest = cv2.imread(path, cv2.IMREAD_REDUCED_COLOR_8)
+    if smallest is None:
+        raise IOError("Failed to read image '{}'".format(path))
+
+    full_side = 8 * max(smallest.shape[:2])
+    for factor, flag in reduced_read_modes():
+        if factor == 1 or full_side / factor >= max_side:
+            break
+    image = smallest if factor == 8 else cv2.imread(path, flag)
+
+    longest = max(image.shape[:2])
+    if longest > max_side:
+        scale = max_side / longest
+        size = (max(1, int(round(image.shape[1] * scale))), max(1, int(round(image.shape[0] * scale))))
+        image = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+
+class PreviewCache:
+    """Downscaled image previews, cached in memory and optionally on disk
+
+    Previews are keyed by image path and modification time, such that changed images get new previews.
+    The on-disk cache is bounded by a byte budget, and its least recently used files are removed to stay within it.
+    The cache is safe to use from several threads.
+    """
+    def __init__(self, max_side=1024, memory_bytes=128 * 2**20, directory=None, disk_bytes=512 * 2**20):
+        """Create the cache
+
+        Parameters
+        -------------
+        max_side : int
+            Maximum length of the longest side of the previews
+        memory_bytes : int
+            Memory budget of the in-memory LRU cache
+        directory : str
+            Directory for the on-disk cache. If None, previews are only cached in memory.
+        disk_bytes : int
+            Size budget of the on-disk cache
+        """
+        self.max_side = max_side
+        self.memory = LRUCache(memory_bytes)
+        self.directory = directory
+        self.disk_bytes = disk_bytes
+        self._disk_lock = threading.Lock()
+        self._disk_usage = 0
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            self._disk_usage = sum(size for _, size, _ in self._disk_files())
+
+    def _key(self, path):
+        return file_cache_key(path) + (self.max_side,)
+
+    def _disk_path(self, key):
+        digest = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, digest + '.png')
+
+    def cached(self, path):
+        """Return the preview if it is in the memory cache, otherwise None"""
+        try:
+            return self.memory.get(self._key(path))
+        except OSError:
+            return None
+
+    def get(self, path):
+        """Return the preview of an image, decoding it if it is not cached
+
+        Raises
+        -------------
+        IOError if the image can not be read
+        """
+        key = self._key(path)
+        image = self.memory.get(key)
+        if image is not None:
+            return image
+
+        disk_path = self._disk_path(key) if self.directory is not None else None
+        if disk_path is not None and os.path.exists(disk_path):
+            image = cv2.imread(disk_path)
+            if image is not None:
+                image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+                try:
+                    os.utime(disk_path)  # The modification time marks the file as recently used
+                except OSError:
+                    pass
+
+        if image is None:
+            image = decode_reduced(path, self.max_side)
+            if disk_path is not None:
+                self._write(disk_path, image)
+
+        self.memory.put(key, image)
+        return image
+
+    def _write(self, disk_path, image):
+        # Write to a temporary file first, such that concurrent readers never see a partial file
+        fd, tmp_path = tempfile.mkstemp(prefix='.', suffix='.png', dir=self.directory)
+        os.close(fd)
+        try:
+            if cv2.imwrite(tmp_path, cv2.cvtColor(image, cv2.COLOR_RGB2BGR)):
+                size = os.path.getsize(tmp_path)
+                os.replace(tmp_path, disk_path)
+                with self._disk_lock:
+                    self._disk_usage += size
+                    if self._disk_usage > self.disk_bytes:
+                        self._prune(keep=disk_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _disk_files(self):
+        """(path, size, modification time) of the previews in the cache directory"""
+        files = []
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                # Temporary files being written start with '.'
+                if entry.name.endswith('.png') and not entry.name.startswith('.') and entry.is_file():
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        continue  # Removed by another process
+                    files.append((entry.path, stat.st_size, stat.st_mtime_ns))
+        return files
+
+    def _prune(self, keep):
+        # The directory is listed again, since other processes may share it
+        files = sorted(self._disk_files(), key=lambda f: f[2])
+        self._disk_usage = sum(size for _, size, _ in files)
+        for path, size, _ in files:
+            if self._disk_usage <= self.disk_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self._disk_usage -= size
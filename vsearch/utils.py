@@ -17,11 +17,16 @@
 
 import os
 import collections
+import fnmatch
 
-import cv2
-import h5py
 import numpy as np
 
+from . import instrumentation
+from .lazy import lazy_import
+
+cv2 = lazy_import('cv2')
+h5py = lazy_import('h5py')
+
 
 FeatureType = collections.namedtuple('FeatureType', 'key name extension featsize')
 
@@ -30,9 +35,32 @@ FEATURE_TYPES = {
     'colornames': FeatureType('colornames', 'colornames', '.cname.h5', 11)
 }
 
-SUPPORTED_IMAGE_EXTENSIONS = ('.jpg', '.png')
+# File extensions of images, compared without regard to case
+SUPPORTED_IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.tif', '.tiff', '.bmp', '.webp', '.jp2', '.pgm', '.ppm')
+
+# Attributes of spatially sorted descriptor files
+SPATIAL_GRID_ATTRIBUTE = 'spatial_grid'
+SPATIAL_CELL_SIZE_ATTRIBUTE = 'spatial_cell_size'
+
+ImageFile = collections.namedtuple('ImageFile', 'path key feature_files')
+"""An image found by :func:`iter_images`
+
+.. py:attribute:: path
+
+    Full path of the image
+
+.. py:attribute:: key
+
+    Path relative to the searched directory, with '/' as separator. This is the key of the image in a database.
+
+.. py:attribute:: feature_files
+
+    dict from feature type key (see :data:`FEATURE_TYPES`) to the path of the descriptor file of the image,
+    for the descriptor files that exist
+"""
 
 
+@instrumentation.timed('utils.load_descriptors_and_keypoints')
 def load_descriptors_and_keypoints(path, *, descriptors=True, keypoints=True):
     """Load a descriptor/keypoint file
 
@@ -54,29 +82,157 @@ def load_descriptors_and_keypoints(path, *, descriptors=True, keypoints=True):
     """
     with h5py.File(path, 'r') as f:
         if descriptors:
-            descriptors = f['descriptors'].value
+            descriptors = f['descriptors'][()]
         else:
             descriptors = None
 
         keypoint_list = []
         if keypoints:
             g = f['keypoints']
-            points = g['pt'].value
-            sizes = g['size'].value
-            angles = g['angle'].value
-            responses = g['response'].value
-            octaves = g['octave'].value
+            points = g['pt'][()]
+            sizes = g['size'][()].ravel()
+            angles = g['angle'][()].ravel()
+            responses = g['response'][()].ravel()
+            octaves = g['octave'][()].ravel()
 
             for (x, y), size, angle, response, octave in zip(points, sizes, angles, responses, octaves):
-                kp = cv2.KeyPoint(x, y, size, angle, response, octave)
+                kp = cv2.KeyPoint(float(x), float(y), float(size), float(angle), float(response), int(octave))
                 keypoint_list.append(kp)
 
+    if descriptors is not None:
+        instrumentation.count('utils.bytes_read', descriptors.nbytes)
     return descriptors, keypoint_list
 
 
-def save_keypoints_and_descriptors(path, kps, desc):
-    """Save keypoints and descriptors to a HDF5 file"""
+@instrumentation.timed('utils.load_descriptors_and_points')
+def load_descriptors_and_points(path):
+    """Load descriptors and keypoint locations from a descriptor/keypoint file
+
+    This is much faster than :func:`load_descriptors_and_keypoints` since no cv2.Keypoint objects are created.
+
+    Parameters
+    -------------
+    path : str
+        Path to descriptor file
+
+    Returns
+    ------------------
+    descriptors : array_like
+        NxD array of N descriptor vectors
+    points : array_like
+        Nx2 array of keypoint locations (x, y)
+    """
+    with h5py.File(path, 'r') as f:
+        descriptors = f['descriptors'][()]
+        points = f['keypoints/pt'][()].reshape(-1, 2)
+    instrumentation.count('utils.bytes_read', descriptors.nbytes + points.nbytes)
+    return descriptors, points
+
+
+@instrumentation.timed('utils.load_descriptors_and_points_in_roi')
+def load_descriptors_and_points_in_roi(path, roi):
+    """Load the descriptors and keypoint locations of a descriptor/keypoint file that may be in a region of interest
+
+    For a spatially sorted file (see :func:`save_keypoints_and_descriptors`) only the grid cells that intersect the
+    region of interest are read. Otherwise the whole file is read.
+    In both cases, keypoints outside the region can be included, and should be removed with :func:`roi_mask`.
+
+    Parameters
+    -------------
+    path : str
+        Path to descriptor file
+    roi : array_like
+        Region of interest encoded as (x, y, width, height), or None for everything
+
+    Returns
+    ------------------
+    descriptors : array_like
+        NxD array of N descriptor vectors
+    points : array_like
+        Nx2 array of keypoint locations (x, y)
+    complete : bool
+        True if all keypoints of the file were read
+    """
+    with h5py.File(path, 'r') as f:
+        if roi is None or SPATIAL_GRID_ATTRIBUTE not in f.attrs:
+            descriptors = f['descriptors'][()]
+            points = f['keypoints/pt'][()].reshape(-1, 2)
+            complete = True
+        else:
+            grid = int(f.attrs[SPATIAL_GRID_ATTRIBUTE])
+            cell_width, cell_height = f.attrs[SPATIAL_CELL_SIZE_ATTRIBUTE]
+            offsets = f['keypoints/cell_offsets'][()]
+            rx, ry, rw, rh = roi
+            c0, c1 = np.clip(np.floor([rx / cell_width, (rx + rw) / cell_width]).astype('int'), 0, grid - 1)
+            r0, r1 = np.clip(np.floor([ry / cell_height, (ry + rh) / cell_height]).astype('int'), 0, grid - 1)
+
+            # The cells of a grid row are stored after each other, so each grid row is one contiguous range
+            ranges = [(offsets[r * grid + c0], offsets[r * grid + c1 + 1]) for r in range(r0, r1 + 1)]
+            ranges = [(start, stop) for start, stop in ranges if stop > start]
+            descriptor_dataset = f['descriptors']
+            point_dataset = f['keypoints/pt']
+            descriptors = np.concatenate([descriptor_dataset[start:stop] for start, stop in ranges] or
+                                         [np.empty((0,) + descriptor_dataset.shape[1:], descriptor_dataset.dtype)])
+            points = np.concatenate([point_dataset[start:stop] for start, stop in ranges] or
+                                    [np.empty((0, 2), point_dataset.dtype)]).reshape(-1, 2)
+            complete = len(points) == len(point_dataset)
+    instrumentation.count('utils.bytes_read', descriptors.nbytes + points.nbytes)
+    return descriptors, points, complete
+
+
+def spatial_order(points, grid, image_size):
+    """Order of keypoints that sorts them into grid cells
+
+    Parameters
+    -------------
+    points : array_like
+        Nx2 array of keypoint locations (x, y)
+    grid : int
+        Number of cells along each side of the image
+    image_size : tuple
+        (width, height) of the image
+
+    Returns
+    ------------------
+    order : array_like
+        Indices of the keypoints, sorted by cell in row-major order
+    offsets : array_like
+        The keypoints of cell i are `order[offsets[i]:offsets[i + 1]]`
+    cell_size : tuple
+        (width, height) of a cell
+    """
+    points = np.asarray(points, dtype='float64').reshape(-1, 2)
+    width, height = image_size
+    cell_size = (width / grid, height / grid)
+    column = np.clip(np.floor(points[:, 0] / cell_size[0]).astype('int'), 0, grid - 1)
+    row = np.clip(np.floor(points[:, 1] / cell_size[1]).astype('int'), 0, grid - 1)
+    cell = row * grid + column
+    order = np.argsort(cell, kind='stable')
+    offsets = np.r_[0, np.cumsum(np.bincount(cell, minlength=grid * grid))]
+    return order, offsets, cell_size
+
+
+def save_keypoints_and_descriptors(path, kps, desc, attrs=None, grid=None, image_size=None):
+    """Save keypoints and descriptors to a HDF5 file
+
+    Optional `attrs`, e.g. the keypoint policy (see :func:`vsearch.sift.keypoint_policy_attrs`), are stored as
+    attributes of the file.
+
+    If `grid` is given the file is spatially sorted: the keypoints are sorted into a `grid` x `grid` grid over the
+    image, with a table of where each cell starts. Queries with a region of interest then only need to read the
+    cells that intersect the region, see :func:`load_descriptors_and_points_in_roi`.
+    The `image_size` (width, height) is then also needed.
+    """
+    if grid is not None:
+        order, offsets, cell_size = spatial_order([kp.pt for kp in kps], grid, image_size)
+        kps = [kps[i] for i in order]
+        desc = np.asarray(desc)[order]
+
     with h5py.File(path, 'w') as f:
+        f.attrs.update(attrs or {})
+        if grid is not None:
+            f.attrs[SPATIAL_GRID_ATTRIBUTE] = grid
+            f.attrs[SPATIAL_CELL_SIZE_ATTRIBUTE] = cell_size
         f['descriptors'] = np.vstack(desc)
         g = f.create_group('keypoints')
         g['pt'] = np.vstack([kp.pt for kp in kps])
@@ -84,12 +240,75 @@ def save_keypoints_and_descriptors(path, kps, desc):
         g['angle'] = np.vstack([kp.angle for kp in kps])
         g['response'] = np.vstack([kp.response for kp in kps])
         g['octave'] = np.vstack([kp.octave for kp in kps])
+        if grid is not None:
+            g['cell_offsets'] = offsets
+
+
+def _matches(key, name, patterns):
+    return any(fnmatch.fnmatchcase(key, pattern) or fnmatch.fnmatchcase(name, pattern) for pattern in patterns)
+
+
+def iter_images(directory, include=None, exclude=None, recursive=True, extensions=SUPPORTED_IMAGE_EXTENSIONS):
+    """Generate the images in a directory tree
+
+    Each directory is listed once with :func:`os.scandir`, and the descriptor files of the images are found in
+    the same listing. Images are generated as each directory is listed, in sorted order within a directory and
+    depth first. Symbolic links to directories are not followed.
+
+    Parameters
+    -------------
+    directory : str
+        Root directory
+    include : list
+        Glob patterns, e.g. ``['2016/*']``. If given, only images whose key or file name matches a pattern are
+        generated.
+    exclude : list
+        Glob patterns, e.g. ``['*/thumbnails', '.*']``. Files and directories whose key (relative path) or name
+        matches a pattern are skipped.
+    recursive : bool
+        Whether to search subdirectories
+    extensions : tuple
+        Image file extensions
+
+    Returns
+    -------------
+    Generator of :class:`ImageFile`
+    """
+    extensions = tuple(ext.lower() for ext in extensions)
+    feature_extensions = [(ft.key, ft.extension) for ft in FEATURE_TYPES.values()]
+    pending = ['']
+    while pending:
+        relative = pending.pop()
+        try:
+            with os.scandir(os.path.join(directory, relative)) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+        except OSError:
+            if not relative:
+                raise
+            continue  # Removed or unreadable subdirectory
+
+        names = set(entry.name for entry in entries)
+        subdirectories = []
+        for entry in entries:
+            key = relative + entry.name
+            if exclude and _matches(key, entry.name, exclude):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                if recursive:
+                    subdirectories.append(key + '/')
+                continue
+            root, ext = os.path.splitext(entry.name)
+            if ext.lower() not in extensions or (include and not _matches(key, entry.name, include)):
+                continue
+            feature_files = {feature: os.path.join(os.path.dirname(entry.path), root + feature_extension)
+                             for feature, feature_extension in feature_extensions if root + feature_extension in names}
+            yield ImageFile(entry.path, key, feature_files)
+        pending.extend(reversed(subdirectories))
 
 
 def find_images(directory):
-    """Return list of full paths to images of a supported format in a directory"""
-    return [os.path.join(directory, f) for f in os.listdir(directory)
-            if os.path.splitext(f)[-1] in SUPPORTED_IMAGE_EXTENSIONS]
+    """Return list of full paths to images of a supported format in a directory, not including subdirectories"""
+    return [image.path for image in iter_images(directory, recursive=False)]
 
 
 def keypoint_inside_roi(kp, roi):
@@ -110,16 +329,53 @@ def keypoint_inside_roi(kp, roi):
     return (rx <= x <= rx + rw) and (ry <= y <= ry + rh)
 
 
+def roi_mask(points, roi):
+    """Boolean mask of the points that are within the region of interest
+
+    Parameters
+    -----------------
+    points : array_like
+        Nx2 array of (x, y) locations
+    roi : array_like
+        Region of interest encoded as (x, y, width, height), or None for everything
+
+    Returns
+    -----------------
+    Boolean array of length N
+    """
+    points = np.asarray(points).reshape(-1, 2)
+    if roi is None:
+        return np.ones(len(points), dtype='bool')
+    rx, ry, rw, rh = roi
+    x = points[:, 0]
+    y = points[:, 1]
+    return (rx <= x) & (x <= rx + rw) & (ry <= y) & (y <= ry + rh)
+
+
 def filter_roi(des, kps, roi):
     """Filter a list of keypoints and descriptors to only those within the region of interest
 
     Parameters
     -------------------
+    des : array_like
+        NxD array of N descriptors
+    kps : list
+        List of N cv2.Keypoint objects
+    roi : array_like
+        Region of interest encoded as (x, y, width, height), or None to keep everything
 
+    Returns
+    -------------------
+    des : array_like
+        The descriptors of the keypoints within the ROI
+    kps : list
+        The keypoints within the ROI
     """
-    valid = [i for i, kp in enumerate(kps) if keypoint_inside_roi(kp, roi)]
-    kps = [kp for i, kp in enumerate(kps) if i in valid]
-    des = des[valid]
+    if roi is None:
+        return des, kps
+    valid = np.flatnonzero(roi_mask([kp.pt for kp in kps], roi))
+    kps = [kps[i] for i in valid]
+    des = des[valid] if len(des) else des
     return des, kps
 
 
@@ -130,13 +386,18 @@ def save_vocabulary(means, path):
 
 def load_vocabulary(path):
     with h5py.File(path, 'r') as f:
-        return f['vocabulary'].value
+        return f['vocabulary'][()]
 
 
 def image_for_descriptor_file(desc_path):
+    """Path of the image that a descriptor file belongs to
+
+    The directory is listed once, instead of checking each image extension. Use :func:`iter_images` to pair many
+    images with their descriptor files.
+    """
     try:
         feat_type = [ft for ft in FEATURE_TYPES.values() if desc_path.endswith(ft.extension)][0]
-    except KeyError:
+    except IndexError:
         raise ValueError("{} does not match any known feature type extension".format(os.path.basename(desc_path)))
 
     fname = os.path.basename(desc_path)
@@ -144,10 +405,11 @@ def image_for_descriptor_file(desc_path):
     directory = os.path.dirname(desc_path)
 
     images = []
-    for ext in SUPPORTED_IMAGE_EXTENSIONS:
-        path = os.path.join(directory, root + ext)
-        if os.path.exists(path):
-            images.append(path)
+    with os.scandir(directory or '.') as it:
+        for entry in it:
+            name_root, ext = os.path.splitext(entry.name)
+            if name_root == root and ext.lower() in SUPPORTED_IMAGE_EXTENSIONS:
+                images.append(os.path.join(directory, entry.name))
 
     if not images:
         raise ValueError("No matching image found")